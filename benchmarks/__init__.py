@@ -0,0 +1,46 @@
+'''
+Offline benchmarks for Gamba-Bot's hot paths. Every benchmark runs
+against a throwaway database and fixed item prices, so no network
+access or Discord connection is needed.
+'''
+
+import time
+from gw2_api import ItemType
+
+class FixedPriceAPI:
+    '''Stand-in for `gw2_api.API` that always returns the same prices.'''
+
+    def __init__(self, ecto_value: float = 0.25, rune_value: float = 3.0):
+
+        self._prices = {ItemType.ectoplasm: ecto_value, ItemType.rune: rune_value}
+        self.epoch = 1
+        self.stale = False
+        self.updated_at = time.time()
+
+    def get_item_value(self, item: ItemType) -> float:
+
+        return self._prices[item]
+
+    async def get_item_value_async(self, item: ItemType) -> float:
+
+        return self._prices[item]
+
+    def get_item_value_at(self, item: ItemType, timestamp: float) -> float:
+
+        return self._prices[item]
+
+    async def get_item_value_at_async(self, item: ItemType, timestamp: float) -> float:
+
+        return self._prices[item]
+
+    def revalidate(self):
+        pass
+
+    async def refresh(self, force: bool = False):
+        pass
+
+    async def poll(self, interval: float | None = None):
+        pass
+
+    async def close(self):
+        pass
@@ -0,0 +1,81 @@
+'''
+Generates synthetic gambling histories for benchmarking.
+
+Rows are spread over players following a Zipf-like distribution, so a
+few heavy gamblers own most of the history, like on a real server.
+Rows are written in chunks, so histories of millions of rows can be
+generated with constant memory.
+
+    python -m benchmarks.dataset synthetic.db --rows 1000000 --players 5000 --skew 1.1
+'''
+
+import argparse
+import os
+import random
+import time
+from itertools import accumulate
+from connector import Connector
+
+CHUNK_SIZE = 100_000
+HISTORY_SECONDS = 2 * 365 * 24 * 3600
+
+def generate(
+        conn: Connector,
+        table: str,
+        rows: int,
+        players: int,
+        skew: float = 1.0,
+        seed: int = 0,
+        end: float | None = None):
+    '''
+    Fills `table` with `rows` random gambles by `players` players, then builds the player totals.
+    - `skew` - exponent of the player distribution. 0 spreads rows evenly, higher values favour a few players.
+    - `seed` - seed for the random generator, so that datasets can be reproduced.
+    - `end` - unix time of the last gamble. Gambles span the two years before it.
+    '''
+
+    rng = random.Random(seed)
+    end = end if end is not None else time.time()
+    start = end - HISTORY_SECONDS
+    weights = list(accumulate(1 / (rank + 1) ** skew for rank in range(players)))
+    # Player ids are shuffled so that the heaviest gamblers aren't simply the lowest ids
+    ids = rng.sample(range(10**17, 10**18), players)
+
+    conn.migrate(table)
+    written = 0
+    while written < rows:
+        size = min(CHUNK_SIZE, rows - written)
+        chunk = []
+        for i, player in enumerate(rng.choices(ids, cum_weights=weights, k=size)):
+            hands = rng.randint(1, 30)
+            chunk.append((
+                player,
+                hands,
+                rng.randint(0, 220 * hands),
+                rng.randint(0, 550 * hands),
+                int(rng.random() < 0.02 * hands),
+                start + (written + i) * HISTORY_SECONDS / rows))
+        with conn._connection:
+            conn._connection.executemany(
+                f'INSERT INTO {table}(player, gambles, gold, ectos, runes, timestamp) VALUES (?, ?, ?, ?, ?, ?)',
+                chunk)
+        written += size
+    conn.rebuild_totals(table)
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dbfile', help="sqlite database to fill. Existing rows are kept.")
+    parser.add_argument('--table', default='data')
+    parser.add_argument('--rows', type=int, default=10_000)
+    parser.add_argument('--players', type=int, default=1_000)
+    parser.add_argument('--skew', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    generate(Connector(os.path.abspath(args.dbfile)), args.table, args.rows, args.players, args.skew, args.seed)
+    print(f'Generated {args.rows} rows for {args.players} players in {time.perf_counter() - start:.1f} s.')
+
+if __name__ == '__main__':
+    main()
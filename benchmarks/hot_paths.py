@@ -0,0 +1,174 @@
+'''
+Measures the latency and memory of the queries behind /gamba stats,
+/gamba winners, /gamba losers, /gamba total and /gamba record, over
+all time and within time windows, on a synthetic history, fully offline.
+
+    python -m benchmarks.hot_paths --rows 1000000 --players 5000 --save baseline.json
+    python -m benchmarks.hot_paths --rows 1000000 --players 5000 --baseline baseline.json --threshold 0.2
+
+Exits with status 1 if any median latency regressed past the threshold.
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Awaitable, Callable
+from connector import Connector
+from gamble import Gamble
+from bot import GambaBot, parse_window
+from benchmarks import FixedPriceAPI
+from benchmarks.dataset import generate
+
+TABLE = 'data'
+
+class Result:
+    '''Latencies, in milliseconds, and peak traced memory of one benchmarked operation.'''
+
+    def __init__(self, name: str, latencies: list[float], peak_bytes: int):
+
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.peak_bytes = peak_bytes
+
+    def percentile(self, p: float) -> float:
+
+        return self.latencies[min(int(len(self.latencies) * p), len(self.latencies) - 1)]
+
+    def to_dict(self) -> dict:
+
+        return {
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+            'max': self.latencies[-1],
+            'peak_kib': self.peak_bytes / 1024,
+        }
+
+async def measure(name: str, op: Callable[[], Awaitable], iterations: int, warmup: int = 3) -> Result:
+    '''Times `iterations` calls of `op`, then traces the memory allocated by one more call.'''
+
+    for _ in range(warmup):
+        await op()
+
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await op()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    tracemalloc.start()
+    await op()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return Result(name, latencies, peak)
+
+def sync(f: Callable, *args) -> Callable[[], Awaitable]:
+    '''Wraps a synchronous call so it can be measured like the asynchronous ones.'''
+
+    async def op():
+        return f(*args)
+    return op
+
+async def run(dbfile: str, iterations: int) -> list[Result]:
+    '''Runs every benchmark against an existing database.'''
+
+    conn = Connector(dbfile)
+    rng = random.Random(1)
+    players = [row[0] for row in conn._run_query(
+        f'SELECT player FROM {conn._totals(TABLE)} ORDER BY count DESC')]
+    heaviest = players[0]
+
+    def random_player() -> int:
+        return rng.choice(players)
+
+    bot = GambaBot(dbfile=dbfile, api=FixedPriceAPI())
+    # Walks to the edge of page 49, or of the last page for smaller histories, to seek the deep page from
+    deep = await bot.leaderboard_page(5, True)
+    for _ in range(48):
+        if not deep.has_next:
+            break
+        deep = await bot.leaderboard_page(5, True, previous=deep)
+    results = [
+        await measure('user_totals', lambda: sync(conn.user_totals, TABLE, random_player())(), iterations),
+        await measure('recent_by_user', lambda: sync(conn.recent_by_user, TABLE, random_player(), 5)(), iterations),
+        await measure('recent_by_user (heaviest)', sync(conn.recent_by_user, TABLE, heaviest, 5), iterations),
+        await measure('bot_totals', sync(conn.bot_totals, TABLE), iterations),
+        await measure('all_user_totals', sync(conn.all_user_totals, TABLE), iterations),
+        await measure('save_gamble', lambda: sync(conn.save_gamble, TABLE, Gamble(random_player(), 5, 500, 1000, 0))(), iterations),
+        await measure('create_leaderboard', lambda: bot._create_leaderboard(5, True), iterations),
+        await measure('create_leaderboard (this month)',
+            lambda: bot._create_leaderboard(5, True, window=parse_window('this month')), iterations),
+        await measure('create_leaderboard (cached)', lambda: bot.create_leaderboard(5, True), iterations),
+        await measure('leaderboard_page (page 50)', lambda: bot.leaderboard_page(5, True, previous=deep), iterations),
+    ]
+    await bot._dbconn.close()
+    conn._connection.close()
+    return results
+
+def report(results: list[Result], baseline: dict | None, threshold: float) -> list[str]:
+    '''Prints a table of results, and returns the names of the operations that regressed.'''
+
+    regressions = []
+    print(f"{'operation':30} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'peak KiB':>10}")
+    for result in results:
+        stats = result.to_dict()
+        line = (f"{result.name:30} {stats['p50']:9.3f} {stats['p95']:9.3f} {stats['p99']:9.3f} "
+            f"{stats['max']:9.3f} {stats['peak_kib']:10.1f}")
+        if baseline is not None and result.name in baseline:
+            previous = baseline[result.name]['p50']
+            change = stats['p50'] / previous - 1 if previous > 0 else 0
+            line += f"   {change:+.0%} vs baseline"
+            if change > threshold:
+                regressions.append(result.name)
+                line += '  REGRESSION'
+        print(line)
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'Peak resident memory: {peak_rss / 1024:.1f} MiB')
+    return regressions
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dbfile', help="existing database to benchmark. By default a synthetic one is generated.")
+    parser.add_argument('--rows', type=int, default=10_000)
+    parser.add_argument('--players', type=int, default=1_000)
+    parser.add_argument('--skew', type=float, default=1.0)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--save', help="file to store the results in, for use as a baseline.")
+    parser.add_argument('--baseline', help="results file of a previous run to compare against.")
+    parser.add_argument('--threshold', type=float, default=0.25,
+        help="largest allowed relative increase of a median latency over the baseline.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        dbfile = os.path.abspath(args.dbfile) if args.dbfile else os.path.join(folder, 'bench.db')
+        if not args.dbfile:
+            start = time.perf_counter()
+            generate(Connector(dbfile), TABLE, args.rows, args.players, args.skew)
+            print(f'Generated {args.rows} rows for {args.players} players in {time.perf_counter() - start:.1f} s.')
+        results = asyncio.run(run(dbfile, args.iterations))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    regressions = report(results, baseline, args.threshold)
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump({result.name: result.to_dict() for result in results}, file, indent=2)
+
+    if regressions:
+        print(f"Regressed past {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+'''
+Compares building the leaderboards in Python from every player's totals
+against the `Connector.leaderboard` query, which ranks players in SQL.
+
+    python -m benchmarks.leaderboard --players 100000
+'''
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from heapq import nlargest, nsmallest
+from connector import Connector
+from gw2_api import ItemType
+from benchmarks import FixedPriceAPI
+
+TABLE = 'data'
+
+def populate(conn: Connector, players: int, seed: int = 0):
+    '''Fills the table with one random gamble per player and builds the player totals.'''
+
+    rng = random.Random(seed)
+    rows = []
+    for player in range(players):
+        hands = rng.randint(1, 50)
+        rows.append((player, hands, rng.randint(0, 200 * hands), rng.randint(0, 500 * hands), rng.randint(0, 2), time.time()))
+    with conn._connection:
+        conn._connection.executemany(f'INSERT INTO {TABLE}(player, gambles, gold, ectos, runes, timestamp) VALUES (?, ?, ?, ?, ?, ?)', rows)
+    conn.rebuild_totals(TABLE)
+
+def python_leaderboard(conn: Connector, api: FixedPriceAPI, n: int, winners: bool):
+    '''The original path: value every player in Python, then select the top `n`.'''
+
+    users = conn.all_user_totals(TABLE)
+    n = min(n, len(users))
+    fun = nlargest if winners else nsmallest
+    top_total   = fun(n, users, key=lambda x: x.get_value(api)[0])
+    top_average = fun(n, users, key=lambda x: x.get_value(api)[1])
+    return top_total, top_average
+
+def sql_leaderboard(conn: Connector, api: FixedPriceAPI, n: int, winners: bool):
+    '''The SQL path: rank players in the database and only load the top `n`.'''
+
+    ecto_value = api.get_item_value(ItemType.ectoplasm)
+    rune_value = api.get_item_value(ItemType.rune)
+    top_total = conn.leaderboard(TABLE, ecto_value, rune_value, n, winners)
+    top_average = conn.leaderboard(TABLE, ecto_value, rune_value, n, winners, by_average=True)
+    for user in top_total + top_average:
+        user.get_value(api)
+    return top_total, top_average
+
+def summarize(result, api: FixedPriceAPI) -> list[list[tuple]]:
+    '''Reduces a pair of leaderboards to comparable (player, value) rows.'''
+
+    return [[(g.user, g.get_value(api)) for g in ranking] for ranking in result]
+
+def timed(fun, *args, repeat: int) -> tuple[float, object]:
+    '''Returns the best time over `repeat` runs, in milliseconds, and the last result.'''
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fun(*args)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, result
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--players', type=int, default=100_000)
+    parser.add_argument('--top', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    api = FixedPriceAPI()
+    with tempfile.TemporaryDirectory() as folder:
+        conn = Connector(os.path.join(folder, 'bench.db'))
+        conn.migrate(TABLE)
+        populate(conn, args.players)
+
+        for winners in (True, False):
+            python_ms, python_result = timed(python_leaderboard, conn, api, args.top, winners, repeat=args.repeat)
+            sql_ms, sql_result = timed(sql_leaderboard, conn, api, args.top, winners, repeat=args.repeat)
+            same = summarize(python_result, api) == summarize(sql_result, api)
+            name = 'winners' if winners else 'losers'
+            print(f'{name:8} python: {python_ms:9.2f} ms   sql: {sql_ms:9.2f} ms   '
+                f'speedup: {python_ms / sql_ms:6.1f}x   identical: {same}')
+        conn._connection.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+'''
+Load test driving the /gamba commands of `main.py` and the gamble form's
+`GambaModal.callback` with many concurrent simulated users, through local
+stand-ins for Discord's interaction objects and for the GW2 prices
+endpoint, fully offline.
+
+    python -m benchmarks.load_test --users 300 --requests 5000 --mix record=3,stats=3,winners=2,total=1
+    python -m benchmarks.load_test --duration 30 --price-latency 200 --write-behind
+
+Reports the throughput and latency of every command, and how late the event
+loop ran a timer that should have fired every `--lag-interval` milliseconds.
+Exits with status 1 if the event loop lagged by more than `--max-lag`
+milliseconds, which usually means something blocked it.
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from aiohttp import web
+import main as commands
+from bot import GambaBot, GambaModal
+from connector import Connector
+from gw2_api import API, ItemType, PriceHistory
+from benchmarks.dataset import generate
+from benchmarks.hot_paths import Result
+
+TABLE = 'data'
+COMMANDS = ('record', 'stats', 'winners', 'losers', 'total', 'rank', 'distribution', 'delete')
+DEFAULT_MIX = 'record=4,stats=3,winners=2,losers=1,total=1,rank=1,distribution=1,delete=1'
+# Prices served by the fake GW2 API, in coppers
+PRICES = {ItemType.ectoplasm: 2500, ItemType.rune: 30000}
+
+class FakePriceServer:
+    '''Local stand-in for the GW2 prices endpoint, answering after a fixed latency.'''
+
+    def __init__(self, latency: float = 0.0):
+        '''
+        Creates the server, which must then be started.
+        - `latency` - seconds waited before answering each request.
+        '''
+
+        self.latency = latency
+        self.requests = 0
+        self._runner: web.AppRunner | None = None
+
+    async def start(self) -> str:
+        '''Starts serving on a free local port, and returns the url of the prices endpoint.'''
+
+        app = web.Application()
+        app.router.add_get('/v2/commerce/prices', self._prices)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f'http://127.0.0.1:{port}/v2/commerce/prices'
+
+    async def stop(self):
+
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _prices(self, request: web.Request) -> web.Response:
+
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        ids = [int(i) for i in request.query.get('ids', '').split(',') if i]
+        by_id = {item.value: price for item, price in PRICES.items()}
+        return web.json_response([{'id': i, 'sells': {'unit_price': by_id[i]}} for i in ids if i in by_id])
+
+class FakeUser:
+
+    def __init__(self, id: int):
+
+        self.id = id
+        self.mention = f'<@{id}>'
+
+class FakeAttachment:
+
+    def __init__(self, url: str):
+
+        self.url = url
+
+class FakeResponse:
+    '''Stand-in for `discord.InteractionResponse`, which only keeps what was sent.'''
+
+    def __init__(self):
+
+        self.sent: list[dict] = []
+
+    async def send_message(self, content: str | None = None, **kwargs):
+
+        self.sent.append({'content': content, **kwargs})
+
+    async def edit_message(self, **kwargs):
+
+        self.sent.append(kwargs)
+
+class FakeInteraction:
+    '''Stand-in for the `discord.Interaction` of a submitted form.'''
+
+    def __init__(self, user: FakeUser, guild_id: int | None):
+
+        self.user = user
+        self.guild_id = guild_id
+        self.response = FakeResponse()
+
+class FakeContext:
+    '''Stand-in for the `discord.ApplicationContext` of a slash command.'''
+
+    def __init__(self, bot: GambaBot, author: FakeUser, guild_id: int | None):
+
+        self.bot = bot
+        self.author = author
+        self.guild_id = guild_id
+        self.responses: list[dict] = []
+        self.modal: GambaModal | None = None
+
+    async def respond(self, content: str | None = None, **kwargs):
+
+        self.responses.append({'content': content, **kwargs})
+
+    async def send_modal(self, modal: GambaModal):
+
+        self.modal = modal
+
+async def run_command(bot: GambaBot, command: str, user: FakeUser, guild_id: int | None, rng: random.Random):
+    '''Runs one command as `user` would, through the command callbacks of `main.py`.'''
+
+    ctx = FakeContext(bot, user, guild_id)
+    if command == 'record':
+        await commands.record.callback(ctx, FakeAttachment('https://example.com/proof.png'))
+        # The user fills the form in, then submits it
+        hands = rng.randint(1, 30)
+        for field, value in zip(ctx.modal.children,
+                (hands, rng.randint(0, 220 * hands), rng.randint(0, 550 * hands), int(rng.random() < 0.02 * hands))):
+            field.value = str(value)
+        await ctx.modal.callback(FakeInteraction(user, guild_id))
+    elif command in ('stats', 'winners', 'losers', 'total'):
+        window = rng.choice(('all time', 'all time', 'this week', 'this month'))
+        await getattr(commands, command).callback(ctx, window, None, None)
+    elif command == 'rank':
+        await commands.rank.callback(ctx, rng.choice(('total', 'average')))
+    else:
+        await getattr(commands, command).callback(ctx)
+
+async def monitor_lag(interval: float, lags: list[float], stop: asyncio.Event):
+    '''Records how late the event loop wakes up a task sleeping `interval` seconds at a time, until `stop` is set.'''
+
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(max(time.perf_counter() - start - interval, 0) * 1000)
+
+async def run(dbfile: str, pricefile: str, players: list[int], args: argparse.Namespace) -> dict:
+    '''Runs the workload against an existing database, and returns the results.'''
+
+    server = FakePriceServer(args.price_latency / 1000)
+    url = await server.start()
+    api = API(cache_minutes=args.price_ttl / 60, base_url=url, history=PriceHistory(pricefile))
+    bot = GambaBot(write_behind=args.write_behind, dbfile=dbfile, api=api)
+
+    mix = parse_mix(args.mix)
+    names, weights = list(mix), list(mix.values())
+    latencies: dict[str, list[float]] = {name: [] for name in names}
+    errors: dict[str, int] = {}
+    lags: list[float] = []
+    stop = asyncio.Event()
+    deadline = time.perf_counter() + args.duration if args.duration else None
+    issued = 0
+
+    async def user_loop(seed: int):
+        nonlocal issued
+        rng = random.Random(seed)
+        user = FakeUser(rng.choice(players))
+        while True:
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            if deadline is None and issued >= args.requests:
+                return
+            issued += 1
+            command = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                await run_command(bot, command, user, None, rng)
+            except Exception as e:
+                error = f'{command}: {type(e).__name__}: {e}'
+                errors[error] = errors.get(error, 0) + 1
+                continue
+            latencies[command].append((time.perf_counter() - start) * 1000)
+            if args.think:
+                await asyncio.sleep(rng.expovariate(1000 / args.think))
+
+    monitor = asyncio.create_task(monitor_lag(args.lag_interval / 1000, lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(user_loop(args.seed + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await monitor
+
+    await bot._api.close()
+    await bot._dbconn.close()
+    await server.stop()
+    return {'elapsed': elapsed, 'latencies': latencies, 'errors': errors, 'lags': lags,
+        'price_requests': server.requests}
+
+def parse_mix(mix: str) -> dict[str, float]:
+    '''Parses a workload mix such as "record=3,stats=1" into the weight of each command.'''
+
+    weights = {}
+    for part in mix.split(','):
+        command, _, weight = part.partition('=')
+        command = command.strip()
+        if command not in COMMANDS:
+            raise ValueError(f"Unknown command '{command}', expected one of: {', '.join(COMMANDS)}.")
+        weights[command] = float(weight) if weight else 1.0
+    return weights
+
+def report(results: dict) -> dict:
+    '''Prints the throughput and latency of every command and the event loop lag, and returns them as a summary.'''
+
+    elapsed = results['elapsed']
+    summary = {'elapsed': elapsed, 'commands': {}, 'errors': results['errors']}
+    total = sum(len(latencies) for latencies in results['latencies'].values())
+    print(f"{'command':14} {'count':>7} {'per s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for command, latencies in results['latencies'].items():
+        if not latencies:
+            continue
+        stats = Result(command, latencies, 0).to_dict()
+        del stats['peak_kib']
+        summary['commands'][command] = {'count': len(latencies), 'throughput': len(latencies) / elapsed, **stats}
+        print(f"{command:14} {len(latencies):7} {len(latencies) / elapsed:8.1f} {stats['p50']:9.2f} "
+            f"{stats['p95']:9.2f} {stats['p99']:9.2f} {stats['max']:9.2f}")
+    print(f"{'all':14} {total:7} {total / elapsed:8.1f}")
+
+    lag = Result('lag', results['lags'] or [0.0], 0).to_dict()
+    del lag['peak_kib']
+    summary['loop_lag'] = lag
+    print(f"Event loop lag: p50 {lag['p50']:.2f} ms, p99 {lag['p99']:.2f} ms, max {lag['max']:.2f} ms")
+    print(f"Price requests served: {results['price_requests']}")
+    for error, count in sorted(results['errors'].items()):
+        print(f"  {count} error(s) in {error}")
+    return summary
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dbfile', help="existing database to run against. By default a synthetic one is generated.")
+    parser.add_argument('--rows', type=int, default=100_000, help="rows of the generated database.")
+    parser.add_argument('--players', type=int, default=2_000, help="players of the generated database.")
+    parser.add_argument('--users', type=int, default=200, help="concurrent simulated users.")
+    parser.add_argument('--requests', type=int, default=5_000, help="commands to run in total.")
+    parser.add_argument('--duration', type=float, help="seconds to run for, instead of a number of commands.")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="relative weight of each command, as command=weight pairs.")
+    parser.add_argument('--think', type=float, default=0, help="mean pause of a user between commands, in ms.")
+    parser.add_argument('--write-behind', action='store_true', help="commit submitted gambles in groups.")
+    parser.add_argument('--price-latency', type=float, default=50, help="response time of the fake GW2 API, in ms.")
+    parser.add_argument('--price-ttl', type=float, default=60, help="seconds prices are cached for.")
+    parser.add_argument('--lag-interval', type=float, default=10, help="period of the event loop lag probe, in ms.")
+    parser.add_argument('--max-lag', type=float, default=250, help="event loop lag, in ms, that fails the run.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help="file to store the summary in, as JSON.")
+    args = parser.parse_args()
+    try:
+        parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    with tempfile.TemporaryDirectory() as folder:
+        dbfile = args.dbfile
+        if dbfile is None:
+            dbfile = os.path.join(folder, 'load.db')
+            start = time.perf_counter()
+            generate(Connector(dbfile), TABLE, args.rows, args.players, seed=args.seed)
+            print(f"Generated {args.rows} rows for {args.players} players in {time.perf_counter() - start:.1f} s.")
+        conn = Connector(dbfile)
+        conn.migrate(TABLE)
+        # Users are picked among existing players, so that their stats aren't all empty
+        players = [row[0] for row in conn._run_query(
+            f'SELECT player FROM {conn._totals(TABLE)} LIMIT ?', params=(args.users * 10,))] or list(range(1, args.users + 1))
+        conn._connection.close()
+        results = asyncio.run(run(dbfile, os.path.join(folder, 'prices.db'), players, args))
+
+    summary = report(results)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump(summary, file, indent=2)
+
+    if summary['loop_lag']['max'] > args.max_lag:
+        print(f"Event loop lagged by more than {args.max_lag:.0f} ms.")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
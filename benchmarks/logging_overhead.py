@@ -0,0 +1,112 @@
+'''
+Measures what logging costs the thread that logs, which is the event loop
+in the bot: the time spent per record under the former setup, a DEBUG
+`FileHandler` written synchronously, against the queued pipeline of
+`logs.configure_logging`, with and without sampling of the gateway's
+debug records. Records mimic py-cord's, one debug record per gateway
+event plus the occasional info record, fully offline.
+
+    python -m benchmarks.logging_overhead --records 200000
+    python -m benchmarks.logging_overhead --events-per-info 20 --save logging.json
+
+Also reports how long the background thread took to write the queue out.
+'''
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+import logs
+from benchmarks.hot_paths import Result
+
+# A gateway event as py-cord logs it, roughly the size of an INTERACTION_CREATE
+EVENT = {
+    't': 'INTERACTION_CREATE', 's': 42, 'op': 0,
+    'd': {
+        'type': 2, 'token': 'x' * 180, 'id': '1284129171022286848', 'guild_id': '1284129080731635754',
+        'channel_id': '1284131395492646985', 'application_id': '1284129171022286849', 'locale': 'en-GB',
+        'member': {'user': {'id': '1284129171022286850', 'username': 'gambler', 'global_name': 'Gambler',
+            'avatar': 'a' * 32, 'discriminator': '0'}, 'roles': ['1284129171022286851'] * 3,
+            'joined_at': '2024-09-13T12:00:00.000000+00:00', 'permissions': '2251799813685247'},
+        'data': {'type': 1, 'name': 'gamba', 'id': '1284129171022286852',
+            'options': [{'type': 1, 'name': 'stats', 'options': [{'type': 3, 'name': 'window', 'value': 'all time'}]}]},
+    },
+}
+
+def legacy_logging(filename: str):
+    '''Sets logging up as the bot used to: a DEBUG `discord` logger with a synchronous file handler.'''
+
+    logger = logging.getLogger('discord')
+    logger.setLevel(logging.DEBUG)
+    handler = logging.FileHandler(filename=filename, encoding='utf-8', mode='w')
+    handler.setFormatter(logging.Formatter(logs.LOG_FORMAT))
+    logger.addHandler(handler)
+    return handler
+
+def emit(records: int, events_per_info: int) -> list[float]:
+    '''Logs `records` records as py-cord would, and returns the time spent in each call, in milliseconds.'''
+
+    gateway = logging.getLogger('discord.gateway')
+    client = logging.getLogger('discord.client')
+    latencies = []
+    for i in range(records):
+        start = time.perf_counter()
+        if i % events_per_info:
+            gateway.debug('For Shard ID %s: WebSocket Event: %s', 0, EVENT)
+        else:
+            client.info('Dispatching event %s', 'interaction')
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+def run(mode: str, folder: str, args: argparse.Namespace) -> tuple[Result, float, int]:
+    '''Benchmarks one setup, and returns its latencies, the time taken to write the queue out, and the size of the logs.'''
+
+    filename = os.path.join(folder, f'{mode}.log')
+    if mode == 'direct':
+        handler = legacy_logging(filename)
+    else:
+        every = args.sample_every if mode == 'sampled' else 1
+        logs.configure_logging({'LOG_FILE': filename, 'LOG_SAMPLE_EVERY': str(every)})
+
+    latencies = emit(args.records, args.events_per_info)
+    start = time.perf_counter()
+    if mode == 'direct':
+        logging.getLogger('discord').removeHandler(handler)
+        handler.close()
+    else:
+        logs.stop_logging()
+    drain = time.perf_counter() - start
+    # Rotated files count too
+    size = sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder) if name.startswith(f'{mode}.log'))
+    return Result(mode, latencies, 0), drain, size
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=100_000, help="records logged per setup.")
+    parser.add_argument('--events-per-info', type=int, default=50, help="gateway debug records per info record.")
+    parser.add_argument('--sample-every', type=int, default=logs.LOG_SAMPLE_EVERY,
+        help="one gateway debug record in this many is kept by the sampled setup.")
+    parser.add_argument('--save', help="file to store the results in, as JSON.")
+    args = parser.parse_args()
+
+    summary = {}
+    print(f"{'setup':8} {'mean us':>9} {'p50 us':>9} {'p99 us':>9} {'max us':>9} {'drain s':>8} {'log MiB':>8}")
+    with tempfile.TemporaryDirectory() as folder:
+        for mode in ('direct', 'queued', 'sampled'):
+            result, drain, size = run(mode, folder, args)
+            stats = result.to_dict()
+            del stats['peak_kib']
+            mean = sum(result.latencies) / len(result.latencies)
+            summary[mode] = {'mean': mean, **stats, 'drain_seconds': drain, 'log_bytes': size}
+            print(f"{mode:8} {mean * 1000:9.2f} {stats['p50'] * 1000:9.2f} {stats['p99'] * 1000:9.2f} "
+                f"{stats['max'] * 1000:9.2f} {drain:8.2f} {size / 2**20:8.2f}")
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump(summary, file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+'''
+Compares gamble submission throughput with one commit per gamble against
+write-behind group commits, under bursts of concurrent submissions.
+
+    python -m benchmarks.write_behind --submissions 2000 --concurrency 50
+'''
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from connector import AsyncConnector
+from gamble import Gamble
+
+TABLE = 'data'
+
+async def submit(db: AsyncConnector, gambles: list[Gamble], concurrency: int) -> list[float]:
+    '''Saves all `gambles`, with at most `concurrency` submissions in flight. Returns each latency in seconds.'''
+
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(gamble: Gamble):
+        async with semaphore:
+            start = time.perf_counter()
+            await db.save_gamble(TABLE, gamble)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(one(g) for g in gambles))
+    return latencies
+
+async def run(folder: str, write_behind: bool, args: argparse.Namespace) -> tuple[float, list[float]]:
+    '''Runs one workload against a fresh database. Returns the elapsed time and the latencies.'''
+
+    rng = random.Random(0)
+    gambles = [Gamble(rng.randint(1, args.players), rng.randint(1, 20), rng.randint(0, 2000), rng.randint(0, 5000))
+        for _ in range(args.submissions)]
+
+    db = AsyncConnector(os.path.join(folder, f'bench_{write_behind}.db'), write_behind=write_behind)
+    db.migrate(TABLE)
+    start = time.perf_counter()
+    latencies = await submit(db, gambles, args.concurrency)
+    elapsed = time.perf_counter() - start
+    await db.close()
+    return elapsed, latencies
+
+def report(name: str, elapsed: float, latencies: list[float]):
+
+    latencies = sorted(latencies)
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000
+    print(f'{name:12} {len(latencies) / elapsed:9.0f} gambles/s   p50: {p50:7.2f} ms   p99: {p99:7.2f} ms')
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--submissions', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--players', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        report('per-row', *asyncio.run(run(folder, False, args)))
+        report('write-behind', *asyncio.run(run(folder, True, args)))
+
+if __name__ == '__main__':
+    main()
@@ -1,55 +1,378 @@
 import discord
-from gamble import Gamble
+from gamble import Gamble, VALUATIONS
 import logging
-from connector import Connector
-from gw2_api import API
-from typing import Callable
-from heapq import nlargest, nsmallest
+import asyncio
+from connector import Connector, AsyncConnector
+from cache import ResultCache
+from distribution import HISTOGRAM_BOUNDS
+from ranking import RankIndex
+from maintenance import Maintenance, BACKUP_KEEP
+from perf import METRICS, STARTUP
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from gw2_api import API, ItemType, PriceHistory, PriceUnavailableError
+from typing import Awaitable, Callable, NamedTuple, TypeVar
+
+T = TypeVar('T')
 
 DATA_TABLE = 'data'
 GOLD_ICON = '<:gold:1284129171022286848>'
 ECTO_ICON = '<:ecto:1284129080731635754>'
 RUNE_ICON = '<:r_o_h:1284131395492646985>'
+RESULT_CACHE_SIZE = 32
+LEADERBOARD_SIZE = 5
+# Each warmed guild fills three cache entries: both leaderboards and the total stats
+WARM_UP_GUILDS = RESULT_CACHE_SIZE // 3
+WINDOWS = ['all time', 'this week', 'this month', 'custom']
+# Rank indexes hold every player of their guild, so only the most recently used few are kept
+RANK_INDEX_GUILDS = 8
+RANK_NEIGHBOURS = 2
+# Seconds without clicks after which the buttons of a leaderboard stop working
+LEADERBOARD_TIMEOUT = 300
+# Most leaderboards whose buttons work at once. Older ones expire early past this.
+LEADERBOARD_VIEWS = 200
+# Minutes between two log lines reporting the hit rates of the caches
+CACHE_REPORT_MINUTES = 15
+
+class TimeWindow(NamedTuple):
+    '''A span of unix time that stats and leaderboards can be limited to. Missing bounds leave it open.'''
+
+    start: float | None
+    end: float | None
+    label: str
+
+    def title(self, title: str) -> str:
+        '''Appends the label of the window to `title`, unless the window covers all time.'''
+
+        if self.start is None and self.end is None:
+            return title
+        return f"{title} ({self.label})"
+
+ALL_TIME = TimeWindow(None, None, 'all time')
+
+class LeaderboardPage(NamedTuple):
+    '''
+    A page of both leaderboards of a guild, ranking players by total and by
+    average value, with the rows on its edges that the pages before and
+    after it are sought from.
+    '''
+
+    embed: discord.Embed | None
+    # Prices in gold of ectos and runes, which every page of a leaderboard must share
+    prices: tuple[float, float]
+    # Position of the first row, starting at 1
+    position: int
+    # First and last rows by total and by average, or None for an empty page
+    first: tuple[Gamble, Gamble] | None
+    last: tuple[Gamble, Gamble] | None
+    has_previous: bool
+    has_next: bool
+
+class GambaBot(discord.AutoShardedBot):
+    '''
+    The Gamba-Bot client. Runs over as many shards as Discord recommends,
+    or over the `shard_ids` out of `shard_count` given, so that several
+    processes can share the load against the same database.
+    Gambles, leaderboards and totals are kept separately for each guild.
+    '''
+
+    def __init__(self,
+            write_behind: bool = False,
+            dbfile: str = 'gambadata.db',
+            api: API | None = None,
+            metrics_file: str | None = None,
+            maintenance_hours: float = 0,
+            backup_dir: str | None = None,
+            backup_keep: int = BACKUP_KEEP,
+            archive_days: float = 0,
+            **kwargs):
+        '''
+        Creates the bot.
+        - `write_behind` - if true, submitted gambles are committed to the database in groups.
+        - `dbfile` - sqlite database holding the gambles.
+        - `api` - link to the GW2 API. Defaults to one backed by the local price history.
+        - `metrics_file` - if given, performance metrics are periodically written
+        to this file in the Prometheus text format.
+        - `maintenance_hours` - if given, the database is maintained once per this many hours, see `Maintenance`.
+        - `backup_dir` - folder the maintenance writes backups to. Leave empty to take no backups.
+        - `backup_keep` - number of backups kept. 0 keeps them all.
+        - `archive_days` - age in days past which the maintenance archives gambles. 0 never archives them.
+        '''
 
-class GambaBot(discord.Bot):
-
-    def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self._prepare_logger()
-        self._dbconn = Connector()
-        self._api = API()
-        if not self._dbconn.check_table_exists(DATA_TABLE):
-            self._dbconn.create_table(DATA_TABLE)
+        STARTUP.mark('client')
+        self._api = api if api is not None else API(history=PriceHistory())
+        self._dbconn = AsyncConnector(dbfile, write_behind=write_behind, history=getattr(self._api, 'history', None))
+        self._price_poller: asyncio.Task | None = None
+        self._dbconn.migrate(DATA_TABLE)
+        STARTUP.mark('database')
+        self._results = ResultCache(RESULT_CACHE_SIZE)
+        self._ranks = ResultCache(RANK_INDEX_GUILDS)
+        self._leaderboard_views: OrderedDict['LeaderboardView', None] = OrderedDict()
+        self._expiring: set[asyncio.Task] = set()
+        self._metrics_file = metrics_file
+        self._metrics_exporter: asyncio.Task | None = None
+        self._maintenance = Maintenance(self._dbconn, DATA_TABLE, maintenance_hours, backup_dir, backup_keep,
+            archive_days, self._logger) if maintenance_hours else None
+        self._maintainer: asyncio.Task | None = None
+        self._cache_reporter: asyncio.Task | None = None
+        self._command_starts: dict[int, float] = {}
+        self.before_invoke(self._start_command_timer)
+        self.after_invoke(self._stop_command_timer)
+
+    async def on_ready(self):
+        '''
+        Starts polling item prices in the background and warms the caches up,
+        once per process, then logs how long each phase of the startup took.
+        '''
+
+        if self._price_poller is None:
+            STARTUP.mark('gateway')
+            self._price_poller = asyncio.create_task(self._api.poll())
+            self._cache_reporter = asyncio.create_task(self.report_cache_hits())
+            await self.warm_up()
+            STARTUP.mark('warm-up')
+            if self._maintenance is not None:
+                self._maintainer = asyncio.create_task(self._maintenance.run_periodically())
+            self._logger.info(f"Started in {STARTUP.total:.2f} s:\n{STARTUP.report()}")
+        if self._metrics_file is not None and self._metrics_exporter is None:
+            self._metrics_exporter = asyncio.create_task(METRICS.export_periodically(self._metrics_file))
+
+    async def warm_up(self):
+        '''
+        Fetches every item price and builds the leaderboards and total stats of the
+        most active guilds of this process, all concurrently, so that the first
+        commands after a restart find warm caches. Failures are only logged.
+        '''
+
+        own = {guild.id for guild in self.guilds}
+        _, guilds = await asyncio.gather(
+            self._api.refresh(),
+            self._dbconn.read(Connector.guilds, DATA_TABLE),
+            return_exceptions=True)
+        if isinstance(guilds, BaseException):
+            self._logger.error('Could not list guilds to warm up', exc_info=guilds)
+            return
+
+        active = [guild for guild in guilds if guild in own][:WARM_UP_GUILDS]
+        results = await asyncio.gather(*(job for guild in active for job in (
+            self.create_leaderboard(LEADERBOARD_SIZE, True, guild),
+            self.create_leaderboard(LEADERBOARD_SIZE, False, guild),
+            self.get_total_stats(guild))), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                self._logger.error('Could not warm up the result cache', exc_info=result)
+
+    async def report_cache_hits(self, interval: float = CACHE_REPORT_MINUTES * 60):
+        '''
+        Logs the hit rates of the valuation, result and rank index caches over
+        every `interval` seconds, forever. Intervals without lookups are skipped.
+        '''
 
-    def handle_gamble(self, author: discord.user.User, *values: tuple[int]) -> Gamble:
+        caches = {'valuations': VALUATIONS, 'results': self._results, 'rank indexes': self._ranks}
+        previous = {name: (0, 0) for name in caches}
+        while True:
+            await asyncio.sleep(interval)
+            rates = []
+            for name, cache in caches.items():
+                hits, misses = cache.hits - previous[name][0], cache.misses - previous[name][1]
+                previous[name] = (cache.hits, cache.misses)
+                if hits + misses:
+                    rates.append(f"{name} {hits / (hits + misses):.1%} of {hits + misses}")
+            if rates:
+                self._logger.info(f"Cache hit rates over the last {interval / 60:g} min: {', '.join(rates)}")
+
+    async def on_application_command_error(self, ctx: discord.ApplicationContext, error: discord.DiscordException):
+        '''Tells the user when a command failed because item prices are unknown, and reports any other error as usual.'''
+
+        if isinstance(getattr(error, 'original', error), PriceUnavailableError):
+            await ctx.respond("Item prices can't be fetched from the GW2 API right now. Please try again later.",
+                ephemeral=True)
+            return
+        await super().on_application_command_error(ctx, error)
+
+    async def close(self):
+        '''Closes the connection to Discord, the GW2 API connection pool and the database.'''
+
+        if self._price_poller is not None:
+            self._price_poller.cancel()
+        if self._metrics_exporter is not None:
+            self._metrics_exporter.cancel()
+        if self._cache_reporter is not None:
+            self._cache_reporter.cancel()
+        if self._maintainer is not None:
+            self._maintainer.cancel()
+        await self._api.close()
+        await super().close()
+        await self._dbconn.close()
+
+    async def handle_gamble(self, author: discord.user.User, *values: tuple[int], guild: int | None = None) -> Gamble:
         '''Saves a gamble to the local database, and returns an appropriate message.'''
 
-        g = Gamble(author.id, *values)
-        self._dbconn.save_gamble(DATA_TABLE, g)
+        g = Gamble(author.id, *values, guild=guild_key(guild))
+        ranks = self._ranks.peek(g.guild)
+        await self._dbconn.save_gamble(DATA_TABLE, g)
+        await self._update_rank(g.guild, author.id, ranks)
         return g
     
-    def get_user_stats(self, author: discord.user.User) -> Gamble:
-        '''Gets overall statistics for a user.'''
-
-        g = self._dbconn.user_totals(DATA_TABLE, author.id)[0]
+    async def get_user_stats(self,
+            author: discord.user.User,
+            guild: int | None = None,
+            window: TimeWindow = ALL_TIME) -> Gamble:
+        '''Gets overall statistics for a user in a guild, over the gambles within `window`.'''
+
+        g = (await self._dbconn.read(Connector.user_totals, DATA_TABLE, author.id, guild_key(guild),
+            window.start, window.end))[0]
         return g
+
+    async def get_recent_gambles(self, author: discord.user.User, n: int, guild: int | None = None) -> list[Gamble]:
+        '''Gets the `n` most recent gambles by a user in a guild.'''
+
+        return await self._dbconn.read(Connector.recent_by_user, DATA_TABLE, author.id, n, guild_key(guild))
     
-    def delete_gamble(self, author: discord.user.User) -> None:
-        '''Deletes the last gamble by an user.'''
+    async def create_distribution_embed(self, author: discord.user.User, guild: int | None = None) -> discord.Embed | None:
+        '''
+        Returns an Embed describing the distribution of the net value per hand
+        of a user's sessions in a guild, or None if they have no valued sessions.
+        '''
+
+        d = await self._dbconn.read(Connector.player_distribution, DATA_TABLE, author.id, guild_key(guild))
+        if d is None:
+            return None
+
+        description = (f"<@{author.id}>'s **{d.sessions}** session{'s' if d.sessions != 1 else ''}, "
+            "each valued per hand at the prices of its time.")
+        embed = discord.Embed(title="Distribution", description=description)
+        embed.add_field(name="Per hand:",
+            value=f"Mean {d.mean:.2f} {GOLD_ICON}\nStd. dev. {d.stdev:.2f} {GOLD_ICON}",
+            inline=True)
+        embed.add_field(name="Sessions:",
+            value=f"Best {d.maximum:.2f} {GOLD_ICON}\nWorst {d.minimum:.2f} {GOLD_ICON}",
+            inline=True)
+        if d.streak == 0:
+            current = "none"
+        elif d.streak > 0:
+            current = f"{d.streak} win{'s' if d.streak > 1 else ''}"
+        else:
+            current = f"{-d.streak} loss{'es' if d.streak < -1 else ''}"
+        embed.add_field(name="Streaks:",
+            value=f"Current: {current}\nLongest: {d.best_streak} wins, {d.worst_streak} losses",
+            inline=True)
+        embed.add_field(name="Percentiles:",
+            value=' · '.join(f"p{int(q * 100)} ≤ {d.percentile(q):.0f}" for q in (0.1, 0.25, 0.5, 0.75, 0.9)),
+            inline=False)
+
+        # One bar per bucket, scaled to the fullest one
+        labels = [f"≤ {bound}" for bound in HISTOGRAM_BOUNDS] + [f"> {HISTOGRAM_BOUNDS[-1]}"]
+        peak = max(d.counts)
+        rows = [f"{label:>6} {'█' * round(20 * count / peak):20} {count}"
+            for label, count in zip(labels, d.counts)]
+        embed.add_field(name="Net value per hand, in gold:",
+            value="```" + '\n'.join(rows) + "```",
+            inline=False)
+        return embed
+
+    async def create_rank_embed(self,
+            author: discord.user.User,
+            guild: int | None = None,
+            by_average: bool = False) -> discord.Embed | None:
+        '''
+        Returns an Embed with a user's place among the players of a guild, by
+        total net value or by net value per hand, along with the players
+        ranked right above and below them. Returns None if they have no gambles.
+        '''
+
+        index = await self.get_rank_index(guild_key(guild))
+        position = index.position(author.id, by_average)
+        if position is None:
+            return None
+
+        players = len(index)
+        # Share of the other players ranked below, so that the top player is at 100%
+        percentile = 100 * (players - position) / (players - 1) if players > 1 else 100
+        kind = "on average" if by_average else "in total"
+        description = (f"<@{author.id}> is **#{position}** of {players} player{'s' if players != 1 else ''} "
+            f"by value {kind}, ahead of {percentile:.0f}% of the server, {self._prices_note()}.")
+        embed = discord.Embed(title="Rank", description=description)
+
+        rows = []
+        for place, player, value in index.around(position, by_average, RANK_NEIGHBOURS):
+            row = f"#{place} <@{player}> {'won' if value > 0 else 'lost'} **{abs(value)}** {GOLD_ICON} {kind}."
+            rows.append(f"__{row}__" if player == author.id else row)
+        embed.add_field(name="Nearby players:", value='\n'.join(rows), inline=False)
+        return embed
+
+    async def get_rank_index(self, guild: int) -> RankIndex:
+        '''
+        Gets the rank index of a guild at current prices, building it from the
+        players' totals if the guild's data or the prices changed since.
+        '''
+
+        generation = await self._dbconn.read(Connector.guild_generation, DATA_TABLE, guild)
+        return await self._ranks.get(guild, (generation, self._api.epoch), lambda: self._build_rank_index(guild))
+
+    @METRICS.timed('embed_seconds', embed='rank_index')
+    async def _build_rank_index(self, guild: int) -> RankIndex:
+
+        ecto_value = await self._api.get_item_value_async(ItemType.ectoplasm)
+        rune_value = await self._api.get_item_value_async(ItemType.rune)
+        _, totals = await self._dbconn.read(Connector.ranking_snapshot, DATA_TABLE, guild)
+        return await asyncio.to_thread(RankIndex, totals, ecto_value, rune_value)
+
+    async def _update_rank(self, guild: int, player: int, ranks: tuple | None):
+        '''
+        Moves a player within the guild's rank index after one of their gambles
+        was saved or deleted, given the version and index cached before the write.
+        The index is only updated in place if that gamble is the only change
+        since it was built, which the generation tells since it counts gambles
+        rather than transactions: a group commit of several players' gambles
+        leaves the index at its version, to be rebuilt on next use.
+        '''
+
+        if ranks is None:
+            return
+        version, index = ranks
+        generation, epoch = version
+        if epoch != self._api.epoch:
+            return
+
+        current, totals = await self._dbconn.read(Connector.player_snapshot, DATA_TABLE, player, guild)
+        if current == generation + 1 and self._ranks.restamp(guild, version, (current, epoch)):
+            index.update(player, totals)
+
+    async def delete_gamble(self, author: discord.user.User, guild: int | None = None) -> bool:
+        '''Deletes the last gamble by an user in a guild. Returns false if there was none left to delete.'''
 
-        self._dbconn.remove_last_gamble(DATA_TABLE, author.id)
+        guild = guild_key(guild)
+        ranks = self._ranks.peek(guild)
+        removed = await self._dbconn.write(Connector.remove_last_gamble, DATA_TABLE, author.id, guild)
+        if removed:
+            await self._update_rank(guild, author.id, ranks)
+        return removed
     
-    def get_total_stats(self) -> discord.Embed:
-        '''Gets overall statistics for all users.'''
+    async def get_total_stats(self, guild: int | None = None, window: TimeWindow = ALL_TIME) -> discord.Embed:
+        '''Gets overall statistics for all users in a guild, over the gambles within `window`.'''
 
-        g = self._dbconn.bot_totals(DATA_TABLE)[0]
+        guild = guild_key(guild)
+        embed = await self._cached(('total', guild, window), guild, lambda: self._create_total_stats(guild, window))
+        return embed.copy()
+
+    async def _create_total_stats(self, guild: int, window: TimeWindow = ALL_TIME) -> discord.Embed:
+
+        g = (await self._dbconn.read(Connector.bot_totals, DATA_TABLE, guild, window.start, window.end))[0]
+        if not g.hands:
+            return discord.Embed(title=window.title("Total Stats"),
+                description="Gamba-Bot hasn't registered any gambles in this server yet.")
         g.user = 0
-        embed = self.create_gamble_embed(g, is_summary=True)
-        embed.title = "Total Stats"
-        embed.description = f"Gamba-Bot has registered a total of {g.hands} gambles."
+        embed = await self.create_gamble_embed(g, is_summary=True)
+        embed.title = window.title("Total Stats")
+        embed.description = f"Gamba-Bot has registered a total of {g.hands} gambles in this server."
         return embed
 
-    def create_gamble_embed(self,
+    @METRICS.timed('embed_seconds', embed='gamble')
+    async def create_gamble_embed(self,
             g: Gamble,
             image_url: str | None = None,
             is_summary: bool = False) -> discord.Embed:
@@ -83,9 +406,9 @@ class GambaBot(discord.Bot):
             value=msg,
             inline=True)
         
-        total, average = g.get_value(self._api)
+        total, average = await g.get_value_async(self._api)
         state = 'gain' if total >= 0 else 'loss'
-        msg = f"\nFor a total **{state}** of **{round(abs(total), 2)}** {GOLD_ICON}, or {round(abs(average), 2)} {GOLD_ICON} on average, at current prices."
+        msg = f"\nFor a total **{state}** of **{round(abs(total), 2)}** {GOLD_ICON}, or {round(abs(average), 2)} {GOLD_ICON} on average, {self._prices_note()}."
         embed.add_field(name='',
             value=msg,
             inline=False)
@@ -95,52 +418,209 @@ class GambaBot(discord.Bot):
 
         return embed
     
-    def create_leaderboard(self, n = 10, winners: bool = False) -> discord.Embed:
+    async def create_leaderboard(self,
+            n = 10,
+            winners: bool = False,
+            guild: int | None = None,
+            window: TimeWindow = ALL_TIME) -> discord.Embed:
         '''
         Returns an Embed containing leaderboards for gambling stats.
         - `n` - number of positions on the leaderboard.
         - `winners` - if true, shows the top wins. Otherwise shows the top losses.
+        - `guild` - id of the guild whose players are ranked.
+        - `window` - span of time whose gambles are counted.
         '''
 
-        users = self._dbconn.all_user_totals(DATA_TABLE)
-        title = f"{'Winners' if winners else 'Losers'} Leaderboard"
-        embed = discord.Embed(title=title)
+        return (await self.leaderboard_page(n, winners, guild, window)).embed
 
-        n = min(n, len(users))
-        fun = nlargest if winners else nsmallest
-        top_total   = fun(n, users, key=lambda x: x.get_value(self._api)[0])
-        top_average = fun(n, users, key=lambda x: x.get_value(self._api)[1])
+    async def leaderboard_page(self,
+            n: int = 10,
+            winners: bool = False,
+            guild: int | None = None,
+            window: TimeWindow = ALL_TIME,
+            previous: LeaderboardPage | None = None,
+            forward: bool = True) -> LeaderboardPage:
+        '''
+        Gets a page of `n` positions of the leaderboards, as in `create_leaderboard`.
+        Without `previous`, gets the first page at current prices, from the result
+        cache. Otherwise gets the page after `previous`, or before it if `forward`
+        is false, sought from its edges at the same prices.
+        '''
+
+        guild = guild_key(guild)
+        # A page emptied by deleted gambles has no edges to seek from, so it leads back to the first page
+        if previous is None or previous.first is None:
+            page = await self._cached(('leaderboard', n, winners, guild, window), guild,
+                lambda: self._create_leaderboard(n, winners, guild, window))
+            return page._replace(embed=page.embed.copy())
+        return await self._create_leaderboard(n, winners, guild, window, previous, forward)
+
+    @METRICS.timed('embed_seconds', embed='leaderboard')
+    async def _create_leaderboard(self,
+            n: int,
+            winners: bool,
+            guild: int = 0,
+            window: TimeWindow = ALL_TIME,
+            previous: LeaderboardPage | None = None,
+            forward: bool = True) -> LeaderboardPage:
+
+        if previous is None:
+            prices = (await self._api.get_item_value_async(ItemType.ectoplasm),
+                await self._api.get_item_value_async(ItemType.rune))
+            after = before = (None, None)
+        else:
+            prices = previous.prices
+            after = previous.last if forward else (None, None)
+            before = previous.first if not forward else (None, None)
+        ecto_value, rune_value = prices
+
+        # One extra row tells whether there is another page in the direction read
+        bounds = {'guild': guild, 'start': window.start, 'end': window.end}
+        top_total, top_average = await asyncio.gather(
+            self._dbconn.read(Connector.leaderboard, DATA_TABLE, ecto_value, rune_value, n + 1, winners,
+                after=after[0], before=before[0], **bounds),
+            self._dbconn.read(Connector.leaderboard, DATA_TABLE, ecto_value, rune_value, n + 1, winners,
+                by_average=True, after=after[1], before=before[1], **bounds))
+        if previous is not None and not forward:
+            has_previous, has_next = len(top_total) > n, True
+            top_total, top_average = top_total[-n:], top_average[-n:]
+            position = previous.position - len(top_total) if has_previous else 1
+        else:
+            has_previous, has_next = previous is not None, len(top_total) > n
+            top_total, top_average = top_total[:n], top_average[:n]
+            position = previous.position + n if previous is not None else 1
+        values = {gamble: gamble.value_at(ecto_value, rune_value) for gamble in top_total + top_average}
+
+        title = window.title(f"{'Winners' if winners else 'Losers'} Leaderboard")
+        # Discord rejects fields without a value, so an empty leaderboard only gets a description
+        if not top_total:
+            if previous is None:
+                description = f"Gamba-Bot hasn't registered any gambles in this server ({window.label})."
+            else:
+                description = "No players are left on this page, as gambles were deleted since."
+            return LeaderboardPage(discord.Embed(title=title, description=description), prices, position,
+                None, None, previous is not None, False)
+
+        embed = discord.Embed(title=title)
+        if self._api.stale:
+            embed.description = f"Players are ranked {self._prices_note()}."
 
         def gamble_total_row(gamble: Gamble) -> str:
-            value = gamble._value[0]
+            value = values[gamble][0]
             return f"<@{gamble.user}> {'won' if value > 0 else 'lost'} **{abs(value)}** {GOLD_ICON} total over {gamble.hands} gambles."
 
         def gamble_average_row(gamble: Gamble) -> str:
-            value = gamble._value[1]
+            value = values[gamble][1]
             return f"<@{gamble.user}> {'won' if value > 0 else 'lost'} **{abs(value)}** {GOLD_ICON} on average over {gamble.hands} gambles."
 
         embed = self._add_list_of_gambles(
             embed,
             top_total,
             f"Biggest {'Winners' if winners else 'Losers'}",
-            gamble_total_row
+            gamble_total_row,
+            position
         )
 
         embed = self._add_list_of_gambles(
             embed,
             top_average,
             f"{'Luckiest' if winners else 'Unluckiest'} Gamblers",
-            gamble_average_row
+            gamble_average_row,
+            position
         )
 
+        first = last = None
+        if top_total:
+            first = (top_total[0], top_average[0])
+            last = (top_total[-1], top_average[-1])
+        return LeaderboardPage(embed, prices, position, first, last, has_previous, has_next)
+
+    def track_leaderboard_view(self, view: 'LeaderboardView'):
+        '''Keeps count of a leaderboard with buttons, expiring the oldest ones past `LEADERBOARD_VIEWS`.'''
+
+        self._leaderboard_views[view] = None
+        while len(self._leaderboard_views) > LEADERBOARD_VIEWS:
+            oldest, _ = self._leaderboard_views.popitem(last=False)
+            task = asyncio.create_task(oldest.expire())
+            self._expiring.add(task)
+            task.add_done_callback(self._expiring.discard)
+
+    def forget_leaderboard_view(self, view: 'LeaderboardView'):
+
+        self._leaderboard_views.pop(view, None)
+
+    async def _cached(self, key: tuple, guild: int, create: Callable[[], Awaitable[T]]) -> T:
+        '''
+        Gets a result from the result cache, creating it with `create` if the
+        guild's data or the item prices have changed since it was last built.
+        Cached results are shared, so callers must copy embeds before changing them.
+        '''
+
+        # The generation is read from the database, so writes by other shard processes count too
+        generation = await self._dbconn.read(Connector.guild_generation, DATA_TABLE, guild)
+        # Prices are never refreshed here: expired ones are refreshed in the background,
+        # bumping the epoch, and embeds built from stale prices say so
+        version = (generation, self._api.epoch, self._api.stale)
+        return await self._results.get(key, version, create)
+
+    def _prices_note(self) -> str:
+        '''Describes the prices values are computed at, warning when they couldn't be refreshed for a while.'''
+
+        if self._api.stale:
+            return f"at prices from <t:{int(self._api.updated_at)}:R>, as the GW2 API can't be reached"
+        return "at current prices"
+
+    def create_perf_embed(self) -> discord.Embed:
+        '''Returns an Embed summarizing the latency histograms and counters recorded since startup.'''
+
+        embed = discord.Embed(title="Performance",
+            description=f"Since <t:{int(METRICS.started)}:R>. Percentiles are bucket upper bounds.")
+
+        histograms, counters = METRICS.snapshot()
+        groups: dict[str, list[str]] = {}
+        for (name, labels), histogram in sorted(histograms.items()):
+            label = ' '.join(value for _, value in labels) or name
+            p50, p95, p99 = (histogram.percentile(q) * 1000 for q in (0.5, 0.95, 0.99))
+            groups.setdefault(name, []).append(
+                f"{label[:24]:24} {histogram.count:>6} {p50:>7g} {p95:>7g} {p99:>7g}")
+
+        for name, rows in groups.items():
+            header = f"{'':24} {'count':>6} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7}"
+            # Field values are limited to 1024 characters
+            value = '\n'.join([header] + rows)[:1000]
+            embed.add_field(name=name, value=f"```{value}```", inline=False)
+
+        rows = [f"{name} {' '.join(v for _, v in labels)}: {value}"
+            for (name, labels), value in sorted(counters.items())]
+        if rows:
+            embed.add_field(name="counters", value='\n'.join(rows)[:1024], inline=False)
+
+        if STARTUP.phases:
+            embed.add_field(name="startup", value=f"```{STARTUP.report()}```", inline=False)
+
         return embed
 
-    def _add_list_of_gambles(self, embed: discord.Embed, gambles: list[Gamble], name: str, func: Callable[[Gamble], str]):
-        '''Creates a list of gambles in an embed. The string representing each gamble will be generated
+    async def _start_command_timer(self, ctx: discord.ApplicationContext):
+
+        self._command_starts[ctx.interaction.id] = time.perf_counter()
+
+    async def _stop_command_timer(self, ctx: discord.ApplicationContext):
+
+        start = self._command_starts.pop(ctx.interaction.id, None)
+        if start is not None:
+            METRICS.observe('command_seconds', time.perf_counter() - start, command=ctx.command.qualified_name)
+
+    def _add_list_of_gambles(self,
+            embed: discord.Embed,
+            gambles: list[Gamble],
+            name: str,
+            func: Callable[[Gamble], str],
+            start: int = 1):
+        '''Creates a list of gambles in an embed, numbered from `start`. The string representing each gamble will be generated
         using the `func` function passed'''
 
         rows: list[str] = []
-        i = 0
+        i = start - 1
         for gamble in gambles:
             i += 1
             row = f"{i}. {func(gamble)}"
@@ -155,14 +635,50 @@ class GambaBot(discord.Bot):
         return embed
 
     def _prepare_logger(self):
-        '''Prepares a logger for the bot.'''
-
-        logger = logging.getLogger('discord')
-        logger.setLevel(logging.DEBUG)
-        handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
-        handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-        logger.addHandler(handler)
-        self._logger = logger
+        '''Gets the bot's logger. Where its records go is set up once per process, by `logs.configure_logging`.'''
+
+        self._logger = logging.getLogger('discord')
+
+def parse_window(window: str, start: str | None = None, end: str | None = None, now: float | None = None) -> TimeWindow:
+    '''
+    Gets the span of time chosen in a command. Weeks start on monday, and
+    days at midnight UTC, matching the daily rollups of the database.
+    - `window` - one of `WINDOWS`.
+    - `start` - first day of a custom window, as YYYY-MM-DD.
+    - `end` - last day of a custom window, as YYYY-MM-DD, included. Defaults to today.
+
+    Raises a ValueError with a message for the user if the window isn't valid.
+    '''
+
+    today = datetime.fromtimestamp(now if now is not None else time.time(), timezone.utc).replace(
+        hour=0, minute=0, second=0, microsecond=0)
+
+    if window == 'all time':
+        return ALL_TIME
+    if window == 'this week':
+        return TimeWindow((today - timedelta(days=today.weekday())).timestamp(), None, window)
+    if window == 'this month':
+        return TimeWindow(today.replace(day=1).timestamp(), None, window)
+    if window != 'custom':
+        raise ValueError(f"Unknown time window '{window}'.")
+
+    if start is None:
+        raise ValueError("A custom time window needs a start date.")
+    try:
+        first = datetime.strptime(start, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+        last = datetime.strptime(end, '%Y-%m-%d').replace(tzinfo=timezone.utc) if end is not None else today
+    except ValueError:
+        raise ValueError("Dates must be written as YYYY-MM-DD.")
+    if last < first:
+        raise ValueError("The start date must not be after the end date.")
+
+    label = f"{first:%Y-%m-%d} to {last:%Y-%m-%d}"
+    return TimeWindow(first.timestamp(), (last + timedelta(days=1)).timestamp(), label)
+
+def guild_key(guild: int | None) -> int:
+    '''Gets the guild id gambles are stored under. Gambles recorded outside of a guild are stored under 0.'''
+
+    return guild if guild is not None else 0
 
 class GambaModal(discord.ui.Modal):
     '''Modal for the form that users input their results into.'''
@@ -199,25 +715,86 @@ class GambaModal(discord.ui.Modal):
         '''
         Returns a tuple containing the hands, gold, ectos and runes submitted via
         the modal. If any of the submitted values is not convertable to an integer,
-        then retruns None.'''
+        or is negative, or if no hand was played, then retruns None.'''
 
         try:
             hands = int(self.children[0].value)
             gold = int(self.children[1].value)
             ectos = int(self.children[2].value)
             runes = int(self.children[3].value)
-
-            return hands, gold, ectos, runes
         except ValueError:
             return None
+        # The same bounds as imported gambles, since a session is valued per hand
+        if hands < 1 or min(gold, ectos, runes) < 0:
+            return None
+        return hands, gold, ectos, runes
 
+    @METRICS.timed('command_seconds', command='gamba record (submit)')
     async def callback(self, interaction: discord.Interaction):
         '''This function is called when the form is submitted.'''
 
         values = self.values
         if values is None:
-            await interaction.response.send_message("Invalid content. Fields must be integers.")
+            await interaction.response.send_message(
+                "Invalid content. Fields must be whole numbers, none of them negative, with at least one hand.")
+            return
+        g = await self.bot.handle_gamble(interaction.user, *values, guild=interaction.guild_id)
+        try:
+            embed = await self.bot.create_gamble_embed(g, image_url=self.img_url)
+        except PriceUnavailableError:
+            await interaction.response.send_message(
+                "Your gamble was recorded, but item prices can't be fetched from the GW2 API right now.")
             return
-        g = self.bot.handle_gamble(interaction.user, *self.values)
-        embed = self.bot.create_gamble_embed(g, image_url=self.img_url)
         await interaction.response.send_message(embed=embed)
+
+class LeaderboardView(discord.ui.View):
+    '''
+    Previous and next buttons under a leaderboard. Only the shown page's
+    edges are kept, and each page is only fetched when its button is
+    clicked. The buttons are disabled after `LEADERBOARD_TIMEOUT` seconds
+    without clicks, or earlier once `LEADERBOARD_VIEWS` newer leaderboards were sent.
+    '''
+
+    def __init__(self, bot: GambaBot, page: LeaderboardPage, n: int, winners: bool, guild: int | None, window: TimeWindow):
+        '''Creates the buttons of a leaderboard whose first shown page is `page`.'''
+
+        super().__init__(timeout=LEADERBOARD_TIMEOUT, disable_on_timeout=True)
+        self.bot = bot
+        self._query = (n, winners, guild, window)
+        self._show(page)
+        bot.track_leaderboard_view(self)
+
+    @discord.ui.button(label="Previous", emoji="◀️")
+    async def previous(self, button: discord.ui.Button, interaction: discord.Interaction):
+
+        await self._turn(interaction, forward=False)
+
+    @discord.ui.button(label="Next", emoji="▶️")
+    async def next(self, button: discord.ui.Button, interaction: discord.Interaction):
+
+        await self._turn(interaction, forward=True)
+
+    async def expire(self):
+        '''Stops listening to clicks and disables the buttons, as if the view timed out.'''
+
+        self.stop()
+        await super().on_timeout()
+
+    async def on_timeout(self):
+
+        self.bot.forget_leaderboard_view(self)
+        await super().on_timeout()
+
+    @METRICS.timed('command_seconds', command='gamba leaderboard (page)')
+    async def _turn(self, interaction: discord.Interaction, forward: bool):
+
+        page = await self.bot.leaderboard_page(*self._query, previous=self._page, forward=forward)
+        self._show(page)
+        await interaction.response.edit_message(embed=page.embed, view=self)
+
+    def _show(self, page: LeaderboardPage):
+        '''Remembers the edges of the shown page, without its embed, and enables the buttons that lead somewhere.'''
+
+        self._page = page._replace(embed=None)
+        self.previous.disabled = not page.has_previous
+        self.next.disabled = not page.has_next
@@ -0,0 +1,88 @@
+'''
+Small caching helpers for results that are expensive to compute and
+only change when the underlying data does.
+'''
+
+import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+T = TypeVar('T')
+
+class ResultCache:
+    '''
+    Bounded LRU cache for the results of coroutines. Every entry is stored
+    along with a version, and is only served while the caller asks for that
+    same version, so bumping the version invalidates every entry at once.
+    Concurrent requests for the same missing entry share one computation.
+    '''
+
+    def __init__(self, maxsize: int = 32):
+        '''
+        Creates a new cache.
+        - `maxsize` - number of entries kept before evicting the least recently used one.
+        '''
+
+        self._maxsize = maxsize
+        self._entries: OrderedDict[Hashable, tuple[Hashable, object]] = OrderedDict()
+        self._pending: dict[tuple[Hashable, Hashable], asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: Hashable, version: Hashable, compute: Callable[[], Awaitable[T]]) -> T:
+        '''
+        Gets the entry for `key` at `version`, awaiting `compute()` to build
+        it if it's missing or was stored for another version.
+        '''
+
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        task = self._pending.get((key, version))
+        if task is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(compute())
+            self._pending[(key, version)] = task
+            task.add_done_callback(lambda t: self._store(key, version, t))
+        # Shielded so that a cancelled caller doesn't cancel the computation for the others
+        return await asyncio.shield(task)
+
+    def peek(self, key: Hashable) -> tuple[Hashable, object] | None:
+        '''Gets the version and value stored for `key`, or None, without counting a hit or refreshing its recency.'''
+
+        return self._entries.get(key)
+
+    def restamp(self, key: Hashable, version: Hashable, new_version: Hashable) -> bool:
+        '''
+        Moves the entry for `key` from `version` to `new_version`, for values
+        updated in place to match the new version. Returns false, leaving the
+        cache untouched, if the entry isn't stored at `version` anymore.
+        '''
+
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != version:
+            return False
+        self._entries[key] = (new_version, entry[1])
+        return True
+
+    def clear(self):
+        '''Removes every stored entry.'''
+
+        self._entries.clear()
+
+    def _store(self, key: Hashable, version: Hashable, task: asyncio.Task):
+        '''Stores the result of a finished computation, evicting old entries as needed.'''
+
+        self._pending.pop((key, version), None)
+        if task.cancelled() or task.exception() is not None:
+            return
+
+        self._entries[key] = (version, task.result())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
@@ -1,19 +1,61 @@
 import sqlite3
 import os
-from gamble import Gamble
-from functools import wraps
+import math
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, TypeVar
+from gamble import Gamble, GambleBatch
+from distribution import Distribution
+from gw2_api import ItemType, PriceHistory
+from perf import METRICS
+from functools import wraps, partial
+from contextlib import contextmanager
+
+SCHEMA_VERSION = 5
+STATEMENT_CACHE_SIZE = 256
+FETCH_SIZE = 4096
+READ_POOL_SIZE = 4
+DAY_SECONDS = 86400
+FLUSH_INTERVAL = 0.005
+FLUSH_ROWS = 64
+# Raw gambles archived per transaction, so that writes queued meanwhile only wait for a short one
+ARCHIVE_CHUNK = 2048
+# Pages copied per step of an online backup, and seconds waited between steps
+BACKUP_PAGES = 256
+BACKUP_PAUSE = 0.005
+# Times a backup starts over because of other writers before it finishes in a single step
+BACKUP_RESTARTS = 3
+# Free pages released per step of an incremental vacuum
+VACUUM_PAGES = 512
+# Rows of each index sampled by ANALYZE, which keeps it quick however big the tables
+ANALYSIS_LIMIT = 1000
+# Value of PRAGMA auto_vacuum for databases whose free pages are released on demand
+INCREMENTAL_VACUUM = 2
+
+T = TypeVar('T')
+
+class _BackupRestarted(Exception):
+    '''Raised to stop a stepped backup that keeps starting over.'''
 
 def simple_query(f):
     '''
     Decorator for simple functions consisting in a single
     query that doesn't need to return results.
+    The function may return the query alone, or a tuple
+    with the query and the parameters to bind to it.
     '''
     @wraps(f)
-    def wrapper(*args):
+    def wrapper(*args, **kwargs):
         conn = args[0]
         assert isinstance(conn, Connector)
-        query = f(*args)
-        conn._run_query(query, False)
+        query = f(*args, **kwargs)
+        params = ()
+        if isinstance(query, tuple):
+            query, params = query
+        conn._run_query(query, False, params=params, name=f.__name__)
     
     return wrapper
 
@@ -24,14 +66,19 @@ def gamble_query(f):
     required data to build a Gamble object.
     This decorator will then build the object for each row
     and return all results as a list.
+    The function may return the query alone, or a tuple
+    with the query and the parameters to bind to it.
     '''
     @wraps(f)
-    def wrapper(*args):
+    def wrapper(*args, **kwargs):
         conn = args[0]
         assert isinstance(conn, Connector)
-        query = f(*args)
+        query = f(*args, **kwargs)
+        params = ()
+        if isinstance(query, tuple):
+            query, params = query
         gambles = []
-        rows = conn._run_query(query)
+        rows = conn._run_query(query, params=params, name=f.__name__)
         for row in rows:
             gambles.append(Gamble(*row))
 
@@ -39,112 +86,1533 @@ def gamble_query(f):
     
     return wrapper
 
+def batch_query(f):
+    '''
+    Decorator for bulk queries, which builds a single `GambleBatch`
+    from the resulting rows instead of one Gamble object per row.
+    Rows are fetched in chunks, so they are never all held as tuples at once.
+    The function may return the query alone, or a tuple
+    with the query and the parameters to bind to it.
+    '''
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        conn = args[0]
+        assert isinstance(conn, Connector)
+        query = f(*args, **kwargs)
+        params = ()
+        if isinstance(query, tuple):
+            query, params = query
+        batch = GambleBatch()
+        with METRICS.timer('query_seconds', query=f.__name__):
+            cursor = conn._connection.execute(query, params)
+            while rows := cursor.fetchmany(FETCH_SIZE):
+                batch.extend(rows)
+            cursor.close()
+
+        return batch
+
+    return wrapper
+
 class Connector:
     '''
     Interface for the gambling sqlite database, which specifies
     several default queries and convenience functions.
     '''
 
-    def __init__(self, dbfile: str = 'gambadata.db'):
+    def __init__(self, dbfile: str = 'gambadata.db', read_only: bool = False, history: PriceHistory | None = None):
         '''
         Creates a new Connector. The connector will automatically use the
         specified `dbfile` sqlite database, creating the file if it
         doesn't already exist.
+        If `read_only` is true, the file must already exist and any write will fail.
+        `history` values sessions at the prices of their time for the players'
+        distribution statistics, which are only kept up to date by connectors given one.
         '''
 
+        self._history = history
+
         filepath = os.path.join(os.path.dirname(__file__), dbfile)
-        self._connection = sqlite3.connect(filepath)
+        if read_only:
+            filepath = Path(filepath).absolute().as_uri() + '?mode=ro'
 
-    @simple_query
+        # A connector may be created and used on different threads, but only by one thread at a time
+        self._connection = sqlite3.connect(filepath,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            uri=read_only,
+            check_same_thread=False)
+
+    @METRICS.timed('query_seconds', query='save_gamble')
     def save_gamble(self, table: str, gamble: Gamble):
-        '''Saves a gamble as a row in the specified table.'''
+        '''
+        Saves a gamble as a row in the specified table, and adds it to the
+        player's running totals within the same transaction.
+        '''
 
-        return f"""
-        INSERT INTO {table} VALUES
-            ({gamble.user}, {gamble.hands}, {gamble.gold}, {gamble.ectos}, {gamble.runes}, {gamble.timestamp})
-        """
-    
-    @simple_query
-    def remove_last_gamble(self, table: str, userid: int):
-        '''Deletes the most recent entry by a user.'''
+        with self._connection:
+            self._insert_gambles(table, [gamble])
 
-        return f'''
-        DELETE FROM {table}
-        WHERE player={userid}
-        ORDER BY timestamp DESC
-        LIMIT 1
+    @METRICS.timed('query_seconds', query='save_gambles')
+    def save_gambles(self, table: str, gambles: list[Gamble]):
         '''
+        Saves several gambles and adds them to their players' running totals,
+        all within a single transaction.
+        '''
+
+        with self._connection:
+            self._insert_gambles(table, gambles)
+
+    @METRICS.timed('query_seconds', query='remove_last_gamble')
+    def remove_last_gamble(self, table: str, userid: int, guild: int = 0) -> bool:
+        '''
+        Deletes the most recent entry by a user in a guild, and subtracts it
+        from the player's running totals within the same transaction. The
+        player's distribution statistics are replayed from their unarchived
+        sessions, see `_recompute_distributions`. Archived gambles can't be deleted. Returns false if no gamble was
+        left to delete, such as once all of the user's gambles are archived.
+        '''
+
+        with self._connection:
+            row = self._connection.execute(f'''
+            SELECT id, gambles, gold, ectos, runes, timestamp
+            FROM {table}
+            WHERE guild = ? AND player = ?
+            ORDER BY timestamp DESC
+            LIMIT 1
+            ''', (guild, userid)).fetchone()
+            if row is None:
+                return False
+
+            rowid, hands, gold, ectos, runes, timestamp = row
+            self._connection.execute(f'DELETE FROM {table} WHERE id = ?', (rowid,))
+            self._connection.execute(f'''
+            UPDATE {self._totals(table)} SET
+                hands = hands - ?,
+                gold = gold - ?,
+                ectos = ectos - ?,
+                runes = runes - ?,
+                last_timestamp = (SELECT MAX(timestamp) FROM (
+                    SELECT MAX(timestamp) AS timestamp FROM {table} WHERE guild = ? AND player = ?
+                    UNION ALL
+                    SELECT MAX(last_timestamp) FROM {self._archive(table)} WHERE guild = ? AND player = ?)),
+                count = count - 1
+            WHERE guild = ? AND player = ?
+            ''', (hands, gold, ectos, runes, guild, userid, guild, userid, guild, userid))
+            self._connection.execute(f'''
+            DELETE FROM {self._totals(table)} WHERE guild = ? AND player = ? AND count <= 0
+            ''', (guild, userid))
+
+            day = int(timestamp // DAY_SECONDS)
+            self._connection.execute(f'''
+            UPDATE {self._daily(table)} SET
+                hands = hands - ?,
+                gold = gold - ?,
+                ectos = ectos - ?,
+                runes = runes - ?,
+                last_timestamp = (SELECT MAX(timestamp) FROM (
+                    SELECT MAX(timestamp) AS timestamp FROM {table}
+                    WHERE guild = ? AND player = ? AND timestamp >= ? AND timestamp < ?
+                    UNION ALL
+                    SELECT last_timestamp FROM {self._archive(table)} WHERE guild = ? AND player = ? AND day = ?)),
+                count = count - 1
+            WHERE guild = ? AND day = ? AND player = ?
+            ''', (hands, gold, ectos, runes,
+                guild, userid, day * DAY_SECONDS, (day + 1) * DAY_SECONDS,
+                guild, userid, day,
+                guild, day, userid))
+            self._connection.execute(f'''
+            DELETE FROM {self._daily(table)} WHERE guild = ? AND day = ? AND player = ? AND count <= 0
+            ''', (guild, day, userid))
+            # Removing a session can't undo the extremes and streaks it set, so the player's unarchived
+            # sessions are replayed instead, which archival keeps to the last ARCHIVE_DAYS
+            self._recompute_distributions(table, [(guild, userid)])
+            self._bump_generations(table, [guild])
+        return True
+
+    @METRICS.timed('query_seconds', query='import_gambles')
+    def import_gambles(self, table: str, gambles: list[Gamble]) -> int:
+        '''
+        Saves a chunk of imported gambles within a single transaction, skipping
+        those already recorded: a gamble is a duplicate of another with the same
+        guild, player and timestamp. Archived gambles are only kept as daily
+        rollups, so any gamble of a day archived for its player counts as a
+        duplicate. Returns the number of gambles saved.
+        '''
+
+        with self._connection:
+            self._connection.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS import_staging(
+                guild INTEGER NOT NULL,
+                player INTEGER NOT NULL,
+                timestamp REAL NOT NULL,
+                gambles INTEGER NOT NULL,
+                gold INTEGER NOT NULL,
+                ectos INTEGER NOT NULL,
+                runes INTEGER NOT NULL,
+                PRIMARY KEY (guild, player, timestamp)) WITHOUT ROWID
+            ''')
+            self._connection.execute('DELETE FROM import_staging')
+            # The primary key drops duplicates within the chunk, the query below those already saved
+            self._connection.executemany('''
+            INSERT OR IGNORE INTO import_staging VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', [(g.guild, g.user, g.timestamp, g.hands, g.gold, g.ectos, g.runes) for g in gambles])
+            rows = self._connection.execute(f'''
+            SELECT s.player, s.gambles, s.gold, s.ectos, s.runes, s.timestamp, s.guild
+            FROM import_staging s
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {table} d
+                WHERE d.guild = s.guild AND d.player = s.player AND d.timestamp = s.timestamp)
+            AND NOT EXISTS (
+                SELECT 1 FROM {self._archive(table)} a
+                WHERE a.guild = s.guild AND a.player = s.player AND a.day = CAST(s.timestamp / {DAY_SECONDS} AS INTEGER))
+            ''').fetchall()
+            if rows:
+                self._insert_gambles(table, [Gamble(*row) for row in rows])
+        return len(rows)
+
+    def iter_gambles(self, table: str, guild: int | None = None) -> Iterator[Gamble]:
+        '''
+        Yields every gamble of a table in the order they were saved, reading
+        them in chunks so that memory stays constant however long the history.
+        If `guild` is given, only yields the gambles recorded in that guild.
+        Archived gambles are only kept as daily rollups, and aren't yielded.
+        '''
+
+        query = f'SELECT player, gambles, gold, ectos, runes, timestamp, guild FROM {table}'
+        params = ()
+        if guild is not None:
+            query += ' WHERE guild = ?'
+            params = (guild,)
+        cursor = self._connection.execute(query + ' ORDER BY id', params)
+        try:
+            while rows := cursor.fetchmany(FETCH_SIZE):
+                for row in rows:
+                    yield Gamble(*row)
+        finally:
+            cursor.close()
+
+    def move_guild(self, table: str, source: int, target: int) -> int:
+        '''
+        Moves every gamble recorded in the `source` guild to the `target` guild,
+        rebuilding the player totals. Returns the number of raw gambles moved.
+        Meant for assigning gambles recorded before guilds were tracked.
+        Raises a ValueError if a player has archived sessions in both guilds,
+        as the statistics of their archived sessions can't be merged.
+        '''
+
+        if source == target:
+            return 0
+        with self._connection:
+            clashes = self._connection.execute(f'''
+                SELECT COUNT(*) FROM {self._archive_stats(table)} s
+                JOIN {self._archive_stats(table)} t ON t.guild = ? AND t.player = s.player
+                WHERE s.guild = ?
+            ''', (target, source)).fetchone()[0]
+            if clashes:
+                raise ValueError(f"{clashes} player(s) have archived sessions in both guilds {source} and {target}.")
+
+            moved = self._connection.execute(f'UPDATE {table} SET guild = ? WHERE guild = ?', (target, source)).rowcount
+            self._connection.execute(f'''
+                INSERT INTO {self._archive(table)}
+                SELECT ?, day, player, hands, gold, ectos, runes, last_timestamp, count
+                FROM {self._archive(table)} WHERE guild = ?
+                ON CONFLICT(guild, player, day) DO UPDATE SET
+                    hands = hands + excluded.hands,
+                    gold = gold + excluded.gold,
+                    ectos = ectos + excluded.ectos,
+                    runes = runes + excluded.runes,
+                    last_timestamp = MAX(last_timestamp, excluded.last_timestamp),
+                    count = count + excluded.count
+            ''', (target, source))
+            self._connection.execute(f'DELETE FROM {self._archive(table)} WHERE guild = ?', (source,))
+            self._connection.execute(f'UPDATE {self._archive_stats(table)} SET guild = ? WHERE guild = ?', (target, source))
+            self._fill_derived_tables(table)
+            self._bump_generations(table, [source, target])
+        return moved
+
+    def guild_generation(self, table: str, guild: int = 0) -> int:
+        '''
+        Gets a counter that increases by one for every gamble saved or deleted
+        in a guild, by any process using the database.
+        '''
+
+        row = self._connection.execute(
+            f'SELECT generation FROM {self._guilds(table)} WHERE guild = ?', (guild,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def ranking_snapshot(self, table: str, guild: int = 0) -> tuple[int, GambleBatch]:
+        '''
+        Gets the generation of a guild along with the totals of all its players,
+        read within one transaction so that they describe the same writes.
+        '''
+
+        with self._snapshot():
+            return self.guild_generation(table, guild), self.all_user_totals_batch(table, guild)
+
+    def player_snapshot(self, table: str, userid: int, guild: int = 0) -> tuple[int, Gamble | None]:
+        '''
+        Gets the generation of a guild along with the totals of one of its
+        players, or None if they have none, read within one transaction.
+        '''
+
+        with self._snapshot():
+            row = self._connection.execute(f'''
+                SELECT player, hands, gold, ectos, runes, last_timestamp, guild
+                FROM {self._totals(table)}
+                WHERE guild = ? AND player = ?
+            ''', (guild, userid)).fetchone()
+            return self.guild_generation(table, guild), Gamble(*row) if row is not None else None
+
+    def guilds(self, table: str) -> list[int]:
+        '''Gets the id of every guild with recorded gambles, from the most to the least often written.'''
+
+        return [row[0] for row in self._run_query(
+            f'SELECT guild FROM {self._guilds(table)} ORDER BY generation DESC', name='guilds')]
 
-    @simple_query
     def create_table(self, tablename: str):
-        '''Creates a new table in the gambling database.'''
-        
-        return f"CREATE TABLE {tablename}(player, gambles, gold, ectos, runes, timestamp)"
-    
+        '''Creates a new table in the gambling database, along with its player totals.'''
+
+        with self._connection:
+            self._create_data_table(tablename)
+            self._create_guilds_table(tablename)
+            self._create_totals_table(tablename)
+            self._create_daily_table(tablename)
+            self._create_stats_table(tablename)
+            self._create_archive_tables(tablename)
+
+    def schema_version(self) -> int:
+        '''Gets the schema version recorded in the database file.'''
+
+        return self._connection.execute('PRAGMA user_version').fetchone()[0]
+
+    def migrate(self, tablename: str) -> tuple[int, int]:
+        '''
+        Upgrades the database to the latest schema version, creating the
+        table if it doesn't exist yet. Each step runs in its own immediate
+        transaction, so other connections to a live database wait for it
+        and never see a half-migrated schema. The last step also rebuilds
+        the tables derived from the raw gambles, such as the player totals
+        and the daily rollups.
+        Returns the versions before and after the upgrade.
+        '''
+
+        initial = self.schema_version()
+        if initial >= SCHEMA_VERSION:
+            # Up to date, which is the usual case on startup, so no lock is needed
+            return initial, initial
+        if initial == 0:
+            self._prepare_new_file()
+        while True:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                # Re-read inside the transaction in case another process migrated first
+                version = self.schema_version()
+                if version >= SCHEMA_VERSION:
+                    self._connection.rollback()
+                    return initial, version
+                self._MIGRATIONS[version](self, tablename)
+                if version + 1 == SCHEMA_VERSION:
+                    self._fill_derived_tables(tablename)
+                self._connection.execute(f'PRAGMA user_version = {version + 1}')
+                self._connection.commit()
+            except:
+                self._connection.rollback()
+                raise
+
+    def verify_totals(self, tablename: str) -> list[tuple[int, int]]:
+        '''
+        Recomputes the player totals from the raw rows of a table, and
+        returns the (guild, player) pairs whose stored totals have drifted.
+        '''
+
+        totals = self._totals(tablename)
+        query = f'''
+            WITH expected AS ({self._aggregate_query(tablename)})
+            SELECT e.guild, e.player FROM expected e
+            LEFT JOIN {totals} t ON t.guild = e.guild AND t.player = e.player
+            WHERE t.player IS NULL
+                OR t.hands IS NOT e.hands OR t.gold IS NOT e.gold
+                OR t.ectos IS NOT e.ectos OR t.runes IS NOT e.runes
+                OR t.last_timestamp IS NOT e.last_timestamp OR t.count IS NOT e.count
+            UNION
+            SELECT t.guild, t.player FROM {totals} t
+            LEFT JOIN expected e ON t.guild = e.guild AND t.player = e.player
+            WHERE e.player IS NULL
+        '''
+        return self._run_query(query, name='verify_totals')
+
+    def player_distribution(self, tablename: str, userid: int, guild: int = 0) -> Distribution | None:
+        '''Gets the distribution statistics of a player's sessions in a guild, or None if they have none.'''
+
+        row = self._connection.execute(f'''
+            SELECT sessions, mean, m2, minimum, maximum, streak, best_streak, worst_streak, last_timestamp, histogram
+            FROM {self._stats(tablename)}
+            WHERE guild = ? AND player = ?
+        ''', (guild, userid)).fetchone()
+        return Distribution.from_row(row) if row is not None else None
+
+    def verify_distributions(self, tablename: str) -> list[tuple[int, int]]:
+        '''
+        Recomputes the distribution statistics of every player with a full
+        rescan of the raw rows, and returns the (guild, player) pairs whose
+        stored statistics have drifted. Needs a price history.
+        '''
+
+        stored = {}
+        for row in self._connection.execute(f'SELECT * FROM {self._stats(tablename)}'):
+            stored[row[:2]] = Distribution.from_row(row[2:])
+        drifted = [key for key, distribution in self._scan_distributions(tablename)
+            if stored.pop(key, None) != distribution]
+        return drifted + list(stored)
+
+    def rebuild_distributions(self, tablename: str) -> int:
+        '''
+        Rebuilds the distribution statistics of every player from the raw rows
+        in a single transaction. Returns the number of players repaired.
+        '''
+
+        drifted = self.verify_distributions(tablename)
+        with self._connection:
+            self._fill_stats_table(tablename)
+        return len(drifted)
+
+    def rebuild_totals(self, tablename: str) -> int:
+        '''
+        Rebuilds the player totals and daily rollups of a table from its raw rows
+        in a single transaction. Returns the number of players whose totals were repaired.
+        '''
+
+        drifted = self.verify_totals(tablename)
+        with self._connection:
+            self._fill_derived_tables(tablename)
+            self._bump_generations(tablename, [guild for guild, _ in drifted])
+        return len(drifted)
+
+    @METRICS.timed('query_seconds', query='archive_gambles')
+    def archive_gambles(self, tablename: str, before: float, limit: int = ARCHIVE_CHUNK) -> int:
+        '''
+        Archives up to `limit` raw gambles played before the day holding the unix
+        time `before`, within one transaction, oldest first for each player.
+        Archived gambles are kept as per-player daily rollups, along with the
+        distribution statistics of each player's archived sessions, so that the
+        player totals, daily rollups and statistics are left as they are, and
+        so is every total over all time or over whole days.
+        Returns the number of gambles archived: call it again until it returns 0.
+        Needs a price history, to value the archived sessions.
+        '''
+
+        if self._history is None:
+            raise ValueError("Gambles can only be archived with a price history.")
+        self._history.sync()
+        day = int(before // DAY_SECONDS)
+
+        with self._connection:
+            # Taken before reading, so that no other process writes the rows in between
+            self._connection.execute('BEGIN IMMEDIATE')
+            rows = []
+            players = self._connection.execute(f'''
+                SELECT guild, player FROM {self._totals(tablename)} t
+                WHERE EXISTS (
+                    SELECT 1 FROM {tablename}
+                    WHERE guild = t.guild AND player = t.player AND timestamp < ?)
+            ''', (day * DAY_SECONDS,))
+            for guild, player in players:
+                rows += self._connection.execute(f'''
+                    SELECT id, guild, player, gambles, gold, ectos, runes, timestamp
+                    FROM {tablename}
+                    WHERE guild = ? AND player = ? AND timestamp < ?
+                    ORDER BY timestamp
+                    LIMIT ?
+                ''', (guild, player, day * DAY_SECONDS, limit - len(rows))).fetchall()
+                if len(rows) >= limit:
+                    break
+            players.close()
+            if not rows:
+                return 0
+
+            self._connection.executemany(f'''
+            INSERT INTO {self._archive(tablename)} VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1)
+            ON CONFLICT(guild, player, day) DO UPDATE SET
+                hands = hands + excluded.hands,
+                gold = gold + excluded.gold,
+                ectos = ectos + excluded.ectos,
+                runes = runes + excluded.runes,
+                last_timestamp = MAX(last_timestamp, excluded.last_timestamp),
+                count = count + 1
+            ''', [(guild, int(timestamp // DAY_SECONDS), player, hands, gold, ectos, runes, timestamp)
+                for _, guild, player, hands, gold, ectos, runes, timestamp in rows])
+
+            # Rows are grouped by player and in chronological order, as the statistics need
+            archived = {}
+            for _, guild, player, hands, gold, ectos, runes, timestamp in rows:
+                if (guild, player) not in archived:
+                    archived[guild, player] = self._archived_distribution(tablename, guild, player)
+                value = self._session_value(hands, gold, ectos, runes, timestamp)
+                if value is not None:
+                    archived[guild, player].add(value, timestamp)
+            self._connection.executemany(
+                f'INSERT OR REPLACE INTO {self._archive_stats(tablename)} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(guild, player, *distribution.to_row())
+                    for (guild, player), distribution in archived.items() if distribution.sessions])
+
+            self._connection.executemany(f'DELETE FROM {tablename} WHERE id = ?', [(row[0],) for row in rows])
+        return len(rows)
+
+    def backup(self, path: str, pages: int = BACKUP_PAGES, pause: float = BACKUP_PAUSE) -> int:
+        '''
+        Copies the database to `path` while it stays in use, `pages` pages at a
+        time with a pause of `pause` seconds between steps, so that other
+        connections never wait long on it. The copy is renamed to `path` once
+        complete, and deleted if the backup fails. Writes by other connections
+        make the copy start over, so after `BACKUP_RESTARTS` of them, the rest
+        is copied in a single step, which only blocks other readers, and in
+        WAL mode not even writers.
+        Returns the number of pages copied.
+        '''
+
+        restarts = 0
+        previous = None
+
+        def progress(status: int, remaining: int, total: int):
+            nonlocal restarts, previous
+            if previous is not None and remaining > previous:
+                restarts += 1
+                if restarts > BACKUP_RESTARTS:
+                    raise _BackupRestarted()
+            previous = remaining
+            time.sleep(pause)
+
+        partial = f'{path}.partial'
+        target = sqlite3.connect(partial)
+        try:
+            try:
+                try:
+                    self._connection.backup(target, pages=pages, progress=progress)
+                except _BackupRestarted:
+                    self._connection.backup(target)
+                copied = target.execute('PRAGMA page_count').fetchone()[0]
+            finally:
+                target.close()
+            os.replace(partial, path)
+        except BaseException:
+            # Nothing else removes an unfinished copy, as it isn't named like a backup
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        return copied
+
+    def compact(self, pages: int = VACUUM_PAGES) -> int:
+        '''
+        Returns up to `pages` free pages of the database file to the file system,
+        such as those left by archived gambles. Returns the number of pages
+        released: call it again until it returns 0. Does nothing unless the
+        database was created with incremental vacuum, or switched to it by
+        `vacuum`, which `incremental_vacuum` tells.
+        '''
+
+        if not self.incremental_vacuum():
+            return 0
+        free = self._connection.execute('PRAGMA freelist_count').fetchone()[0]
+        if not free:
+            return 0
+        # Each step of the pragma releases one page, and only scripts are stepped through to the end
+        self._connection.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+        return free - self._connection.execute('PRAGMA freelist_count').fetchone()[0]
+
+    def incremental_vacuum(self) -> bool:
+        '''Whether `compact` can release free pages, which databases created before it existed can't until `vacuum`.'''
+
+        return self._connection.execute('PRAGMA auto_vacuum').fetchone()[0] == INCREMENTAL_VACUUM
+
+    def vacuum(self):
+        '''
+        Rebuilds the whole database file, switching it to incremental vacuum
+        so that `compact` can then shrink it in small steps. Every other
+        connection waits until it is done, so it is meant for maintenance windows.
+        '''
+
+        self._connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self._connection.execute('VACUUM')
+
+    @METRICS.timed('query_seconds', query='analyze')
+    def analyze(self, limit: int = ANALYSIS_LIMIT):
+        '''
+        Refreshes the statistics the query planner picks indexes with, sampling
+        about `limit` rows of each index, so that it stays quick on large tables.
+        '''
+
+        self._connection.execute(f'PRAGMA analysis_limit = {int(limit)}')
+        self._connection.execute('ANALYZE')
+
     @gamble_query
-    def user_totals(self, tablename: str, userid: int) -> list[Gamble]:
-        '''Gets the sum data for a user within a table.'''
+    def user_totals(self,
+            tablename: str,
+            userid: int,
+            guild: int = 0,
+            start: float | None = None,
+            end: float | None = None) -> list[Gamble]:
+        '''
+        Gets the sum data for a user within a table and guild. If `start` or
+        `end` are given, only sums the gambles within that window of unix time.
+        '''
+
+        if start is None and end is None:
+            return f'''
+                SELECT player, SUM(hands), SUM(gold), SUM(ectos), SUM(runes), MAX(last_timestamp), guild
+                FROM {self._totals(tablename)}
+                WHERE guild = ? AND player = ?
+            ''', (guild, userid)
 
         return f'''
-            SELECT player, SUM(gambles), SUM(gold), SUM(ectos), SUM(runes), MAX(timestamp)
-            FROM {tablename}
-            WHERE player={userid}
+            SELECT :player, SUM(hands), SUM(gold), SUM(ectos), SUM(runes), MAX(last_timestamp), :guild
+            FROM ({self._window_query(tablename, by_player=True)})
+        ''', self._window_params(guild, start, end, player=userid)
+
+    @gamble_query
+    def bot_totals(self,
+            tablename: str,
+            guild: int = 0,
+            start: float | None = None,
+            end: float | None = None) -> list[Gamble]:
+        '''
+        Gets the sum data for all users within a table and guild. If `start`
+        or `end` are given, only sums the gambles within that window of unix time.
         '''
+
+        if start is None and end is None:
+            return f'''
+                SELECT null, SUM(hands), SUM(gold), SUM(ectos), SUM(runes), MAX(last_timestamp), guild
+                FROM {self._totals(tablename)}
+                WHERE guild = ?
+            ''', (guild,)
+
+        return f'''
+            SELECT null, SUM(hands), SUM(gold), SUM(ectos), SUM(runes), MAX(last_timestamp), :guild
+            FROM ({self._window_query(tablename)})
+        ''', self._window_params(guild, start, end)
+    
     @gamble_query
-    def bot_totals(self, tablename: str) -> list[Gamble]:
-        '''Gets the sum data for all users within a table.'''
+    def all_user_totals(self, tablename: str, guild: int = 0) -> list[Gamble]:
 
         return f'''
-            SELECT null, SUM(gambles), SUM(gold), SUM(ectos), SUM(runes), MAX(timestamp)
-            FROM {tablename}
-        '''
+            SELECT player, hands, gold, ectos, runes, last_timestamp, guild
+            FROM {self._totals(tablename)}
+            WHERE guild = ?
+        ''', (guild,)
     
+    @batch_query
+    def all_user_totals_batch(self, tablename: str, guild: int = 0) -> GambleBatch:
+        '''Gets the totals of every player within a table and guild, as a single columnar batch.'''
+
+        return f'''
+            SELECT player, hands, gold, ectos, runes, last_timestamp
+            FROM {self._totals(tablename)}
+            WHERE guild = ?
+        ''', (guild,)
+
+    @gamble_query
+    def leaderboard(self,
+            tablename: str,
+            ecto_value: float,
+            rune_value: float,
+            n: int,
+            winners: bool = True,
+            by_average: bool = False,
+            guild: int = 0,
+            start: float | None = None,
+            end: float | None = None,
+            after: Gamble | None = None,
+            before: Gamble | None = None) -> list[Gamble]:
+        '''
+        Gets the totals of the `n` players of a guild with the highest (or
+        lowest, if `winners` is false) net value, valued at the given prices in gold.
+        If `by_average` is true, players are ranked on their net value per hand instead.
+        If `start` or `end` are given, only the gambles within that window of
+        unix time are counted, mostly read from the daily rollups.
+        Pages past the first are sought from a row on the edge of another page:
+        `after` gets the `n` players ranked right after that row, and `before`
+        the `n` players ranked right before it.
+        '''
+
+        def value(hands: str = 'hands', gold: str = 'gold', ectos: str = 'ectos', runes: str = 'runes') -> str:
+            expression = f'({gold} + {ectos} * :ecto + {runes} * :rune - {hands} * (100 + 250 * :ecto))'
+            return f'{expression} / {hands}' if by_average else expression
+
+        order = f"score {'DESC' if winners else 'ASC'}, player"
+        params = {'ecto': ecto_value, 'rune': rune_value, 'n': n}
+
+        # Keyset pagination: a page is found by a filtered scan past the key of its
+        # edge, so deep pages cost the same as the first one, unlike with an OFFSET.
+        # The edge row's score is computed by the same expression as the others, so that it
+        # rounds the same way, and scores are negated for winners to compare in ranking order.
+        seek = '1'
+        scan = order
+        if after is not None or before is not None:
+            forward = after is not None
+            edge = after if forward else before
+            sign = -1 if winners else 1
+            edge_score = f"ROUND({value(':edge_hands', ':edge_gold', ':edge_ectos', ':edge_runes')}, 2)"
+            seek = f"({sign} * score, player) {'>' if forward else '<'} ({sign} * {edge_score}, :edge_player)"
+            params.update(edge_hands=edge.hands, edge_gold=edge.gold, edge_ectos=edge.ectos,
+                edge_runes=edge.runes, edge_player=edge.user)
+            if not forward:
+                # The page before the key is scanned backwards from it, then put back in order
+                scan = f"score {'ASC' if winners else 'DESC'}, player DESC"
+
+        if start is None and end is None:
+            players = f'''
+                SELECT player, hands, gold, ectos, runes, last_timestamp, guild
+                FROM {self._totals(tablename)}
+                WHERE guild = :guild
+            '''
+            params['guild'] = guild
+        else:
+            players = f'''
+                SELECT player, SUM(hands) AS hands, SUM(gold) AS gold, SUM(ectos) AS ectos,
+                    SUM(runes) AS runes, MAX(last_timestamp) AS last_timestamp, :guild AS guild
+                FROM ({self._window_query(tablename)})
+                GROUP BY player
+            '''
+            params.update(self._window_params(guild, start, end))
+
+        # When seeking, every score is computed once in a subquery that LIMIT -1 keeps SQLite
+        # from flattening, which would compute it again for the filter and for the sort
+        barrier = 'LIMIT -1' if seek != '1' else ''
+        query = f'''
+            SELECT player, hands, gold, ectos, runes, last_timestamp, guild, score
+            FROM (SELECT *, ROUND({value()}, 2) AS score FROM ({players}) {barrier})
+            WHERE {seek}
+            ORDER BY {scan}
+            LIMIT :n
+        '''
+        if scan != order:
+            query = f'SELECT * FROM ({query}) ORDER BY {order}'
+        query = f'SELECT player, hands, gold, ectos, runes, last_timestamp, guild FROM ({query})'
+        return query, params
+
     @gamble_query
-    def all_user_totals(self, tablename: str) -> list[Gamble]:
+    def recent_by_user(self, tablename: str, userid: int, n: int, guild: int = 0) -> list[Gamble]:
+        '''Gets the n most recent gambles by the user with the given id in the specified table and guild.'''
 
         return f'''
-            SELECT player, SUM(gambles), SUM(gold), SUM(ectos), SUM(runes), MAX(timestamp)
+            SELECT player, gambles, gold, ectos, runes, timestamp, guild
             FROM {tablename}
-            GROUP BY player
+            WHERE guild = ? AND player = ?
+            ORDER BY timestamp DESC
+            LIMIT ?
+        ''', (guild, userid, n)
+
+    def check_table_exists(self, tablename: str) -> bool:
+
+        query = "SELECT name FROM sqlite_master WHERE type='table' AND name=?"
+        return any(self._run_query(query, params=(tablename,), name='check_table_exists'))
+
+    def _insert_gambles(self, table: str, gambles: list[Gamble]):
+        '''Inserts gambles and adds them to the running totals, within the caller's transaction.'''
+
+        values = [(g.guild, g.user, g.hands, g.gold, g.ectos, g.runes, g.timestamp) for g in gambles]
+        self._connection.executemany(f'''
+        INSERT INTO {table}(guild, player, gambles, gold, ectos, runes, timestamp)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', values)
+        self._connection.executemany(f'''
+        INSERT INTO {self._totals(table)} VALUES (?, ?, ?, ?, ?, ?, ?, 1)
+        ON CONFLICT(guild, player) DO UPDATE SET
+            hands = hands + excluded.hands,
+            gold = gold + excluded.gold,
+            ectos = ectos + excluded.ectos,
+            runes = runes + excluded.runes,
+            last_timestamp = MAX(last_timestamp, excluded.last_timestamp),
+            count = count + 1
+        ''', values)
+        self._connection.executemany(f'''
+        INSERT INTO {self._daily(table)} VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1)
+        ON CONFLICT(guild, day, player) DO UPDATE SET
+            hands = hands + excluded.hands,
+            gold = gold + excluded.gold,
+            ectos = ectos + excluded.ectos,
+            runes = runes + excluded.runes,
+            last_timestamp = MAX(last_timestamp, excluded.last_timestamp),
+            count = count + 1
+        ''', [(guild, int(timestamp // DAY_SECONDS), player, hands, gold, ectos, runes, timestamp)
+            for guild, player, hands, gold, ectos, runes, timestamp in values])
+        self._update_distributions(table, gambles)
+        # Once per gamble, so that a write changing a single player is told apart from a group commit
+        self._bump_generations(table, [g.guild for g in gambles])
+
+    def _session_value(self, hands: int, gold: int, ectos: int, runes: int, timestamp: float) -> float | None:
         '''
-    
-    @gamble_query
-    def recent_by_user(self, tablename: str, userid: int, n: int) -> list[Gamble]:
-        '''Gets the n most recent gambles by the user with the given id in the specified table.'''
+        Net value per hand of a session at the prices of its time, or None if
+        no prices are known or the session has no hands to divide by. Callers
+        sync the price history first, so that sessions are valued at the
+        snapshots of every process sharing its file.
+        '''
+
+        if hands <= 0:
+            return None
+        prices = self._history.prices_at(timestamp) if self._history is not None else None
+        if prices is None:
+            return None
+        session = Gamble(None, hands, gold, ectos, runes, timestamp)
+        return session._compute_value(prices[ItemType.ectoplasm]/10000, prices[ItemType.rune]/10000)[1]
+
+    def _update_distributions(self, table: str, gambles: list[Gamble]):
+        '''
+        Adds new gambles to their players' distribution statistics, within the
+        caller's transaction. Players receiving a gamble older than their latest
+        one, such as from an import, have their sessions replayed in order instead.
+        '''
+
+        if self._history is None:
+            return
+        self._history.sync()
+
+        by_player: dict[tuple[int, int], list[Gamble]] = {}
+        for g in gambles:
+            by_player.setdefault((g.guild, g.user), []).append(g)
+
+        updated = []
+        replay = []
+        for (guild, player), sessions in by_player.items():
+            row = self._connection.execute(f'''
+                SELECT sessions, mean, m2, minimum, maximum, streak, best_streak, worst_streak, last_timestamp, histogram
+                FROM {self._stats(table)}
+                WHERE guild = ? AND player = ?
+            ''', (guild, player)).fetchone()
+            distribution = Distribution.from_row(row) if row is not None else Distribution()
+            sessions.sort(key=lambda g: g.timestamp)
+            if distribution.sessions and sessions[0].timestamp < distribution.last_timestamp:
+                replay.append((guild, player))
+                continue
+            for g in sessions:
+                value = self._session_value(g.hands, g.gold, g.ectos, g.runes, g.timestamp)
+                if value is not None:
+                    distribution.add(value, g.timestamp)
+            if distribution.sessions:
+                updated.append((guild, player, *distribution.to_row()))
 
+        self._store_distributions(table, updated)
+        self._recompute_distributions(table, replay)
+
+    def _recompute_distributions(self, table: str, players: list[tuple[int, int]]):
+        '''
+        Replays every session of the given (guild, player) pairs, within the caller's
+        transaction, starting from the statistics of their archived sessions.
+        Takes time in proportion to the players' unarchived sessions, but leaves
+        exactly the statistics a rebuild would, which undoing a single session
+        can't: the minimum, maximum and streaks it set would be lost.
+        '''
+
+        if self._history is None or not players:
+            return
+        self._history.sync()
+
+        updated = []
+        for guild, player in players:
+            distribution = self._archived_distribution(table, guild, player)
+            for row in self._connection.execute(f'''
+                    SELECT gambles, gold, ectos, runes, timestamp
+                    FROM {table}
+                    WHERE guild = ? AND player = ?
+                    ORDER BY timestamp''', (guild, player)):
+                value = self._session_value(*row)
+                if value is not None:
+                    distribution.add(value, row[4])
+            if distribution.sessions:
+                updated.append((guild, player, *distribution.to_row()))
+            else:
+                self._connection.execute(
+                    f'DELETE FROM {self._stats(table)} WHERE guild = ? AND player = ?', (guild, player))
+        self._store_distributions(table, updated)
+
+    def _archived_distribution(self, table: str, guild: int, player: int) -> Distribution:
+        '''Gets the distribution statistics of a player's archived sessions, which are empty if none were archived.'''
+
+        row = self._connection.execute(f'''
+            SELECT sessions, mean, m2, minimum, maximum, streak, best_streak, worst_streak, last_timestamp, histogram
+            FROM {self._archive_stats(table)}
+            WHERE guild = ? AND player = ?
+        ''', (guild, player)).fetchone()
+        return Distribution.from_row(row) if row is not None else Distribution()
+
+    def _store_distributions(self, table: str, rows: list[tuple]):
+
+        self._connection.executemany(
+            f'INSERT OR REPLACE INTO {self._stats(table)} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def _scan_distributions(self, table: str) -> Iterator[tuple[tuple[int, int], Distribution]]:
+        '''
+        Yields the (guild, player) pair and distribution statistics of every
+        player, computed by replaying all raw rows in chronological order,
+        after the statistics of the player's archived sessions.
+        Rows are read in chunks, so only one player's statistics are held at a time.
+        '''
+
+        if self._history is None:
+            raise ValueError("Distribution statistics can only be computed with a price history.")
+        self._history.sync()
+
+        cursor = self._connection.execute(f'''
+            SELECT guild, player, gambles, gold, ectos, runes, timestamp
+            FROM {table}
+            ORDER BY guild, player, timestamp
+        ''')
+        # Both are in (guild, player) order, so each player's archived statistics are met along with their raw rows
+        archive = self._connection.execute(f'SELECT * FROM {self._archive_stats(table)} ORDER BY guild, player')
+        archived = archive.fetchone()
+        key = None
+        distribution = Distribution()
+        try:
+            while rows := cursor.fetchmany(FETCH_SIZE):
+                for guild, player, *session in rows:
+                    if (guild, player) != key:
+                        if key is not None and distribution.sessions:
+                            yield key, distribution
+                        key = (guild, player)
+                        distribution = Distribution()
+                        # Players whose sessions are all archived have no raw rows
+                        while archived is not None and archived[:2] < key:
+                            yield archived[:2], Distribution.from_row(archived[2:])
+                            archived = archive.fetchone()
+                        if archived is not None and archived[:2] == key:
+                            distribution = Distribution.from_row(archived[2:])
+                            archived = archive.fetchone()
+                    value = self._session_value(*session)
+                    if value is not None:
+                        distribution.add(value, session[4])
+            if key is not None and distribution.sessions:
+                yield key, distribution
+            while archived is not None:
+                yield archived[:2], Distribution.from_row(archived[2:])
+                archived = archive.fetchone()
+        finally:
+            cursor.close()
+            archive.close()
+
+    def _prepare_new_file(self):
+        '''
+        Switches a database without any table to incremental vacuum, so that
+        `compact` works on it. This must happen before its first table is
+        created, and before it is switched to WAL mode, after which the setting
+        is ignored. Does nothing to other databases.
+        '''
+
+        if self._connection.execute('SELECT 1 FROM sqlite_master').fetchone() is None:
+            self._connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
+    def _bump_generations(self, table: str, guilds: Iterable[int]):
+        '''
+        Increases the generation counter of each guild once for every time it
+        is listed in `guilds`, within the caller's transaction.
+        '''
+
+        self._connection.executemany(f'''
+        INSERT INTO {self._guilds(table)} VALUES (?, 1)
+        ON CONFLICT(guild) DO UPDATE SET generation = generation + 1
+        ''', [(guild,) for guild in guilds])
+
+    @contextmanager
+    def _snapshot(self) -> Iterator[None]:
+        '''Runs the reads within it in a single read transaction, so that they all see the same state of the database.'''
+
+        self._connection.execute('BEGIN')
+        try:
+            yield
+        finally:
+            self._connection.rollback()
+
+    def _window_query(self, tablename: str, by_player: bool = False) -> str:
+        '''
+        Query for the gambles of a guild within a window of time, as rows of
+        (player, hands, gold, ectos, runes, last_timestamp). Whole days are read
+        from the daily rollups, and only the partial days at the edges of the
+        window from the raw gambles. Expects the parameters of `_window_params`.
+        If `by_player` is true, the rows are limited to the `:player` parameter.
+        '''
+
+        player = 'AND player = :player' if by_player else ''
         return f'''
+            SELECT player, hands, gold, ectos, runes, last_timestamp
+            FROM {self._daily(tablename)}
+            WHERE guild = :guild {player} AND day >= :first_day AND day < :last_day
+            UNION ALL
             SELECT player, gambles, gold, ectos, runes, timestamp
             FROM {tablename}
-            WHERE player={userid}
-            ORDER BY timestamp DESC
-            LIMIT {n}
+            WHERE guild = :guild {player} AND timestamp >= :start AND timestamp < :head_end
+            UNION ALL
+            SELECT player, gambles, gold, ectos, runes, timestamp
+            FROM {tablename}
+            WHERE guild = :guild {player} AND timestamp >= :tail_start AND timestamp < :end
         '''
 
-    def check_table_exists(self, tablename: str) -> bool:
+    def _window_params(self, guild: int, start: float | None, end: float | None, **extra) -> dict:
+        '''
+        Parameters of `_window_query` for the window from `start` (inclusive)
+        to `end` (exclusive), in unix time. Missing bounds leave the window open.
+        '''
 
-        query = f'SELECT name FROM sqlite_master WHERE type=\'table\' AND name=\'{tablename}\';'
-        return any(self._run_query(query))
-        
+        start = start if start is not None else -math.inf
+        end = end if end is not None else math.inf
+        first_day = math.ceil(start / DAY_SECONDS) if math.isfinite(start) else -2**62
+        last_day = math.floor(end / DAY_SECONDS) if math.isfinite(end) else 2**62
+
+        if first_day >= last_day:
+            # No whole day fits in the window, so every row comes from the raw gambles
+            first_day = last_day = 0
+            head_end = tail_start = end
+        else:
+            head_end = first_day * DAY_SECONDS if math.isfinite(start) else start
+            tail_start = last_day * DAY_SECONDS if math.isfinite(end) else end
+
+        return {'guild': guild, 'start': start, 'end': end,
+            'first_day': first_day, 'last_day': last_day,
+            'head_end': head_end, 'tail_start': tail_start, **extra}
+
+    def _totals(self, tablename: str) -> str:
+        '''Name of the table holding the running player totals of `tablename`.'''
+
+        return f'{tablename}_player_totals'
 
-    def _run_query(self, query: str, get_result: bool = True) -> list | None:
+    def _stats(self, tablename: str) -> str:
+        '''Name of the table holding the distribution statistics of the players of `tablename`.'''
+
+        return f'{tablename}_player_stats'
+
+    def _daily(self, tablename: str) -> str:
+        '''Name of the table holding the daily per-player rollups of `tablename`.'''
+
+        return f'{tablename}_daily'
+
+    def _archive(self, tablename: str) -> str:
+        '''Name of the table holding the daily per-player rollups of the archived gambles of `tablename`.'''
+
+        return f'{tablename}_archive'
+
+    def _archive_stats(self, tablename: str) -> str:
+        '''Name of the table holding the distribution statistics of the archived sessions of each player of `tablename`.'''
+
+        return f'{tablename}_archive_stats'
+
+    def _guilds(self, tablename: str) -> str:
+        '''Name of the table holding the generation counter of each guild in `tablename`.'''
+
+        return f'{tablename}_guilds'
+
+    def _create_data_table(self, tablename: str):
+        '''Creates the raw gambles table `tablename` and its per-guild, per-player index.'''
+
+        self._connection.execute(f'''
+            CREATE TABLE {tablename}(
+                id INTEGER PRIMARY KEY,
+                player INTEGER NOT NULL,
+                gambles INTEGER NOT NULL,
+                gold INTEGER NOT NULL,
+                ectos INTEGER NOT NULL,
+                runes INTEGER NOT NULL,
+                timestamp REAL NOT NULL,
+                guild INTEGER NOT NULL DEFAULT 0)
+        ''')
+        # Covers the per-player queries, which never need to visit the table itself
+        self._connection.execute(f'''
+            CREATE INDEX {tablename}_guild_player_timestamp
+            ON {tablename}(guild, player, timestamp DESC, gambles, gold, ectos, runes)
+        ''')
+        # Covers the edges of time windows, across all players of a guild
+        self._connection.execute(f'''
+            CREATE INDEX {tablename}_guild_timestamp
+            ON {tablename}(guild, timestamp, player, gambles, gold, ectos, runes)
+        ''')
+
+    def _create_guilds_table(self, tablename: str):
+        '''Creates the per-guild generation counters for `tablename`.'''
+
+        self._connection.execute(f'''
+            CREATE TABLE {self._guilds(tablename)}(
+                guild INTEGER PRIMARY KEY,
+                generation INTEGER NOT NULL)
+        ''')
+
+    def _create_totals_table(self, tablename: str):
+        '''Creates the running player totals table for `tablename` if it doesn't exist.'''
+
+        self._connection.execute(f'''
+            CREATE TABLE IF NOT EXISTS {self._totals(tablename)}(
+                guild INTEGER NOT NULL,
+                player INTEGER NOT NULL,
+                hands INTEGER NOT NULL,
+                gold INTEGER NOT NULL,
+                ectos INTEGER NOT NULL,
+                runes INTEGER NOT NULL,
+                last_timestamp REAL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (guild, player)) WITHOUT ROWID
+        ''')
+
+    def _create_daily_table(self, tablename: str):
+        '''Creates the daily per-player rollups table for `tablename` if it doesn't exist.'''
+
+        self._connection.execute(f'''
+            CREATE TABLE IF NOT EXISTS {self._daily(tablename)}(
+                guild INTEGER NOT NULL,
+                day INTEGER NOT NULL,
+                player INTEGER NOT NULL,
+                hands INTEGER NOT NULL,
+                gold INTEGER NOT NULL,
+                ectos INTEGER NOT NULL,
+                runes INTEGER NOT NULL,
+                last_timestamp REAL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (guild, day, player)) WITHOUT ROWID
+        ''')
+        self._connection.execute(f'''
+            CREATE INDEX IF NOT EXISTS {self._daily(tablename)}_guild_player_day
+            ON {self._daily(tablename)}(guild, player, day)
+        ''')
+
+    def _create_stats_table(self, tablename: str):
+        '''Creates the per-player distribution statistics table for `tablename` if it doesn't exist.'''
+
+        self._connection.execute(f'''
+            CREATE TABLE IF NOT EXISTS {self._stats(tablename)}(
+                guild INTEGER NOT NULL,
+                player INTEGER NOT NULL,
+                sessions INTEGER NOT NULL,
+                mean REAL NOT NULL,
+                m2 REAL NOT NULL,
+                minimum REAL NOT NULL,
+                maximum REAL NOT NULL,
+                streak INTEGER NOT NULL,
+                best_streak INTEGER NOT NULL,
+                worst_streak INTEGER NOT NULL,
+                last_timestamp REAL NOT NULL,
+                histogram BLOB NOT NULL,
+                PRIMARY KEY (guild, player)) WITHOUT ROWID
+        ''')
+
+    def _create_archive_tables(self, tablename: str):
+        '''
+        Creates the tables holding the archived gambles of `tablename` if they don't exist:
+        per-player daily rollups, and the distribution statistics of each player's archived sessions.
+        '''
+
+        self._connection.execute(f'''
+            CREATE TABLE IF NOT EXISTS {self._archive(tablename)}(
+                guild INTEGER NOT NULL,
+                day INTEGER NOT NULL,
+                player INTEGER NOT NULL,
+                hands INTEGER NOT NULL,
+                gold INTEGER NOT NULL,
+                ectos INTEGER NOT NULL,
+                runes INTEGER NOT NULL,
+                last_timestamp REAL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (guild, player, day)) WITHOUT ROWID
+        ''')
+        self._connection.execute(f'''
+            CREATE TABLE IF NOT EXISTS {self._archive_stats(tablename)}(
+                guild INTEGER NOT NULL,
+                player INTEGER NOT NULL,
+                sessions INTEGER NOT NULL,
+                mean REAL NOT NULL,
+                m2 REAL NOT NULL,
+                minimum REAL NOT NULL,
+                maximum REAL NOT NULL,
+                streak INTEGER NOT NULL,
+                best_streak INTEGER NOT NULL,
+                worst_streak INTEGER NOT NULL,
+                last_timestamp REAL NOT NULL,
+                histogram BLOB NOT NULL,
+                PRIMARY KEY (guild, player)) WITHOUT ROWID
+        ''')
+
+    def _fill_derived_tables(self, tablename: str):
         '''
-        Creates a cursor and attempts to run a query.
+        Rebuilds every table derived from the raw gambles of `tablename`, within the caller's transaction.
+        The distribution statistics are left as they are if the connector has no price history.
+        '''
+
+        self._fill_totals_table(tablename)
+        self._fill_daily_table(tablename)
+        if self._history is not None:
+            self._fill_stats_table(tablename)
+
+    def _fill_stats_table(self, tablename: str):
+        '''Replaces the distribution statistics of `tablename` with statistics replayed from its raw rows.'''
+
+        self._create_stats_table(tablename)
+        self._connection.execute(f'DELETE FROM {self._stats(tablename)}')
+        chunk = []
+        for (guild, player), distribution in self._scan_distributions(tablename):
+            chunk.append((guild, player, *distribution.to_row()))
+            if len(chunk) >= FETCH_SIZE:
+                self._store_distributions(tablename, chunk)
+                chunk = []
+        self._store_distributions(tablename, chunk)
+
+    def _fill_daily_table(self, tablename: str):
+        '''Replaces the contents of the daily rollups of `tablename` with rollups computed from its raw rows and its archive.'''
+
+        self._create_daily_table(tablename)
+        self._create_archive_tables(tablename)
+        self._connection.execute(f'DELETE FROM {self._daily(tablename)}')
+        # Archived days are only left as rollups, which are added to those of the raw gambles
+        self._connection.execute(f'''
+            INSERT INTO {self._daily(tablename)}
+            SELECT guild, day, player, SUM(hands), SUM(gold), SUM(ectos), SUM(runes), MAX(last_timestamp), SUM(count)
+            FROM (
+                SELECT guild, CAST(timestamp / {DAY_SECONDS} AS INTEGER) AS day, player,
+                    gambles AS hands, gold, ectos, runes, timestamp AS last_timestamp, 1 AS count
+                FROM {tablename}
+                UNION ALL
+                SELECT guild, day, player, hands, gold, ectos, runes, last_timestamp, count
+                FROM {self._archive(tablename)})
+            GROUP BY guild, day, player
+        ''')
+
+    def _fill_totals_table(self, tablename: str):
+        '''Replaces the contents of the player totals of `tablename` with totals computed from its raw rows and its archive.'''
+
+        self._create_totals_table(tablename)
+        self._create_archive_tables(tablename)
+        self._connection.execute(f'DELETE FROM {self._totals(tablename)}')
+        self._connection.execute(f'INSERT INTO {self._totals(tablename)} {self._aggregate_query(tablename)}')
+
+    def _aggregate_query(self, tablename: str) -> str:
+        '''Query computing the player totals of `tablename` from its raw rows and its archive.'''
+
+        return f'''
+            SELECT guild, player, SUM(hands) AS hands, SUM(gold) AS gold, SUM(ectos) AS ectos,
+                SUM(runes) AS runes, MAX(last_timestamp) AS last_timestamp, SUM(count) AS count
+            FROM (
+                SELECT guild, player, gambles AS hands, gold, ectos, runes, timestamp AS last_timestamp, 1 AS count
+                FROM {tablename}
+                UNION ALL
+                SELECT guild, player, hands, gold, ectos, runes, last_timestamp, count
+                FROM {self._archive(tablename)})
+            GROUP BY guild, player
+        '''
+
+    # Migration steps create their tables with the schema of their own version,
+    # rather than with the helpers above, which always follow the latest one.
+
+    def _migrate_to_typed_schema(self, tablename: str):
+        '''
+        Schema version 1: typed columns, an integer primary key on the raw
+        gambles and a covering (player, timestamp) index. Legacy untyped
+        tables are copied over in place.
+        '''
+
+        legacy = f'{tablename}_legacy'
+        exists = self._connection.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name=?", (tablename,)).fetchone() is not None
+        if exists:
+            self._connection.execute(f'ALTER TABLE {tablename} RENAME TO {legacy}')
+        self._connection.execute(f'''
+            CREATE TABLE {tablename}(
+                id INTEGER PRIMARY KEY,
+                player INTEGER NOT NULL,
+                gambles INTEGER NOT NULL,
+                gold INTEGER NOT NULL,
+                ectos INTEGER NOT NULL,
+                runes INTEGER NOT NULL,
+                timestamp REAL NOT NULL)
+        ''')
+        self._connection.execute(f'''
+            CREATE INDEX {tablename}_player_timestamp
+            ON {tablename}(player, timestamp DESC, gambles, gold, ectos, runes)
+        ''')
+        if exists:
+            self._connection.execute(f'''
+                INSERT INTO {tablename}(id, player, gambles, gold, ectos, runes, timestamp)
+                SELECT rowid, player, gambles, gold, ectos, runes, timestamp FROM {legacy}
+            ''')
+            self._connection.execute(f'DROP TABLE {legacy}')
+
+        # Derived tables are rebuilt once the last migration step has run
+        self._connection.execute(f'DROP TABLE IF EXISTS {self._totals(tablename)}')
+
+    def _migrate_to_guilds(self, tablename: str):
+        '''
+        Schema version 2: every gamble belongs to a guild. Existing gambles
+        are assigned to guild 0, and the per-player index is replaced by a
+        per-guild one. Adds a generation counter for each guild.
+        '''
+
+        self._connection.execute(f'ALTER TABLE {tablename} ADD COLUMN guild INTEGER NOT NULL DEFAULT 0')
+        self._connection.execute(f'DROP INDEX {tablename}_player_timestamp')
+        self._connection.execute(f'''
+            CREATE INDEX {tablename}_guild_player_timestamp
+            ON {tablename}(guild, player, timestamp DESC, gambles, gold, ectos, runes)
+        ''')
+        self._connection.execute(f'''
+            CREATE TABLE {self._guilds(tablename)}(
+                guild INTEGER PRIMARY KEY,
+                generation INTEGER NOT NULL)
+        ''')
+        self._connection.execute(f'DROP TABLE IF EXISTS {self._totals(tablename)}')
+
+    def _migrate_to_daily_rollups(self, tablename: str):
+        '''
+        Schema version 3: adds a (guild, timestamp) index for reading the edges
+        of time windows. The daily rollups are derived, so they are built along
+        with the other derived tables.
+        '''
+
+        self._connection.execute(f'''
+            CREATE INDEX {tablename}_guild_timestamp
+            ON {tablename}(guild, timestamp, player, gambles, gold, ectos, runes)
+        ''')
+
+    def _migrate_to_player_stats(self, tablename: str):
+        '''
+        Schema version 4: adds the players' distribution statistics. They are
+        derived, so they are filled along with the other derived tables.
+        '''
+
+        self._create_stats_table(tablename)
+
+    def _migrate_to_archive(self, tablename: str):
+        '''
+        Schema version 5: adds the archive of old gambles, kept as per-player
+        daily rollups along with the statistics of the archived sessions.
+        '''
+
+        self._create_archive_tables(tablename)
+
+    # Migration steps, where the step at index `i` upgrades the schema from version `i` to `i + 1`
+    _MIGRATIONS = [_migrate_to_typed_schema, _migrate_to_guilds, _migrate_to_daily_rollups, _migrate_to_player_stats,
+        _migrate_to_archive]
+
+    def _run_query(self,
+            query: str,
+            get_result: bool = True,
+            params: tuple | dict = (),
+            name: str = 'query') -> list | None:
+        '''
+        Creates a cursor and attempts to run a query, binding `params` to its placeholders.
         If `get_result` is `True`, attempts to return the query results as a list.
+        The time taken is recorded under `name` in the performance metrics.
         '''
 
-        cursor = self._connection.cursor()
-        result = cursor.execute(query)
-        if get_result:
-            result = result.fetchall()
-        cursor.close()
-        self._connection.commit()
+        with METRICS.timer('query_seconds', query=name):
+            cursor = self._connection.cursor()
+            result = cursor.execute(query, params)
+            if get_result:
+                result = result.fetchall()
+            cursor.close()
+            if self._connection.in_transaction:
+                self._connection.commit()
 
         if get_result:
             return result
         return None
         
+class AsyncConnector:
+    '''
+    Asynchronous front for `Connector`, meant to be used from the bot's event loop.
+    The database runs in WAL mode: every write goes through a single
+    writer thread, so writes are serialized, while reads are spread over
+    a small pool of read-only connections and run alongside them.
+
+    Queries are the unbound `Connector` methods, for example
+    `await db.read(Connector.user_totals, table, userid)`.
+
+    With `write_behind` enabled, gambles passed to `save_gamble` are queued
+    and committed in groups, trading a few milliseconds of latency for far
+    fewer commits during bursts of submissions.
+    '''
+
+    def __init__(self,
+            dbfile: str = 'gambadata.db',
+            readers: int = READ_POOL_SIZE,
+            write_behind: bool = False,
+            flush_interval: float = FLUSH_INTERVAL,
+            flush_rows: int = FLUSH_ROWS,
+            history: PriceHistory | None = None):
+        '''
+        Opens the writer connection, switching `dbfile` to WAL mode, and
+        prepares a pool of `readers` read-only connections, opened on first use.
+        - `write_behind` - if true, queued gambles are saved together.
+        - `history` - price history the writer values sessions with, for the distribution statistics.
+        - `flush_interval` - longest time, in seconds, a queued gamble waits for its group.
+        - `flush_rows` - number of queued gambles that triggers an immediate flush.
+        '''
+
+        self._write_behind = write_behind
+        self._flush_interval = flush_interval
+        self._flush_rows = flush_rows
+        self._pending: list[tuple[str, Gamble, asyncio.Future]] = []
+        self._flush_timer: asyncio.TimerHandle | None = None
+        self._flushes: set[asyncio.Future] = set()
+
+        self._dbfile = dbfile
+        self._history = history
+        self._local = threading.local()
+        self._connectors: list[Connector] = []
+        self._connectors_lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(1, 'db-writer', self._open, (False,))
+        self._readers = ThreadPoolExecutor(readers, 'db-reader', self._open, (True,))
+        # The writer must create the file before any reader can open it
+        self._writer.submit(self._enable_wal).result()
+
+    async def read(self, query: Callable[..., T], *args, **kwargs) -> T:
+        '''Runs a read-only `Connector` method on the reader pool.'''
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, partial(self._call, query, *args, **kwargs))
+
+    async def write(self, query: Callable[..., T], *args, **kwargs) -> T:
+        '''Runs a `Connector` method on the writer thread, after every write submitted before it.'''
+
+        # Queued gambles were submitted first, so they must be written first
+        self._flush()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, partial(self._call, query, *args, **kwargs))
+
+    async def save_gamble(self, table: str, gamble: Gamble):
+        '''
+        Saves a gamble, returning once it has been committed. In write-behind
+        mode the gamble is queued, and committed along with the other gambles
+        queued within `flush_interval` seconds or `flush_rows` submissions.
+        '''
+
+        if not self._write_behind:
+            return await self.write(Connector.save_gamble, table, gamble)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((table, gamble, future))
+        if len(self._pending) >= self._flush_rows:
+            self._flush()
+        elif self._flush_timer is None:
+            self._flush_timer = loop.call_later(self._flush_interval, self._flush)
+        await future
+
+    async def backup(self, path: str, pages: int = BACKUP_PAGES, pause: float = BACKUP_PAUSE) -> int:
+        '''
+        Copies the database to `path` as `Connector.backup` does, from a thread and
+        a read-only connection of its own, so that reads and writes carry on meanwhile.
+        '''
+
+        return await asyncio.to_thread(self._backup, path, pages, pause)
+
+    @property
+    def dbfile(self) -> str:
+        '''The database file, as given when the connector was created.'''
+
+        return self._dbfile
+
+    def migrate(self, tablename: str) -> tuple[int, int]:
+        '''Blocking call that upgrades the schema on the writer thread. Meant for startup.'''
+
+        return self._writer.submit(self._call, Connector.migrate, tablename).result()
+
+    async def close(self):
+        '''Flushes queued gambles and waits for pending queries to finish, then closes every connection.'''
+
+        self._flush()
+        if self._flushes:
+            await asyncio.wait(self._flushes)
+        await asyncio.to_thread(self._shutdown)
+
+    def _flush(self):
+        '''
+        Submits every queued gamble to the writer thread, one transaction per
+        table, and resolves their futures once the transaction is committed.
+        '''
+
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if not self._pending:
+            return
+
+        batches: dict[str, list[tuple[Gamble, asyncio.Future]]] = {}
+        for table, gamble, future in self._pending:
+            batches.setdefault(table, []).append((gamble, future))
+        self._pending = []
+
+        loop = asyncio.get_running_loop()
+        for table, batch in batches.items():
+            gambles = [gamble for gamble, _ in batch]
+            flush = loop.run_in_executor(self._writer, self._save_group, table, gambles)
+            self._flushes.add(flush)
+            flush.add_done_callback(partial(self._resolve, [future for _, future in batch]))
+
+    def _save_group(self, table: str, gambles: list[Gamble]) -> list[Exception | None]:
+        '''
+        Saves a group of queued gambles in a single transaction. If it fails,
+        the gambles are saved again one at a time, so that one bad gamble
+        doesn't fail the others. Returns the error each gamble failed with, or None.
+        '''
+
+        connector = self._local.connector
+        try:
+            connector.save_gambles(table, gambles)
+            return [None] * len(gambles)
+        except Exception as e:
+            if len(gambles) == 1:
+                return [e]
+
+        METRICS.increment('write_behind_retries_total')
+        errors = []
+        for gamble in gambles:
+            try:
+                connector.save_gamble(table, gamble)
+                errors.append(None)
+            except Exception as e:
+                errors.append(e)
+        return errors
+
+    def _resolve(self, futures: list[asyncio.Future], flush: asyncio.Future):
+        '''Passes the outcome of a flush on to each gamble that was part of it.'''
+
+        self._flushes.discard(flush)
+        errors = [flush.exception()] * len(futures) if flush.exception() is not None else flush.result()
+        for future, error in zip(futures, errors):
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(None)
+
+    def _shutdown(self):
+
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        for connector in self._connectors:
+            connector._connection.close()
+
+    def _backup(self, path: str, pages: int, pause: float) -> int:
+
+        connector = Connector(self._dbfile, read_only=True)
+        try:
+            return connector.backup(path, pages, pause)
+        finally:
+            connector._connection.close()
+
+    def _open(self, read_only: bool):
+        '''Thread initializer, giving each worker thread its own connection.'''
+
+        connector = Connector(self._dbfile, read_only=read_only, history=None if read_only else self._history)
+        connector._connection.execute('PRAGMA busy_timeout = 5000')
+        self._local.connector = connector
+        with self._connectors_lock:
+            self._connectors.append(connector)
+
+    def _enable_wal(self):
+
+        connector = self._local.connector
+        connector._prepare_new_file()
+        connector._connection.execute('PRAGMA journal_mode = WAL')
+
+    def _call(self, query: Callable[..., T], *args, **kwargs) -> T:
+
+        return query(self._local.connector, *args, **kwargs)
+
 if __name__ == "__main__":
     conn = Connector("gambadata.db")
+    conn.migrate('data')
     g = Gamble(1234, 1, 200, 400, 1)
     conn.save_gamble('data', g)
     conn.remove_last_gamble('data', 1234)
\ No newline at end of file
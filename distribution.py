@@ -0,0 +1,112 @@
+'''
+Streaming statistics of the per-hand net value of a player's sessions,
+updated one session at a time so they never need a rescan of the history.
+'''
+
+import math
+from array import array
+from bisect import bisect_left
+
+# Upper bounds of the histogram buckets, in gold per hand. The last bucket has no upper bound.
+HISTOGRAM_BOUNDS = (-150, -100, -75, -50, -25, 0, 25, 50, 75, 100, 150)
+
+class Distribution:
+    '''
+    Running statistics of a player's sessions, each session counting as
+    one observation of its net value per hand: Welford's mean and variance,
+    the best and worst sessions, winning and losing streaks, and a
+    fixed-bucket histogram. Sessions must be added in chronological order.
+    '''
+
+    __slots__ = ('sessions', 'mean', 'm2', 'minimum', 'maximum',
+        'streak', 'best_streak', 'worst_streak', 'last_timestamp', 'counts')
+
+    def __init__(self):
+
+        self.sessions = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        # Positive while on a winning streak, negative while on a losing one
+        self.streak = 0
+        self.best_streak = 0
+        self.worst_streak = 0
+        self.last_timestamp = 0.0
+        self.counts = array('q', bytes(8 * (len(HISTOGRAM_BOUNDS) + 1)))
+
+    def add(self, value: float, timestamp: float):
+        '''Adds a session worth `value` gold per hand, played at the unix time `timestamp`.'''
+
+        self.sessions += 1
+        delta = value - self.mean
+        self.mean += delta / self.sessions
+        self.m2 += delta * (value - self.mean)
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+
+        if value > 0:
+            self.streak = self.streak + 1 if self.streak > 0 else 1
+            self.best_streak = max(self.best_streak, self.streak)
+        elif value < 0:
+            self.streak = self.streak - 1 if self.streak < 0 else -1
+            self.worst_streak = max(self.worst_streak, -self.streak)
+        else:
+            self.streak = 0
+
+        self.last_timestamp = max(self.last_timestamp, timestamp)
+        self.counts[bisect_left(HISTOGRAM_BOUNDS, value)] += 1
+
+    @property
+    def variance(self) -> float:
+        '''Sample variance of the per-hand values, or 0 for less than two sessions.'''
+
+        return self.m2 / (self.sessions - 1) if self.sessions > 1 else 0.0
+
+    @property
+    def stdev(self) -> float:
+
+        return math.sqrt(self.variance)
+
+    def percentile(self, q: float) -> float:
+        '''
+        Estimates the `q` quantile of the per-hand values as the upper bound of
+        the bucket it falls in, clamped to the best and worst sessions.
+        '''
+
+        rank = q * self.sessions
+        seen = 0
+        for bound, count in zip(HISTOGRAM_BOUNDS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(max(bound, self.minimum), self.maximum)
+        return self.maximum
+
+    def to_row(self) -> tuple:
+        '''Gets the statistics as the columns stored in the database, after the guild and player.'''
+
+        return (self.sessions, self.mean, self.m2, self.minimum, self.maximum,
+            self.streak, self.best_streak, self.worst_streak, self.last_timestamp, self.counts.tobytes())
+
+    @classmethod
+    def from_row(cls, row: tuple) -> 'Distribution':
+        '''Rebuilds the statistics from the columns returned by `to_row`.'''
+
+        distribution = cls()
+        (distribution.sessions, distribution.mean, distribution.m2, distribution.minimum, distribution.maximum,
+            distribution.streak, distribution.best_streak, distribution.worst_streak,
+            distribution.last_timestamp, counts) = row
+        distribution.counts = array('q', counts)
+        return distribution
+
+    def __eq__(self, other: object) -> bool:
+
+        if not isinstance(other, Distribution):
+            return NotImplemented
+        return (self.sessions == other.sessions
+            and math.isclose(self.mean, other.mean, rel_tol=1e-9, abs_tol=1e-9)
+            and math.isclose(self.m2, other.m2, rel_tol=1e-9, abs_tol=1e-6)
+            and self.minimum == other.minimum and self.maximum == other.maximum
+            and self.streak == other.streak
+            and self.best_streak == other.best_streak and self.worst_streak == other.worst_streak
+            and self.last_timestamp == other.last_timestamp and self.counts == other.counts)
@@ -4,21 +4,32 @@ This module defines the general data structure and behaviour for Gambles.
 
 import time
 import json
+from array import array
+from collections import OrderedDict
+from functools import cache
+from typing import Iterable, Iterator
 from gw2_api import API, ItemType
+from perf import METRICS
 import logging
 import sys
 
+# Valuations kept by the process-wide valuation cache
+VALUE_CACHE_SIZE = 4096
+
 class Gamble:
     '''
     Represents the result of a gamble session.
     '''
+    __slots__ = ('timestamp', 'user', 'hands', 'gold', 'ectos', 'runes', 'guild')
+
     def __init__(self,
             user: str,
             hands: int = 0, 
             gold: int = 0, 
             ectos: int = 0,
             runes: int = 0,
-            timestamp: float | None = None):
+            timestamp: float | None = None,
+            guild: int = 0):
         '''
         Creates a new gamble session object with the given data.
 
@@ -28,6 +39,7 @@ class Gamble:
         - `ectos` - gross total ectos gained during the session.
         - `runes` - total number of superior runes of holding won.
         - `timestamp` - float, number of seconds in unix time.
+        - `guild` - id of the Discord server the gamble was recorded in.
         '''
         if timestamp is not None:
             self.timestamp = timestamp
@@ -38,23 +50,58 @@ class Gamble:
         self.gold = gold
         self.ectos = ectos
         self.runes = runes
-        self._value: tuple[float] | None = None
+        self.guild = guild
 
-    def get_value(self, api: API) -> tuple[float]:
-        '''Net total and average value of the gamble.'''
+    def get_value(self, api: API, historical: bool = False) -> tuple[float]:
+        '''
+        Net total and average value of the gamble.
+        If `historical` is true, the gamble is valued at the prices recorded
+        at its timestamp rather than at current prices. Either way, it is
+        valued through `value_at`, sharing values with other gambles.
+        '''
 
-        if self._value is not None:
-            return self._value
+        if historical:
+            ecto_value = api.get_item_value_at(ItemType.ectoplasm, self.timestamp)
+            rune_value = api.get_item_value_at(ItemType.rune, self.timestamp)
+        else:
+            ecto_value = api.get_item_value(ItemType.ectoplasm)
+            rune_value = api.get_item_value(ItemType.rune)
+        return self.value_at(ecto_value, rune_value)
+
+    async def get_value_async(self, api: API, historical: bool = False) -> tuple[float]:
+        '''Awaitable version of `get_value`, which never blocks the event loop on the API.'''
 
-        ecto_value = api.get_item_value(ItemType.ectoplasm)
-        rune_value = api.get_item_value(ItemType.rune)
+        if historical:
+            ecto_value = await api.get_item_value_at_async(ItemType.ectoplasm, self.timestamp)
+            rune_value = await api.get_item_value_at_async(ItemType.rune, self.timestamp)
+        else:
+            ecto_value = await api.get_item_value_async(ItemType.ectoplasm)
+            rune_value = await api.get_item_value_async(ItemType.rune)
+        return self.value_at(ecto_value, rune_value)
+
+    def value_at(self, ecto_value: float, rune_value: float) -> tuple[float]:
+        '''
+        Net total and average value of the gamble at given prices of ectos and
+        runes in gold, such as the current ones, those of a price snapshot, or
+        those every page of a leaderboard shares. Values are shared through
+        `VALUATIONS` by every gamble with the same totals valued at the same prices.
+        '''
+
+        key = (self.hands, self.gold, self.ectos, self.runes, ecto_value, rune_value)
+        value = VALUATIONS.get(key)
+        if value is None:
+            value = self._compute_value(ecto_value, rune_value)
+            VALUATIONS.put(key, value)
+        return value
+
+    def _compute_value(self, ecto_value: float, rune_value: float) -> tuple[float]:
+        '''Computes the value of the gamble given the prices of ectos and runes in gold.'''
 
         spent = self.hands*(100 + 250 * ecto_value)
         gained = self.gold + self.ectos * ecto_value + self.runes * rune_value
         value = gained - spent
 
-        self._value = (round(value, 2), round(value/self.hands, 2))
-        return self._value
+        return (round(value, 2), round(value/self.hands, 2))
 
     def __str__(self) -> str:
         '''Converts the Gamble data to a json string.'''
@@ -65,10 +112,144 @@ class Gamble:
             'hands':self.hands, 
             'gold':self.gold, 
             'ectos':self.ectos, 
-            'runes':self.runes
+            'runes':self.runes,
+            'guild':self.guild
         }
         return json.dumps(data_dict)
 
+class GambleBatch:
+    '''
+    Columnar set of gambles, holding each field in a compact typed array
+    instead of one `Gamble` object per row. Meant for bulk queries, where
+    most rows are only aggregated or exported.
+    '''
+    __slots__ = ('user', 'hands', 'gold', 'ectos', 'runes', 'timestamp')
+
+    def __init__(self, rows: Iterable[tuple] = ()):
+        '''
+        Creates a new batch from rows laid out like the arguments of `Gamble`:
+        user, hands, gold, ectos, runes and timestamp.
+        '''
+
+        self.user = array('q')
+        self.hands = array('q')
+        self.gold = array('q')
+        self.ectos = array('q')
+        self.runes = array('q')
+        self.timestamp = array('d')
+        self.extend(rows)
+
+    def extend(self, rows: Iterable[tuple]):
+        '''Appends rows to the end of the batch.'''
+
+        for user, hands, gold, ectos, runes, timestamp in rows:
+            self.user.append(user)
+            self.hands.append(hands)
+            self.gold.append(gold)
+            self.ectos.append(ectos)
+            self.runes.append(runes)
+            self.timestamp.append(timestamp)
+
+    def get_values(self, ecto_value: float, rune_value: float) -> tuple[array, array]:
+        '''
+        Net total and average value of every gamble in the batch, given the
+        prices of ectos and runes in gold. Unlike `Gamble.get_value`, the
+        values are not rounded. Computed with NumPy, over the whole columns at
+        once, or row by row if it is missing from the environment.
+        '''
+
+        numpy = _numpy()
+        if numpy is not None:
+            hands = numpy.frombuffer(self.hands, dtype=numpy.int64)
+            value = (numpy.frombuffer(self.gold, dtype=numpy.int64)
+                + numpy.frombuffer(self.ectos, dtype=numpy.int64) * ecto_value
+                + numpy.frombuffer(self.runes, dtype=numpy.int64) * rune_value
+                - hands * (100 + 250 * ecto_value))
+            return array('d', value.tobytes()), array('d', (value / hands).tobytes())
+
+        cost = 100 + 250 * ecto_value
+        totals = array('d', (gold + ectos * ecto_value + runes * rune_value - hands * cost
+            for hands, gold, ectos, runes in zip(self.hands, self.gold, self.ectos, self.runes)))
+        averages = array('d', (value / hands for value, hands in zip(totals, self.hands)))
+        return totals, averages
+
+    def __len__(self) -> int:
+
+        return len(self.hands)
+
+    def __getitem__(self, i: int) -> Gamble:
+
+        return Gamble(self.user[i], self.hands[i], self.gold[i], self.ectos[i], self.runes[i], self.timestamp[i])
+
+    def __iter__(self) -> Iterator[Gamble]:
+
+        for i in range(len(self)):
+            yield self[i]
+
+class ValueCache:
+    '''
+    Bounded LRU cache of the values of gambles, keyed on their hands, gold,
+    ectos and runes and on the prices they were valued at, so that values
+    stay right whichever prices, or `API` instance, they come from. Values at
+    prices that changed since are evicted as they fall out of use.
+    '''
+
+    def __init__(self, maxsize: int = VALUE_CACHE_SIZE):
+        '''
+        Creates a new cache.
+        - `maxsize` - number of values kept before evicting the least recently used one.
+        '''
+
+        self._maxsize = maxsize
+        self._entries: OrderedDict[tuple, tuple[float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> tuple[float] | None:
+        '''Gets the value stored for `key`, or None if there is none.'''
+
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            METRICS.increment('valuation_cache_total', result='miss')
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        METRICS.increment('valuation_cache_total', result='hit')
+        return value
+
+    def put(self, key: tuple, value: tuple[float]):
+        '''Stores the value of `key`, evicting the least recently used values past the size of the cache.'''
+
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        '''Removes every stored value.'''
+
+        self._entries.clear()
+
+    def __len__(self) -> int:
+
+        return len(self._entries)
+
+VALUATIONS = ValueCache()
+
+@cache
+def _numpy():
+    '''
+    Imports NumPy on first use, as it is slow to import and only bulk valuations
+    need it. Returns None if it isn't installed, even though it is required.
+    '''
+
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
 if __name__ == "__main__":
     logger = logging.Logger('testLogger', logging.DEBUG)
     handler = logging.StreamHandler(sys.stdout)
@@ -79,4 +260,4 @@ if __name__ == "__main__":
 
     api = API(logger)
     g = Gamble('silver', 1, 25, 300, 0)
-    print(g.get_value(api))
\ No newline at end of file
+    print(g.get_value(api))
@@ -6,18 +6,37 @@ decide to add more functionality or make my life harder for some
 reason.
 '''
 
-import requests
+import aiohttp
+import asyncio
+import sqlite3
+import os
+import random
+import threading
+from array import array
+from bisect import bisect_right
 from enum import Enum
 import time
 import logging
 import sys
+from perf import METRICS
 
 PRICE_URL = f"https://api.guildwars2.com/v2/commerce/prices/"
-API_LOGGER = logging.Logger('API', logging.DEBUG)
-API_LOGGER.setLevel(logging.DEBUG)
-handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
-handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-API_LOGGER.addHandler(handler)
+POOL_SIZE = 4
+REQUEST_TIMEOUT = 10
+# Prices older than this many cache timeouts have missed at least one refresh
+STALE_FACTOR = 2
+BREAKER_THRESHOLD = 5
+BACKOFF_BASE = 1
+BACKOFF_MAX = 300
+BREAKER_COOLDOWN = 600
+# Seconds before the last read of the price history from which snapshots of other processes are read
+# again, covering those taken before that read but written after it
+HISTORY_SYNC_MARGIN = 60
+# Written to the bot's log file once `logs.configure_logging` has been called
+API_LOGGER = logging.getLogger('API')
+
+class PriceUnavailableError(Exception):
+    '''Raised when an item has never been priced and the GW2 API can't be reached.'''
 
 class ItemType(Enum):
     '''Stores the API IDs of various items as integer values.'''
@@ -47,39 +66,501 @@ class ItemValue:
             self._update_value_from_api()
         return self._price/10000
 
+    @property
+    def cached_value(self) -> float:
+        '''
+        Gets the last known value of the item in gold, without contacting the API.
+        Raises a PriceUnavailableError if the item was never priced.
+        '''
+
+        if self._price is None:
+            raise PriceUnavailableError(f"No price is known for {self._item.name}.")
+        return self._price/10000
+
+    @property
+    def known(self) -> bool:
+        '''True if the item was priced at least once.'''
+
+        return self._price is not None
+
+    @property
+    def updated_at(self) -> float:
+        '''Unix time at which the price was read, or 0 if it never was.'''
+
+        return self._timestamp
+
+    @METRICS.timed('price_fetch_seconds', source='sync')
     def _update_value_from_api(self):
+        # Imported here as it is slow to import, and only the synchronous fallback needs it
+        import requests
+
         api_url = PRICE_URL + str(self._item.value)
-        API_LOGGER.debug(f'Getting data from {api_url}')
-        data = requests.get(api_url)
-        self._price = data.json()['sells']['unit_price']
-        self._timestamp = time.time()
+        API_LOGGER.debug('Getting data from %s', api_url)
+        data = requests.get(api_url, timeout=REQUEST_TIMEOUT)
+        data.raise_for_status()
+        self.set_price(data.json()['sells']['unit_price'])
+
+    @property
+    def expired(self) -> bool:
+        '''True if the cached price is missing or older than the cache timeout.'''
+
+        return self._price is None or time.time() - self._timestamp > self._cache_timeout
+
+    def set_price(self, price: int, timestamp: float | None = None):
+        '''
+        Stores a price in coppers, as given by the api, and resets the cache timer.
+        - `timestamp` - float, unix time in seconds at which the price was read. Leave empty to use the current time.
+        '''
+
+        self._price = price
+        self._timestamp = timestamp if timestamp is not None else time.time()
+
+class PriceHistory:
+    '''
+    Local store of price snapshots, kept in a small sqlite database and
+    mirrored in memory as sorted arrays, so that the price of an item at
+    any point in time can be found with a binary search. Several processes
+    may share the database, each reading the snapshots of the others with `sync`.
+    '''
+
+    def __init__(self, dbfile: str = 'prices.db'):
+        '''
+        Opens the price history stored in `dbfile`, creating the file if it
+        doesn't already exist, and loads every snapshot into memory.
+        '''
+
+        filepath = os.path.join(os.path.dirname(__file__), dbfile)
+        # Snapshots are written from a worker thread, so access is guarded by a lock instead
+        self._connection = sqlite3.connect(filepath, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._timestamps: dict[ItemType, array] = {item: array('d') for item in ItemType}
+        self._prices: dict[ItemType, array] = {item: array('q') for item in ItemType}
+
+        with self._connection:
+            self._connection.execute('''
+                CREATE TABLE IF NOT EXISTS prices(
+                    item INTEGER NOT NULL,
+                    timestamp REAL NOT NULL,
+                    price INTEGER NOT NULL,
+                    PRIMARY KEY (item, timestamp)) WITHOUT ROWID
+            ''')
+        known = {item.value: item for item in ItemType}
+        for item_id, timestamp, price in self._connection.execute(
+                'SELECT item, timestamp, price FROM prices ORDER BY item, timestamp'):
+            if item_id in known:
+                self._timestamps[known[item_id]].append(timestamp)
+                self._prices[known[item_id]].append(price)
+        self._synced_at = time.time()
+        self._data_version = self._connection.execute('PRAGMA data_version').fetchone()[0]
+
+    def record(self, prices: dict[ItemType, int], timestamp: float):
+        '''Stores a snapshot of the prices, in coppers, of several items taken at `timestamp`.'''
+
+        with self._lock:
+            with self._connection:
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO prices VALUES (?, ?, ?)',
+                    [(item.value, timestamp, price) for item, price in prices.items()])
+            for item, price in prices.items():
+                self._insert(item, timestamp, price)
+
+    def sync(self):
+        '''
+        Loads the snapshots written to the database by other processes since
+        the last call, so that every process values sessions at the same
+        snapshots as a rescan of the database would. Only reads the database
+        if another connection changed it since.
+        '''
+
+        known = {item.value: item for item in ItemType}
+        with self._lock:
+            version = self._connection.execute('PRAGMA data_version').fetchone()[0]
+            if version == self._data_version:
+                return
+            since = self._synced_at - HISTORY_SYNC_MARGIN
+            self._synced_at = time.time()
+            self._data_version = version
+            for item_id, timestamp, price in self._connection.execute(
+                    'SELECT item, timestamp, price FROM prices WHERE timestamp >= ?', (since,)):
+                if item_id in known:
+                    self._insert(known[item_id], timestamp, price)
+
+    def _insert(self, item: ItemType, timestamp: float, price: int):
+        '''Adds a snapshot to the arrays in memory, or replaces the one taken at the same time. The lock must be held.'''
+
+        timestamps = self._timestamps[item]
+        i = bisect_right(timestamps, timestamp)
+        if i > 0 and timestamps[i - 1] == timestamp:
+            self._prices[item][i - 1] = price
+        else:
+            timestamps.insert(i, timestamp)
+            self._prices[item].insert(i, price)
+
+    def price_at(self, item: ItemType, timestamp: float, oldest: bool = True) -> int | None:
+        '''
+        Gets the price of an item, in coppers, from the last snapshot taken
+        at or before `timestamp`. Times before the first snapshot get the
+        oldest known price, or None if `oldest` is false. Returns None if
+        there are no snapshots of the item.
+        '''
+
+        timestamps = self._timestamps[item]
+        i = bisect_right(timestamps, timestamp) - 1
+        if i < 0:
+            if not oldest or not timestamps:
+                return None
+            i = 0
+        return self._prices[item][i]
+
+    def prices_at(self, timestamp: float) -> dict[ItemType, int] | None:
+        '''
+        Gets the price of every item, in coppers, at `timestamp`, consistently
+        even while snapshots are recorded from another thread. Returns None if
+        any item had no snapshot yet at that time: unlike with `price_at`, the
+        oldest price isn't used instead, so that whether a session gets valued
+        doesn't depend on when it is.
+        '''
+
+        with self._lock:
+            prices = {item: self.price_at(item, timestamp, oldest=False) for item in ItemType}
+        return prices if None not in prices.values() else None
+
+    def latest(self, item: ItemType) -> tuple[float, int] | None:
+        '''Gets the time and price, in coppers, of the most recent snapshot of an item.'''
+
+        if not self._timestamps[item]:
+            return None
+        return self._timestamps[item][-1], self._prices[item][-1]
+
+    def close(self):
+
+        self._connection.close()
+
+class PriceClient:
+    '''
+    Asynchronous client for the commerce prices endpoint. A single
+    connection pool is kept alive for the lifetime of the client, and
+    prices for several items are fetched with one request.
+    '''
+
+    def __init__(self, base_url: str = PRICE_URL, pool_size: int = POOL_SIZE, timeout: float = REQUEST_TIMEOUT):
+        '''
+        Creates a new client.
+        - `base_url` - url of the prices endpoint. Point it at a local server for testing.
+        - `pool_size` - maximum number of pooled connections.
+        - `timeout` - total time allowed for a request, in seconds.
+        '''
+
+        self._url = base_url.rstrip('/')
+        self._pool_size = pool_size
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session: aiohttp.ClientSession | None = None
+
+    @METRICS.timed('price_fetch_seconds', source='batch')
+    async def fetch_prices(self, items: list[ItemType]) -> dict[ItemType, int]:
+        '''Gets the minimum sell price, in coppers, of all the given items in a single request.'''
+
+        ids = ','.join(str(item.value) for item in items)
+        API_LOGGER.debug('Getting data from %s?ids=%s', self._url, ids)
+        session = self._get_session()
+        async with session.get(self._url, params={'ids': ids}) as response:
+            response.raise_for_status()
+            data = await response.json()
+
+        by_id = {entry['id']: entry['sells']['unit_price'] for entry in data}
+        return {item: by_id[item.value] for item in items}
+
+    async def close(self):
+        '''Closes the connection pool.'''
+
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        '''Returns the pooled session, creating it on first use.'''
+
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self._timeout)
+        return self._session
+
+class CircuitBreaker:
+    '''
+    Spaces out calls to a failing service. Every consecutive failure delays
+    the next call exponentially, with some jitter. After `threshold`
+    consecutive failures the breaker opens, and no call is allowed for
+    `cooldown` seconds. A single success closes it again.
+    '''
+
+    def __init__(self,
+            threshold: int = BREAKER_THRESHOLD,
+            base_delay: float = BACKOFF_BASE,
+            max_delay: float = BACKOFF_MAX,
+            cooldown: float = BREAKER_COOLDOWN):
+
+        self._threshold = threshold
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._cooldown = cooldown
+        self.failures = 0
+        self._retry_at = 0.0
+
+    @property
+    def state(self) -> str:
+        '''`closed` while calls go through, `open` while they're blocked and `half-open` when a trial call is allowed.'''
+
+        if self.failures < self._threshold:
+            return 'closed'
+        return 'open' if time.time() < self._retry_at else 'half-open'
+
+    @property
+    def retry_in(self) -> float:
+        '''Seconds until the next call is allowed.'''
+
+        return max(0.0, self._retry_at - time.time())
+
+    def allow(self) -> bool:
+        '''True if a call may be made now.'''
+
+        return time.time() >= self._retry_at
+
+    def record_success(self):
+
+        self.failures = 0
+        self._retry_at = 0.0
+
+    def record_failure(self) -> float:
+        '''Counts a failed call, and returns the number of seconds until the next one is allowed.'''
+
+        self.failures += 1
+        if self.failures >= self._threshold:
+            delay = self._cooldown
+        else:
+            delay = min(self._max_delay, self._base_delay * 2 ** (self.failures - 1))
+            delay *= random.uniform(0.5, 1)
+        self._retry_at = time.time() + delay
+        return delay
 
 class API:
-    '''Manages the bot's requests to the GW2 API.'''
+    '''
+    Manages the bot's requests to the GW2 API. Prices are served from a cache,
+    and expired prices keep being served while a single background request
+    refreshes them. Failing requests are retried with an exponential backoff
+    behind a circuit breaker, and `stale` tells when prices couldn't be
+    refreshed for a while.
+    '''
 
-    def __init__(self, logger: logging.Logger = API_LOGGER, cache_minutes: int = 30):
+    def __init__(self,
+            logger: logging.Logger = API_LOGGER,
+            cache_minutes: int = 30,
+            base_url: str = PRICE_URL,
+            history: PriceHistory | None = None):
         '''
         Creates a new API link.
         - `cache_minutes` - time that the price of an
         item will be cached before re-querying the API.
+        - `base_url` - url of the prices endpoint used by the asynchronous client.
+        - `history` - store for price snapshots. When given, the cache starts
+        from the latest stored prices and every refresh is recorded in it.
         '''
 
         self._timeout = cache_minutes * 60
         self._cache: dict[ItemType, ItemValue] = {}
         self._logger = logger
+        self._client = PriceClient(base_url)
+        self._refresh_lock: asyncio.Lock | None = None
+        self._refresh_task: asyncio.Task | None = None
+        self._breaker = CircuitBreaker()
+        self._history = history
+        # Increased by every refresh, so that values computed from older prices can be told apart
+        self.epoch = 0
+
+        if history is not None:
+            for item in ItemType:
+                latest = history.latest(item)
+                if latest is not None:
+                    self._cache[item] = ItemValue(item, cache_timeout=self._timeout)
+                    self._cache[item].set_price(latest[1], timestamp=latest[0])
+
+    @property
+    def updated_at(self) -> float:
+        '''Unix time of the oldest cached price, or 0 if any item was never priced.'''
+
+        return min((self._cache[item].updated_at if item in self._cache else 0) for item in ItemType)
+
+    @property
+    def stale(self) -> bool:
+        '''True if the cached prices have missed at least one refresh, such as while the API is down.'''
+
+        return time.time() - self.updated_at > self._timeout * STALE_FACTOR
+
+    @property
+    def history(self) -> PriceHistory | None:
+        '''The store of price snapshots, if the API was given one.'''
+
+        return self._history
 
     def get_item_value(self, item: ItemType) -> float:
         '''
         Gets the value of an item from the Guild Wars 2 API.
         Returns the minmum sell value on the trading post, in gold.
+        If the request fails, the last known value is returned instead.
         '''
 
         if not item in self._cache:
             self._cache[item] = ItemValue(item, cache_timeout=self._timeout)
-        return self._cache[item].value
-    
+        value = self._cache[item]
+        if not value.expired:
+            METRICS.increment('price_cache_total', result='hit')
+            return value.cached_value
+
+        METRICS.increment('price_cache_total', result='miss')
+        if self._breaker.allow():
+            try:
+                value.value
+            except Exception:
+                self._record_failure()
+            else:
+                self._breaker.record_success()
+                self.epoch += 1
+        return value.cached_value
+
+    async def get_item_value_async(self, item: ItemType) -> float:
+        '''
+        Awaitable version of `get_item_value`, which never waits on the API
+        once a price is known: an expired price is served as is, while the
+        prices of all items are refreshed in the background with a single request.
+        Only waits for the API if the item was never priced, raising a
+        PriceUnavailableError if it can't be reached.
+        '''
+
+        if not item in self._cache:
+            self._cache[item] = ItemValue(item, cache_timeout=self._timeout)
+        value = self._cache[item]
+        if not value.expired:
+            METRICS.increment('price_cache_total', result='hit')
+        elif value.known:
+            METRICS.increment('price_cache_total', result='stale')
+            self.revalidate()
+        else:
+            METRICS.increment('price_cache_total', result='miss')
+            await self.refresh()
+        return value.cached_value
+
+    def get_item_value_at(self, item: ItemType, timestamp: float) -> float:
+        '''
+        Gets the value of an item in gold at the given unix time, from the
+        price history. Falls back to `get_item_value` if there is no history.
+        '''
+
+        price = self._history.price_at(item, timestamp) if self._history is not None else None
+        if price is None:
+            return self.get_item_value(item)
+        return price/10000
+
+    async def get_item_value_at_async(self, item: ItemType, timestamp: float) -> float:
+        '''Awaitable version of `get_item_value_at`, falling back to `get_item_value_async`.'''
+
+        price = self._history.price_at(item, timestamp) if self._history is not None else None
+        if price is None:
+            return await self.get_item_value_async(item)
+        return price/10000
+
+    async def poll(self, interval: float | None = None):
+        '''
+        Refreshes every price once per `interval` seconds, forever. Defaults to
+        the cache timeout, so that with a poller running users never wait on the API.
+        The first refresh is skipped if the prices were already fetched, such as
+        by a warm-up started at the same time.
+        After a failed refresh, the next one is tried as soon as the backoff allows.
+        '''
+
+        interval = interval if interval is not None else self._timeout
+        force = False
+        while True:
+            try:
+                await self.refresh(force=force)
+            except Exception:
+                self._logger.exception('Could not refresh prices')
+            force = True
+            await asyncio.sleep(self._breaker.retry_in if self._breaker.failures else interval)
+
+    def revalidate(self):
+        '''
+        Starts refreshing expired prices in the background and returns at once.
+        Does nothing if a refresh is already running, or if the API is backing off.
+        '''
+
+        if self._refresh_task is not None and not self._refresh_task.done():
+            return
+        if not self._breaker.allow():
+            return
+        self._refresh_task = asyncio.create_task(self.refresh())
+        self._refresh_task.add_done_callback(self._log_refresh_error)
+
+    async def refresh(self, force: bool = False):
+        '''
+        Fetches the prices of every `ItemType` in one batched request.
+        Concurrent callers wait for the refresh already in progress instead
+        of starting their own. Each refresh increases `epoch`, so results
+        computed from older prices can be told apart.
+        Failed requests are logged rather than raised, and no request is made
+        while the circuit breaker is open, so the cached prices are kept.
+        '''
+
+        if self._refresh_lock is None:
+            self._refresh_lock = asyncio.Lock()
+
+        async with self._refresh_lock:
+            for item in ItemType:
+                if not item in self._cache:
+                    self._cache[item] = ItemValue(item, cache_timeout=self._timeout)
+            if not force and not any(value.expired for value in self._cache.values()):
+                return
+            if not self._breaker.allow():
+                return
+
+            try:
+                prices = await self._client.fetch_prices(list(ItemType))
+            except Exception:
+                self._record_failure()
+                return
+            if self._breaker.failures:
+                self._logger.info('Prices refreshed, the GW2 API is reachable again')
+            self._breaker.record_success()
+            now = time.time()
+            for item, price in prices.items():
+                self._cache[item].set_price(price, timestamp=now)
+            self.epoch += 1
+            if self._history is not None:
+                await asyncio.to_thread(self._history.record, prices, now)
+
+    async def close(self):
+        '''Releases the connections held by the asynchronous client and the price history.'''
+
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+        await self._client.close()
+        if self._history is not None:
+            self._history.close()
+
+    def _record_failure(self):
+        '''Counts a failed request in the circuit breaker, and logs when the next one will be tried.'''
+
+        delay = self._breaker.record_failure()
+        METRICS.increment('price_fetch_failures_total')
+        self._logger.warning(
+            f'Could not refresh prices ({self._breaker.failures} failure(s) in a row, '
+            f'circuit {self._breaker.state}), retrying in {delay:.0f} s', exc_info=True)
+
+    def _log_refresh_error(self, task: asyncio.Task):
+
+        if not task.cancelled() and task.exception() is not None:
+            self._logger.error('Background price refresh failed', exc_info=task.exception())
+
 if __name__ == '__main__':
-    API_LOGGER.removeHandler(handler)
+    API_LOGGER.setLevel(logging.DEBUG)
     API_LOGGER.addHandler(logging.StreamHandler(sys.stdout))
     api = API()
     print(api.get_item_value(ItemType.ectoplasm))
@@ -0,0 +1,168 @@
+'''
+Logging setup of the bot. Records are handed over to a queue and written
+to a rotating log file by a background thread, so that the event loop
+never waits on the disk, and the debug records Discord's gateway emits
+for every event are sampled down before they cost anything more.
+'''
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import time
+from typing import Iterable, Mapping
+
+LOG_FILE = 'discord.log'
+LOG_FORMAT = '%(asctime)s:%(levelname)s:%(name)s: %(message)s'
+# Levels of the loggers unless configured otherwise. The empty name stands for every other logger.
+LOG_LEVELS = {'': 'WARNING', 'discord': 'DEBUG', 'API': 'DEBUG'}
+LOG_MAX_MB = 10
+LOG_ROTATE_HOURS = 24
+LOG_BACKUPS = 5
+# Loggers writing a debug record for every gateway event, of which one in `LOG_SAMPLE_EVERY` is kept
+SAMPLED_LOGGERS = ('discord.gateway', 'discord.state')
+LOG_SAMPLE_EVERY = 100
+
+_handler: logging.handlers.QueueHandler | None = None
+_listener: logging.handlers.QueueListener | None = None
+
+class SamplingFilter(logging.Filter):
+    '''
+    Keeps one in every `every` debug records of some loggers and of their
+    children, counted separately for each logger, and every other record.
+    '''
+
+    def __init__(self, loggers: Iterable[str], every: int):
+        '''
+        Creates the filter.
+        - `loggers` - names of the sampled loggers.
+        - `every` - one record in this many is kept. 1 keeps them all.
+        '''
+
+        super().__init__()
+        self._loggers = tuple(loggers)
+        self._prefixes = tuple(name + '.' for name in self._loggers)
+        self._every = every
+        self._seen: dict[str, int] = {}
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+
+        if record.levelno > logging.DEBUG or self._every <= 1:
+            return True
+        name = record.name
+        if name not in self._loggers and not name.startswith(self._prefixes):
+            return True
+        seen = self._seen.get(name, 0)
+        self._seen[name] = seen + 1
+        if seen % self._every == 0:
+            return True
+        self.dropped += 1
+        return False
+
+class RotatingHandler(logging.handlers.RotatingFileHandler):
+    '''
+    Appends to a log file, which is rotated once it would grow past `max_bytes`
+    or once it is `interval` seconds old, whichever comes first. Old files are
+    kept as numbered backups, as with `logging.handlers.RotatingFileHandler`.
+    '''
+
+    def __init__(self, filename: str, max_bytes: int, interval: float, backups: int):
+        '''
+        Creates the handler. The file is only opened by the first record.
+        - `max_bytes` - size past which the file is rotated. 0 never rotates it by size.
+        - `interval` - seconds after which the file is rotated. 0 never rotates it by age.
+        - `backups` - number of rotated files kept.
+        '''
+
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups, encoding='utf-8', delay=True)
+        self._interval = interval
+        # A file left by a previous run is as old as its last record
+        started = os.path.getmtime(filename) if os.path.exists(filename) else time.time()
+        self._rollover_at = started + interval if interval > 0 else None
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+
+        if self._rollover_at is not None and record.created >= self._rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+
+        super().doRollover()
+        if self._interval > 0:
+            self._rollover_at = time.time() + self._interval
+
+def parse_levels(levels: str) -> dict[str, str]:
+    '''
+    Parses comma-separated logger=LEVEL pairs, such as "discord=INFO,discord.http=WARNING".
+    A level without a logger name applies to every other logger.
+    '''
+
+    parsed = {}
+    for part in levels.split(','):
+        if not part.strip():
+            continue
+        name, _, level = part.rpartition('=')
+        level = level.strip().upper()
+        if not isinstance(logging.getLevelName(level), int):
+            raise ValueError(f"Unknown log level '{level}' for logger '{name.strip()}'.")
+        parsed[name.strip()] = level
+    return parsed
+
+def configure_logging(config: Mapping[str, str] | None = None) -> SamplingFilter:
+    '''
+    Sends the records of every logger through a queue to a rotating log file,
+    written by a background thread, replacing any previous configuration.
+    Returns the filter sampling the gateway's debug records.
+    Reads these optional keys of `config`, such as the values of a .env file:
+    - `LOG_FILE` - path of the log file.
+    - `LOG_LEVELS` - logger=LEVEL pairs, as read by `parse_levels`, overriding `LOG_LEVELS`.
+    - `LOG_MAX_MB` - size in megabytes past which the file is rotated.
+    - `LOG_ROTATE_HOURS` - age in hours after which the file is rotated.
+    - `LOG_BACKUPS` - number of rotated files kept.
+    - `LOG_SAMPLE_EVERY` - one gateway debug record in this many is kept.
+    '''
+
+    global _handler, _listener
+
+    config = config or {}
+    levels = {**LOG_LEVELS, **parse_levels(config.get('LOG_LEVELS') or '')}
+    stop_logging()
+
+    file_handler = RotatingHandler(
+        config.get('LOG_FILE') or LOG_FILE,
+        max_bytes=int(float(config.get('LOG_MAX_MB') or LOG_MAX_MB) * 1024 * 1024),
+        interval=float(config.get('LOG_ROTATE_HOURS') or LOG_ROTATE_HOURS) * 3600,
+        backups=int(config.get('LOG_BACKUPS') or LOG_BACKUPS))
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    # Filtered before being queued, so that dropped records are never formatted
+    sampler = SamplingFilter(SAMPLED_LOGGERS, int(config.get('LOG_SAMPLE_EVERY') or LOG_SAMPLE_EVERY))
+    records = queue.SimpleQueue()
+    _handler = logging.handlers.QueueHandler(records)
+    _handler.addFilter(sampler)
+    _listener = logging.handlers.QueueListener(records, file_handler)
+
+    for name, level in levels.items():
+        logging.getLogger(name or None).setLevel(level)
+    logging.getLogger().addHandler(_handler)
+    _listener.start()
+    return sampler
+
+def stop_logging():
+    '''Writes out the records still queued, then detaches and closes the handlers set up by `configure_logging`.'''
+
+    global _handler, _listener
+
+    if _handler is not None:
+        logging.getLogger().removeHandler(_handler)
+        _handler = None
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+atexit.register(stop_logging)
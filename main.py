@@ -1,56 +1,152 @@
+from perf import STARTUP
 import discord.types
-from bot import GambaBot, GambaModal, DATA_TABLE, GOLD_ICON
+from bot import GambaBot, GambaModal, LeaderboardView, GOLD_ICON, LEADERBOARD_SIZE, WINDOWS, TimeWindow, parse_window
 from gamble import Gamble
+from logs import configure_logging
+from maintenance import BACKUP_KEEP, MAINTENANCE_HOURS
 import discord
 import dotenv
+STARTUP.mark('imports')
 
-try:
-    CONFIG = dotenv.dotenv_values()
-    bot_token = CONFIG["BOT_TOKEN"]
-except KeyError:
-    raise RuntimeError("No bot token is set in the enviroment.")
+# Commands reach the bot through their context, so that they can be driven without a connection to Discord
+gamba = discord.SlashCommandGroup("gamba", "Send and receive gamble statistics from GambaBot")
+
+WindowOption = discord.Option(str, "Span of time to count gambles over.", choices=WINDOWS, default='all time')
+StartOption = discord.Option(str, "First day of a custom window, as YYYY-MM-DD.", required=False, default=None)
+EndOption = discord.Option(str, "Last day of a custom window, as YYYY-MM-DD. Defaults to today.", required=False, default=None)
+
+async def resolve_window(ctx: discord.ApplicationContext, window: str, start: str | None, end: str | None) -> TimeWindow | None:
+    """Gets the time window chosen in a command, or tells the user what's wrong with it and returns None."""
+
+    try:
+        return parse_window(window, start, end)
+    except ValueError as e:
+        await ctx.respond(str(e), ephemeral=True)
+        return None
 
-bot = GambaBot()
-gamba = bot.create_group("gamba", "Send and receive gamble statistics from GambaBot")
+async def respond_leaderboard(ctx: discord.ApplicationContext, winners: bool, window: TimeWindow):
+    """Responds with the first page of a leaderboard, with buttons to turn pages if there are more."""
+
+    bot: GambaBot = ctx.bot
+    page = await bot.leaderboard_page(n=LEADERBOARD_SIZE, winners=winners, guild=ctx.guild_id, window=window)
+    if not page.has_next:
+        await ctx.respond(embed=page.embed)
+        return
+    view = LeaderboardView(bot, page, LEADERBOARD_SIZE, winners, ctx.guild_id, window)
+    await ctx.respond(embed=page.embed, view=view)
 
 @gamba.command(description="Submits a new gamble to GambaBot.")
 async def record(ctx: discord.ApplicationContext, proof_image: discord.message.Attachment):
     """Submits a new gamble to GambaBot."""
     
-    await ctx.send_modal(GambaModal(bot, proof_image.url, title="Gambling Results"))
+    await ctx.send_modal(GambaModal(ctx.bot, proof_image.url, title="Gambling Results"))
 
 @gamba.command(description="Gets your overall statistics.")
-async def stats(ctx: discord.ApplicationContext):
+async def stats(ctx: discord.ApplicationContext, window: WindowOption, start: StartOption, end: EndOption):
+    time_window = await resolve_window(ctx, window, start, end)
+    if time_window is None:
+        return
+    bot: GambaBot = ctx.bot
     author = ctx.author
-    g = bot.get_user_stats(author)
-    embed = bot.create_gamble_embed(g, author, is_summary=True)
-    user_recent = bot._dbconn.recent_by_user(DATA_TABLE, author.id, 5)
+    g = await bot.get_user_stats(author, ctx.guild_id, time_window)
+    if not g.hands:
+        await ctx.respond(f"<@{author.id}> has no gambles recorded ({time_window.label}).")
+        return
+    embed = await bot.create_gamble_embed(g, author, is_summary=True)
+    embed.title = time_window.title(embed.title)
+    user_recent = await bot.get_recent_gambles(author, 5, ctx.guild_id)
+    # Each session is valued at the prices recorded when it was played
+    values = {recent: await recent.get_value_async(bot._api, historical=True) for recent in user_recent}
     def func(g: Gamble) -> str:
-        value = g.get_value(bot._api)
+        value = values[g]
         state = 'winning' if value[0] > 0 else 'losing'
         plural = '' if g.hands == 1 else 's'
         return f'<t:{int(g.timestamp)}> - gambled {g.hands} time{plural}, {state} a total of {value[0]} {GOLD_ICON}'
     embed = bot._add_list_of_gambles(embed, user_recent, 'Recent activity:', func)
     await ctx.respond(embed=embed)
 
-@gamba.command(description="Gets the leaderboard for top winners.")
-async def winners(ctx: discord.ApplicationContext):
-    embed = bot.create_leaderboard(n = 5, winners=True)
+@gamba.command(description="Shows how your sessions are distributed: spread, best and worst sessions, streaks.")
+async def distribution(ctx: discord.ApplicationContext):
+    embed = await ctx.bot.create_distribution_embed(ctx.author, ctx.guild_id)
+    if embed is None:
+        await ctx.respond(f"<@{ctx.author.id}> has no gambles recorded.")
+        return
     await ctx.respond(embed=embed)
 
-@gamba.command(description="Gets the leaderboard for top losers.")
-async def losers(ctx: discord.ApplicationContext):
-    embed = bot.create_leaderboard(n = 5, winners=False)
+@gamba.command(description="Shows your place among the players of this server, and who is ranked around you.")
+async def rank(ctx: discord.ApplicationContext,
+        by: discord.Option(str, "Rank players by total value or by value per hand.",
+            choices=['total', 'average'], default='total')):
+    embed = await ctx.bot.create_rank_embed(ctx.author, ctx.guild_id, by_average=by == 'average')
+    if embed is None:
+        await ctx.respond(f"<@{ctx.author.id}> has no gambles recorded.")
+        return
     await ctx.respond(embed=embed)
 
+@gamba.command(description="Gets the leaderboard for top winners.")
+async def winners(ctx: discord.ApplicationContext, window: WindowOption, start: StartOption, end: EndOption):
+    time_window = await resolve_window(ctx, window, start, end)
+    if time_window is None:
+        return
+    await respond_leaderboard(ctx, True, time_window)
+
+@gamba.command(description="Gets the leaderboard for top losers.")
+async def losers(ctx: discord.ApplicationContext, window: WindowOption, start: StartOption, end: EndOption):
+    time_window = await resolve_window(ctx, window, start, end)
+    if time_window is None:
+        return
+    await respond_leaderboard(ctx, False, time_window)
+
 @gamba.command(description="Gets total stats for Gamba-Bot.")
-async def total(ctx: discord.ApplicationContext):
-    embed = bot.get_total_stats()
+async def total(ctx: discord.ApplicationContext, window: WindowOption, start: StartOption, end: EndOption):
+    time_window = await resolve_window(ctx, window, start, end)
+    if time_window is None:
+        return
+    embed = await ctx.bot.get_total_stats(ctx.guild_id, time_window)
     await ctx.respond(embed=embed)
 
 @gamba.command(description="Deletes your most recent gamble.")
 async def delete(ctx: discord.ApplicationContext):
-    bot.delete_gamble(ctx.author)
+    if not await ctx.bot.delete_gamble(ctx.author, ctx.guild_id):
+        await ctx.respond(f"<@{ctx.author.id}> has nothing left to delete (older gambles are archived).")
+        return
     await ctx.respond(f"<@{ctx.author.id}>'s most recent entry has been deleted.")
 
-bot.run(bot_token)
+@gamba.command(description="Shows performance statistics. Only available to the bot owner.")
+async def perf(ctx: discord.ApplicationContext):
+    bot: GambaBot = ctx.bot
+    if not await bot.is_owner(ctx.author):
+        await ctx.respond("Only the bot owner can use this command.", ephemeral=True)
+        return
+    await ctx.respond(embed=bot.create_perf_embed(), ephemeral=True)
+
+def create_bot(config: dict) -> GambaBot:
+    """Creates the bot with the /gamba commands, configured by the values of a .env file."""
+
+    # Logs are written by a background thread, to a file rotated by size and age
+    configure_logging(config)
+    # Several processes can share the shards with SHARD_COUNT and a comma-separated SHARD_IDS
+    shards = {}
+    if config.get("SHARD_COUNT"):
+        shards["shard_count"] = int(config["SHARD_COUNT"])
+        if config.get("SHARD_IDS"):
+            shards["shard_ids"] = [int(i) for i in config["SHARD_IDS"].split(",")]
+    STARTUP.mark('config')
+
+    bot = GambaBot(
+        write_behind=config.get("WRITE_BEHIND", "").lower() in ("1", "true", "yes"),
+        metrics_file=config.get("METRICS_FILE"),
+        # Backups are only taken, and old gambles only archived, when BACKUP_DIR and ARCHIVE_DAYS are set
+        maintenance_hours=float(config.get("MAINTENANCE_HOURS") or MAINTENANCE_HOURS),
+        backup_dir=config.get("BACKUP_DIR") or None,
+        backup_keep=int(config.get("BACKUP_KEEP") or BACKUP_KEEP),
+        archive_days=float(config.get("ARCHIVE_DAYS") or 0),
+        **shards)
+    bot.add_application_command(gamba)
+    return bot
+
+if __name__ == "__main__":
+    CONFIG = dotenv.dotenv_values()
+    if "BOT_TOKEN" not in CONFIG:
+        raise RuntimeError("No bot token is set in the enviroment.")
+    create_bot(CONFIG).run(CONFIG["BOT_TOKEN"])
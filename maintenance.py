@@ -0,0 +1,125 @@
+'''
+Scheduled upkeep of the gambling database while the bot runs: online
+backups, archival of old gambles into rollups, releasing the space they
+leave, and fresh statistics for the query planner. Every step is split
+into short jobs, so that commands never wait long behind it.
+'''
+
+import asyncio
+import glob
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import NamedTuple
+from connector import AsyncConnector, Connector, DAY_SECONDS
+
+MAINTENANCE_HOURS = 24
+BACKUP_KEEP = 7
+
+class MaintenanceReport(NamedTuple):
+    '''What one maintenance run did.'''
+
+    backup: str | None
+    archived: int
+    released_pages: int
+    seconds: float
+
+def backup_path(folder: str, dbfile: str, now: float | None = None) -> str:
+    '''Path of a backup of `dbfile` taken at the unix time `now` in `folder`, named so that backups sort by age.'''
+
+    name = os.path.splitext(os.path.basename(dbfile))[0]
+    stamp = datetime.fromtimestamp(now if now is not None else time.time(), timezone.utc).strftime('%Y%m%d-%H%M%S')
+    return os.path.join(folder, f'{name}-{stamp}.db')
+
+def prune_backups(folder: str, dbfile: str, keep: int) -> list[str]:
+    '''
+    Deletes all but the `keep` most recent backups of `dbfile` in `folder`,
+    and returns the paths deleted. A `keep` of 0 keeps every backup.
+    '''
+
+    if keep <= 0:
+        return []
+    name = os.path.splitext(os.path.basename(dbfile))[0]
+    backups = sorted(glob.glob(os.path.join(glob.escape(folder), f'{glob.escape(name)}-*.db')))
+    removed = backups[:-keep]
+    for path in removed:
+        os.remove(path)
+    return removed
+
+class Maintenance:
+    '''
+    Periodic upkeep of the database of a running bot. Backups are copied in
+    page steps from a connection of their own, while archival and compaction
+    run on the writer thread as a series of short transactions, between
+    which the bot's own writes go through.
+    '''
+
+    def __init__(self,
+            db: AsyncConnector,
+            table: str,
+            interval_hours: float = MAINTENANCE_HOURS,
+            backup_dir: str | None = None,
+            backup_keep: int = BACKUP_KEEP,
+            archive_days: float = 0,
+            logger: logging.Logger | None = None):
+        '''
+        Prepares the upkeep of a table, which starts with `run_periodically`.
+        - `interval_hours` - time between two runs.
+        - `backup_dir` - folder backups are written to. Leave empty to take no backups.
+        - `backup_keep` - number of backups kept, the oldest being deleted first. 0 keeps them all.
+        - `archive_days` - age in days past which gambles are archived. 0 never archives them.
+        '''
+
+        self._db = db
+        self._table = table
+        self._interval = interval_hours * 3600
+        self._backup_dir = backup_dir
+        self._backup_keep = backup_keep
+        self._archive_days = archive_days
+        self._logger = logger if logger is not None else logging.getLogger('discord')
+
+    async def run(self) -> MaintenanceReport:
+        '''
+        Backs the database up, then archives old gambles, releases the free
+        pages of the file and refreshes the query planner's statistics.
+        The backup comes first, so that it still holds the archived rows.
+        '''
+
+        start = time.perf_counter()
+        path = None
+        if self._backup_dir is not None:
+            os.makedirs(self._backup_dir, exist_ok=True)
+            path = backup_path(self._backup_dir, self._db.dbfile)
+            await self._db.backup(path)
+            prune_backups(self._backup_dir, self._db.dbfile, self._backup_keep)
+
+        archived = 0
+        if self._archive_days > 0:
+            before = time.time() - self._archive_days * DAY_SECONDS
+            while count := await self._db.write(Connector.archive_gambles, self._table, before):
+                archived += count
+
+        released = 0
+        if await self._db.read(Connector.incremental_vacuum):
+            while pages := await self._db.write(Connector.compact):
+                released += pages
+        else:
+            self._logger.warning('The database file was created without incremental vacuum, so free pages are '
+                "never released. Stop the bot and run 'manage.py compact --full' once to switch it over.")
+        await self._db.write(Connector.analyze)
+        return MaintenanceReport(path, archived, released, time.perf_counter() - start)
+
+    async def run_periodically(self):
+        '''Runs the upkeep once per interval, forever, starting at once. Failed runs are logged and tried again next time.'''
+
+        while True:
+            try:
+                report = await self.run()
+            except Exception:
+                self._logger.exception('Database maintenance failed')
+            else:
+                backup = f'backed up to {report.backup}, ' if report.backup is not None else ''
+                self._logger.info(f'Database maintenance took {report.seconds:.1f} s: {backup}'
+                    f'archived {report.archived} gamble(s), released {report.released_pages} page(s)')
+            await asyncio.sleep(self._interval)
@@ -0,0 +1,175 @@
+'''
+Maintenance commands for the gambling database, meant to be run
+from a shell alongside `main.py`.
+'''
+
+import argparse
+import sys
+import time
+from connector import Connector, DAY_SECONDS
+from bot import DATA_TABLE
+from gw2_api import PriceHistory
+import transfer
+
+def migrate(conn: Connector, args: argparse.Namespace):
+    '''Upgrades the database to the latest schema version.'''
+
+    before, after = conn.migrate(args.table)
+    if before == after:
+        print(f"Database is already at schema version {after}.")
+        return
+    print(f"Upgraded database from schema version {before} to {after}.")
+
+def verify_totals(conn: Connector, args: argparse.Namespace):
+    '''Reports players whose running totals don't match their raw rows.'''
+
+    drifted = conn.verify_totals(args.table)
+    if not drifted:
+        print("All player totals are consistent.")
+        return
+    players = ', '.join(f"{player} (guild {guild})" for guild, player in drifted)
+    print(f"{len(drifted)} player(s) have drifted totals: {players}")
+
+def rebuild_totals(conn: Connector, args: argparse.Namespace):
+    '''Rebuilds all running totals from the raw rows.'''
+
+    repaired = conn.rebuild_totals(args.table)
+    print(f"Rebuilt player totals, repairing {repaired} player(s).")
+
+def verify_stats(conn: Connector, args: argparse.Namespace):
+    '''Reports players whose distribution statistics don't match a full rescan of their raw rows.'''
+
+    drifted = conn.verify_distributions(args.table)
+    if not drifted:
+        print("All distribution statistics are consistent.")
+        return
+    players = ', '.join(f"{player} (guild {guild})" for guild, player in drifted)
+    print(f"{len(drifted)} player(s) have drifted statistics: {players}")
+
+def rebuild_stats(conn: Connector, args: argparse.Namespace):
+    '''Rebuilds all distribution statistics with a full rescan of the raw rows.'''
+
+    repaired = conn.rebuild_distributions(args.table)
+    print(f"Rebuilt distribution statistics, repairing {repaired} player(s).")
+
+def move_guild(conn: Connector, args: argparse.Namespace):
+    '''Moves gambles from one guild to another, such as those recorded before guilds were tracked.'''
+
+    moved = conn.move_guild(args.table, args.source, args.target)
+    print(f"Moved {moved} gamble(s) from guild {args.source} to guild {args.target}.")
+
+def export_gambles(conn: Connector, args: argparse.Namespace):
+    '''Writes every gamble to a CSV or JSON Lines file, or to the standard output.'''
+
+    fmt = args.format or transfer.detect_format(args.file)
+    conn.migrate(args.table)
+    if args.file == '-':
+        count = transfer.export_gambles(conn, args.table, sys.stdout, fmt, args.guild)
+    else:
+        with open(args.file, 'w', encoding='utf-8', newline='') as file:
+            count = transfer.export_gambles(conn, args.table, file, fmt, args.guild)
+    print(f"Exported {count} gamble(s).", file=sys.stderr)
+
+def import_gambles(conn: Connector, args: argparse.Namespace):
+    '''Saves the gambles of a CSV or JSON Lines file, or of the standard input, skipping those already recorded.'''
+
+    fmt = args.format or transfer.detect_format(args.file)
+    conn.migrate(args.table)
+    if args.file == '-':
+        report = transfer.import_gambles(conn, args.table, sys.stdin, fmt, args.guild)
+    else:
+        with open(args.file, encoding='utf-8', newline='') as file:
+            report = transfer.import_gambles(conn, args.table, file, fmt, args.guild)
+    print(f"Imported {report.imported} gamble(s), skipped {report.duplicates} duplicate(s) "
+        f"and {report.invalid} invalid record(s).")
+    for error in report.errors:
+        print(f"  {error}")
+
+def backup(conn: Connector, args: argparse.Namespace):
+    '''Copies the database to a file while the bot keeps using it.'''
+
+    pages = conn.backup(args.file)
+    print(f"Backed up {pages} page(s) to {args.file}.")
+
+def archive(conn: Connector, args: argparse.Namespace):
+    '''Archives gambles older than a number of days into per-player daily rollups, leaving every total unchanged.'''
+
+    conn.migrate(args.table)
+    before = time.time() - args.days * DAY_SECONDS
+    archived = 0
+    while count := conn.archive_gambles(args.table, before):
+        archived += count
+    print(f"Archived {archived} gamble(s).")
+
+def compact(conn: Connector, args: argparse.Namespace):
+    '''Releases the free pages of the database file and refreshes the query planner's statistics.'''
+
+    if args.full:
+        conn.vacuum()
+        print("Rebuilt the database file, which now releases free pages incrementally.")
+    elif not conn.incremental_vacuum():
+        print("The database file was created without incremental vacuum, so no page can be released. "
+            "Run this command with --full once, while the bot is stopped, to switch it over.")
+    else:
+        released = 0
+        while pages := conn.compact():
+            released += pages
+        print(f"Released {released} free page(s).")
+    conn.analyze()
+
+def build_parser() -> argparse.ArgumentParser:
+
+    parser = argparse.ArgumentParser(description="Maintenance commands for Gamba-Bot's database.")
+    parser.add_argument('--db', default='gambadata.db', help="sqlite database file.")
+    parser.add_argument('--table', default=DATA_TABLE, help="table holding the gambles.")
+    parser.add_argument('--prices', default='prices.db', help="sqlite database holding the price history.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('migrate', help=migrate.__doc__).set_defaults(func=migrate)
+    commands.add_parser('verify-totals', help=verify_totals.__doc__).set_defaults(func=verify_totals)
+    commands.add_parser('rebuild-totals', help=rebuild_totals.__doc__).set_defaults(func=rebuild_totals)
+    commands.add_parser('verify-stats', help=verify_stats.__doc__).set_defaults(func=verify_stats)
+    commands.add_parser('rebuild-stats', help=rebuild_stats.__doc__).set_defaults(func=rebuild_stats)
+
+    move = commands.add_parser('move-guild', help=move_guild.__doc__)
+    move.add_argument('target', type=int, help="id of the guild receiving the gambles.")
+    move.add_argument('--source', type=int, default=0,
+        help="id of the guild the gambles are taken from. Defaults to gambles recorded before guilds were tracked.")
+    move.set_defaults(func=move_guild)
+
+    copy = commands.add_parser('backup', help=backup.__doc__)
+    copy.add_argument('file', help="file to write the backup to.")
+    copy.set_defaults(func=backup)
+
+    old = commands.add_parser('archive', help=archive.__doc__)
+    old.add_argument('days', type=float, help="age in days past which gambles are archived.")
+    old.set_defaults(func=archive)
+
+    shrink = commands.add_parser('compact', help=compact.__doc__)
+    shrink.add_argument('--full', action='store_true',
+        help="rebuild the whole file instead, which blocks the bot until done. Needed once for databases "
+            "created before incremental vacuum was enabled.")
+    shrink.set_defaults(func=compact)
+
+    export = commands.add_parser('export', help=export_gambles.__doc__)
+    export.add_argument('file', help="file to write, or - for the standard output.")
+    export.add_argument('--format', choices=transfer.FORMATS, help="defaults to the extension of the file.")
+    export.add_argument('--guild', type=int, help="only export the gambles recorded in this guild.")
+    export.set_defaults(func=export_gambles)
+
+    load = commands.add_parser('import', help=import_gambles.__doc__)
+    load.add_argument('file', help="file to read, or - for the standard input.")
+    load.add_argument('--format', choices=transfer.FORMATS, help="defaults to the extension of the file.")
+    load.add_argument('--guild', type=int, default=0,
+        help="guild of the records that don't name one. Defaults to gambles recorded before guilds were tracked.")
+    load.set_defaults(func=import_gambles)
+
+    return parser
+
+if __name__ == '__main__':
+    parser = build_parser()
+    args = parser.parse_args()
+    try:
+        args.func(Connector(args.db, history=PriceHistory(args.prices)), args)
+    except ValueError as e:
+        parser.error(str(e))
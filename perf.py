@@ -0,0 +1,214 @@
+'''
+Lightweight in-memory performance metrics: latency histograms and
+counters that can be recorded from any thread, summarized for the
+`/gamba perf` command or exported in the Prometheus text format.
+'''
+
+import asyncio
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Iterator
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRIC_PREFIX = 'gamba_'
+
+Labels = tuple[tuple[str, str], ...]
+
+class Histogram:
+    '''Fixed-bucket histogram of durations in seconds.'''
+
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def percentile(self, q: float) -> float:
+        '''
+        Estimates the `q` quantile as the upper bound of the bucket it falls in.
+        Returns infinity if it falls past the last bucket.
+        '''
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+class Metrics:
+    '''Registry of named histograms and counters, each optionally split by labels.'''
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        self.histograms: dict[tuple[str, Labels], Histogram] = {}
+        self.counters: dict[tuple[str, Labels], int] = {}
+        self.started = time.time()
+
+    def observe(self, name: str, seconds: float, **labels: str):
+        '''Records a duration, in seconds, in the histogram `name`.'''
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name: str, amount: int = 1, **labels: str):
+        '''Increases the counter `name`.'''
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        '''Context manager recording the time spent inside it in the histogram `name`.'''
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name: str, **labels: str) -> Callable:
+        '''Decorator recording the duration of every call of a function or coroutine function.'''
+
+        def decorator(f):
+            if asyncio.iscoroutinefunction(f):
+                @wraps(f)
+                async def async_wrapper(*args, **kwargs):
+                    with self.timer(name, **labels):
+                        return await f(*args, **kwargs)
+                return async_wrapper
+
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return f(*args, **kwargs)
+            return wrapper
+
+        return decorator
+
+    def snapshot(self) -> tuple[dict[tuple[str, Labels], Histogram], dict[tuple[str, Labels], int]]:
+        '''Gets consistent copies of every histogram and counter, safe to read while new values are recorded.'''
+
+        with self._lock:
+            histograms = {}
+            for key, histogram in self.histograms.items():
+                copy = histograms[key] = Histogram()
+                copy.counts, copy.count, copy.sum = list(histogram.counts), histogram.count, histogram.sum
+            return histograms, dict(self.counters)
+
+    def reset(self):
+        '''Discards every recorded value.'''
+
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.started = time.time()
+
+    def to_prometheus(self) -> str:
+        '''Renders every metric in the Prometheus text exposition format.'''
+
+        histograms, counters = self.snapshot()
+
+        lines = []
+        for name in sorted({name for name, _ in histograms}):
+            metric = METRIC_PREFIX + name
+            lines.append(f'# TYPE {metric} histogram')
+            for (other, labels), histogram in sorted(histograms.items()):
+                if other != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(BUCKETS, histogram.counts):
+                    cumulative += bucket
+                    lines.append(f'{metric}_bucket{_format_labels(labels, le=str(bound))} {cumulative}')
+                lines.append(f'{metric}_bucket{_format_labels(labels, le="+Inf")} {histogram.count}')
+                lines.append(f'{metric}_sum{_format_labels(labels)} {histogram.sum}')
+                lines.append(f'{metric}_count{_format_labels(labels)} {histogram.count}')
+
+        for name in sorted({name for name, _ in counters}):
+            metric = METRIC_PREFIX + name
+            lines.append(f'# TYPE {metric} counter')
+            for (other, labels), value in sorted(counters.items()):
+                if other == name:
+                    lines.append(f'{metric}{_format_labels(labels)} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        '''Writes every metric to a Prometheus text file, replacing it atomically.'''
+
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as file:
+            file.write(self.to_prometheus())
+        os.replace(temporary, path)
+
+    async def export_periodically(self, path: str, interval: float = 60):
+        '''Writes the Prometheus text file every `interval` seconds, forever, off the event loop.'''
+
+        while True:
+            await asyncio.to_thread(self.write_prometheus, path)
+            await asyncio.sleep(interval)
+
+class StartupReport:
+    '''
+    Durations of the phases of the bot's startup, in the order they ran.
+    Each phase lasts from the end of the previous one, or from the import
+    of this module for the first, until it is marked.
+    '''
+
+    def __init__(self):
+
+        self.started = time.perf_counter()
+        self.phases: list[tuple[str, float]] = []
+        self._last = self.started
+
+    def mark(self, phase: str):
+        '''Ends the phase named `phase`, recording its duration.'''
+
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    @property
+    def total(self) -> float:
+        '''Seconds from the start of the first phase to the end of the last one.'''
+
+        return self._last - self.started
+
+    def report(self) -> str:
+        '''Formats the phases and their durations as a table, one phase per line.'''
+
+        lines = [f"{phase:16} {seconds * 1000:9.1f} ms" for phase, seconds in self.phases]
+        lines.append(f"{'total':16} {self.total * 1000:9.1f} ms")
+        return '\n'.join(lines)
+
+def _format_labels(labels: Labels, **extra: str) -> str:
+
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+# Process-wide registry used by the bot's modules
+METRICS = Metrics()
+# Phases of the startup of this process, marked by `main` and the bot
+STARTUP = StartupReport()
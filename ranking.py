@@ -0,0 +1,188 @@
+'''
+Order-statistic indexes of the players of a guild, answering "what place
+am I?" in logarithmic time instead of ranking every player per request.
+'''
+
+from bisect import bisect_left, insort
+from typing import Iterable
+from gamble import Gamble, GambleBatch
+
+# Target length of the sublists of a SortedKeyList
+SUBLIST_SIZE = 512
+
+class SortedKeyList:
+    '''
+    Sorted list of unique keys, split in sublists of about `SUBLIST_SIZE`
+    keys. A Fenwick tree over the sublist lengths finds the position of a
+    key, or the key at a position, in logarithmic time, while insertions
+    and removals only shift the keys of one short sublist.
+    '''
+
+    def __init__(self, keys: Iterable = ()):
+
+        keys = sorted(keys)
+        self._lists = [keys[i:i + SUBLIST_SIZE] for i in range(0, len(keys), SUBLIST_SIZE)]
+        self._maxes = [sublist[-1] for sublist in self._lists]
+        self._len = len(keys)
+        self._build_tree()
+
+    def add(self, key):
+
+        if not self._lists:
+            self._lists.append([key])
+            self._maxes.append(key)
+            self._len = 1
+            self._build_tree()
+            return
+
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            i -= 1
+            self._lists[i].append(key)
+            self._maxes[i] = key
+        else:
+            insort(self._lists[i], key)
+        self._len += 1
+
+        sublist = self._lists[i]
+        if len(sublist) > 2 * SUBLIST_SIZE:
+            self._lists[i:i + 1] = [sublist[:SUBLIST_SIZE], sublist[SUBLIST_SIZE:]]
+            self._maxes[i:i + 1] = [sublist[SUBLIST_SIZE - 1], sublist[-1]]
+            self._build_tree()
+        else:
+            self._tree_add(i, 1)
+
+    def remove(self, key):
+        '''Removes a key, raising a KeyError if it isn't in the list.'''
+
+        i = bisect_left(self._maxes, key)
+        sublist = self._lists[i] if i < len(self._lists) else []
+        j = bisect_left(sublist, key)
+        if j == len(sublist) or sublist[j] != key:
+            raise KeyError(key)
+
+        del sublist[j]
+        self._len -= 1
+        if not sublist:
+            del self._lists[i]
+            del self._maxes[i]
+            self._build_tree()
+        else:
+            self._maxes[i] = sublist[-1]
+            self._tree_add(i, -1)
+
+    def index(self, key) -> int:
+        '''Gets the number of keys lower than `key`, which is its position if it is in the list.'''
+
+        i = bisect_left(self._maxes, key)
+        if i == len(self._lists):
+            return self._len
+        return self._tree_prefix(i) + bisect_left(self._lists[i], key)
+
+    def __getitem__(self, position: int):
+
+        if not 0 <= position < self._len:
+            raise IndexError(position)
+        i, offset = self._tree_find(position)
+        return self._lists[i][offset]
+
+    def __len__(self) -> int:
+
+        return self._len
+
+    def _build_tree(self):
+
+        self._tree = [len(sublist) for sublist in self._lists]
+        for i in range(len(self._tree)):
+            parent = i | (i + 1)
+            if parent < len(self._tree):
+                self._tree[parent] += self._tree[i]
+
+    def _tree_add(self, i: int, delta: int):
+
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i |= i + 1
+
+    def _tree_prefix(self, i: int) -> int:
+        '''Total length of the sublists before sublist `i`.'''
+
+        total = 0
+        while i > 0:
+            total += self._tree[i - 1]
+            i &= i - 1
+        return total
+
+    def _tree_find(self, position: int) -> tuple[int, int]:
+        '''Gets the sublist holding the key at `position`, and the key's offset within it.'''
+
+        i = 0
+        step = 1 << len(self._tree).bit_length()
+        while step:
+            if i + step <= len(self._tree) and self._tree[i + step - 1] <= position:
+                i += step
+                position -= self._tree[i - 1]
+            step >>= 1
+        return i, position
+
+class RankIndex:
+    '''
+    Ranks of every player of a guild by total net value and by net value per
+    hand, at fixed prices, in the order of `Connector.leaderboard`: highest
+    value first, ties broken by player id. Rebuild it when prices change.
+    '''
+
+    def __init__(self, totals: GambleBatch, ecto_value: float, rune_value: float):
+        '''
+        Builds the index in bulk.
+        - `totals` - totals of every player of the guild.
+        - `ecto_value`, `rune_value` - prices of ectos and runes in gold.
+        '''
+
+        self.ecto_value = ecto_value
+        self.rune_value = rune_value
+        self._keys: dict[int, tuple[tuple[float, int], tuple[float, int]]] = {}
+        values, averages = totals.get_values(ecto_value, rune_value)
+        for player, value, average in zip(totals.user, values, averages):
+            # Keys sort ascending, so values are negated to put the biggest winner first
+            self._keys[player] = ((-round(value, 2), player), (-round(average, 2), player))
+        self._by_total = SortedKeyList(keys[0] for keys in self._keys.values())
+        self._by_average = SortedKeyList(keys[1] for keys in self._keys.values())
+
+    def update(self, player: int, totals: Gamble | None):
+        '''Replaces the totals of a player, or removes the player if `totals` is None.'''
+
+        keys = self._keys.pop(player, None)
+        if keys is not None:
+            self._by_total.remove(keys[0])
+            self._by_average.remove(keys[1])
+        if totals is None:
+            return
+
+        value, average = totals._compute_value(self.ecto_value, self.rune_value)
+        keys = self._keys[player] = ((-value, player), (-average, player))
+        self._by_total.add(keys[0])
+        self._by_average.add(keys[1])
+
+    def position(self, player: int, by_average: bool = False) -> int | None:
+        '''Gets the 1-based rank of a player, or None if they aren't ranked.'''
+
+        keys = self._keys.get(player)
+        if keys is None:
+            return None
+        ranking = self._by_average if by_average else self._by_total
+        return ranking.index(keys[by_average]) + 1
+
+    def around(self, position: int, by_average: bool = False, n: int = 2) -> list[tuple[int, int, float]]:
+        '''Gets the position, player and value of the `n` players above and below `position`, and of the player at it.'''
+
+        ranking = self._by_average if by_average else self._by_total
+        rows = []
+        for i in range(max(position - 1 - n, 0), min(position + n, len(ranking))):
+            value, player = ranking[i]
+            rows.append((i + 1, player, -value))
+        return rows
+
+    def __len__(self) -> int:
+
+        return len(self._keys)
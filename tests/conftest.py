@@ -0,0 +1,25 @@
+'''
+Shared setup of the tests. The bot's modules sit at the root of the
+repository, which is put on the path so that they import as in production.
+'''
+
+import os
+import sys
+import time
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gw2_api import ItemType, PriceHistory
+
+# Prices of the snapshot recorded by the `history` fixture, in coppers
+PRICES = {ItemType.ectoplasm: 2500, ItemType.rune: 30000}
+
+@pytest.fixture
+def history(tmp_path) -> PriceHistory:
+    '''A price history holding a single snapshot, taken a day ago.'''
+
+    history = PriceHistory(str(tmp_path / 'prices.db'))
+    history.record(PRICES, time.time() - 86400)
+    yield history
+    history.close()
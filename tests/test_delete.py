@@ -0,0 +1,56 @@
+'''Tests of /gamba delete.'''
+
+import asyncio
+import time
+import main as commands
+from bot import GambaBot, DATA_TABLE
+from connector import Connector, DAY_SECONDS
+from gamble import Gamble
+from gw2_api import API, ItemType, PriceHistory
+
+class User:
+
+    def __init__(self, id: int):
+
+        self.id = id
+
+class Context:
+    '''Stand-in for the context of a slash command, which only keeps the responses.'''
+
+    def __init__(self, bot: GambaBot, author: User, guild_id: int):
+
+        self.bot = bot
+        self.author = author
+        self.guild_id = guild_id
+        self.responses: list[str] = []
+
+    async def respond(self, content: str | None = None, **kwargs):
+
+        self.responses.append(content)
+
+def test_delete_reports_archived_gambles(tmp_path):
+
+    history = PriceHistory(str(tmp_path / 'prices.db'))
+    old = time.time() - 30 * DAY_SECONDS
+    history.record({ItemType.ectoplasm: 2500, ItemType.rune: 30000}, old - DAY_SECONDS)
+
+    async def main():
+        bot = GambaBot(dbfile=str(tmp_path / 'gambles.db'), api=API(history=history))
+        try:
+            await bot._dbconn.write(Connector.save_gambles, DATA_TABLE,
+                [Gamble(1, 2, 300, 40, 0, old, guild=7), Gamble(1, 1, 50, 10, 0, old + 60, guild=7)])
+            await bot._dbconn.write(Connector.archive_gambles, DATA_TABLE, time.time() - DAY_SECONDS)
+            await bot.handle_gamble(User(1), 3, 500, 20, 0, guild=7)
+
+            ctx = Context(bot, User(1), 7)
+            await commands.delete.callback(ctx)
+            await commands.delete.callback(ctx)
+            assert "has been deleted" in ctx.responses[0]
+            assert "nothing left to delete" in ctx.responses[1]
+            # The archived gambles still count
+            totals = (await bot._dbconn.read(Connector.user_totals, DATA_TABLE, 1, 7))[0]
+            assert totals.hands == 3
+        finally:
+            await bot._api.close()
+            await bot._dbconn.close()
+    asyncio.run(main())
@@ -0,0 +1,68 @@
+'''Tests of the per-player distribution statistics kept alongside the gambles.'''
+
+import random
+import time
+from connector import Connector, DAY_SECONDS
+from gamble import Gamble
+from gw2_api import PriceHistory
+from conftest import PRICES
+
+TABLE = 'data'
+
+def connect(tmp_path, history: PriceHistory) -> Connector:
+
+    conn = Connector(str(tmp_path / 'gambles.db'), history=history)
+    conn.migrate(TABLE)
+    return conn
+
+def test_delete_replays_to_rebuilt_statistics(tmp_path, history):
+
+    conn = connect(tmp_path, history)
+    rng = random.Random(0)
+    now = time.time()
+    for i in range(60):
+        player = i % 3
+        hands = rng.randint(1, 20)
+        conn.save_gamble(TABLE, Gamble(player, hands, rng.randint(0, 250 * hands), rng.randint(0, 600 * hands),
+            rng.randint(0, 1), now - 3600 + i, guild=1))
+
+    # Each deletion has to bring back the extremes and streaks the deleted session replaced
+    for _ in range(10):
+        for player in range(3):
+            assert conn.remove_last_gamble(TABLE, player, 1)
+            assert conn.verify_distributions(TABLE) == []
+    assert conn.player_distribution(TABLE, 0, 1).sessions == 10
+
+def test_sessions_before_the_first_snapshot_are_left_out(tmp_path):
+
+    history = PriceHistory(str(tmp_path / 'prices.db'))
+    conn = connect(tmp_path, history)
+    now = time.time()
+    # Saved before any price is known
+    conn.save_gamble(TABLE, Gamble(1, 2, 300, 40, 0, now - 50, guild=1))
+    history.record(PRICES, now - 10)
+    conn.save_gamble(TABLE, Gamble(1, 2, 900, 40, 0, now, guild=1))
+    # Saved once prices are known, but played before the first snapshot
+    conn.save_gamble(TABLE, Gamble(2, 2, 900, 40, 0, now - 100, guild=1))
+
+    assert conn.player_distribution(TABLE, 1, 1).sessions == 1
+    assert conn.player_distribution(TABLE, 2, 1) is None
+    # A rescan values them the same way
+    assert conn.verify_distributions(TABLE) == []
+    assert conn.rebuild_distributions(TABLE) == 0
+    conn._connection.close()
+    history.close()
+
+def test_archived_sessions_are_not_replayed(tmp_path, history):
+
+    conn = connect(tmp_path, history)
+    now = time.time()
+    history.record(PRICES, now - 30 * DAY_SECONDS)
+    conn.save_gambles(TABLE, [Gamble(1, 1, 500 * i, 100, 0, now - 20 * DAY_SECONDS + i, guild=1) for i in range(1, 6)])
+    conn.archive_gambles(TABLE, now - 10 * DAY_SECONDS)
+    conn.save_gamble(TABLE, Gamble(1, 1, 0, 0, 0, now, guild=1))
+
+    assert conn.remove_last_gamble(TABLE, 1, 1)
+    assert conn.player_distribution(TABLE, 1, 1).sessions == 5
+    assert conn.verify_distributions(TABLE) == []
+    assert not conn.remove_last_gamble(TABLE, 1, 1)
@@ -0,0 +1,44 @@
+'''Tests of the valuation of gambles.'''
+
+import random
+import pytest
+import gamble
+from benchmarks import FixedPriceAPI
+from gamble import Gamble, GambleBatch
+
+ECTO_VALUE = 0.2537
+RUNE_VALUE = 3.1
+
+def random_rows(count: int, seed: int = 0) -> list[tuple]:
+
+    rng = random.Random(seed)
+    rows = []
+    for player in range(count):
+        hands = rng.randint(1, 500)
+        rows.append((player, hands, rng.randint(0, 200 * hands), rng.randint(0, 500 * hands), rng.randint(0, 3), 0.0))
+    return rows
+
+@pytest.mark.parametrize('vectorized', [True, False], ids=['numpy', 'arrays'])
+def test_batch_values_match_gambles(monkeypatch, vectorized: bool):
+
+    if vectorized:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(gamble, '_numpy', lambda: None)
+    rows = random_rows(1000)
+    totals, averages = GambleBatch(rows).get_values(ECTO_VALUE, RUNE_VALUE)
+
+    assert len(totals) == len(averages) == len(rows)
+    for row, total, average in zip(rows, totals, averages):
+        # Gamble values are rounded to the copper, batch values are not
+        assert Gamble(*row)._compute_value(ECTO_VALUE, RUNE_VALUE) == (round(total, 2), round(average, 2))
+
+def test_shared_values_follow_prices():
+
+    cheap, dear = FixedPriceAPI(0.2, 3.0), FixedPriceAPI(0.3, 3.0)
+    # Both stand-ins count their refreshes from the same epoch
+    assert cheap.epoch == dear.epoch
+    g = Gamble(1, 10, 2000, 3000, 1)
+    assert g.get_value(cheap) == g._compute_value(0.2, 3.0)
+    assert g.get_value(dear) == g._compute_value(0.3, 3.0)
+    assert Gamble(2, 10, 2000, 3000, 1).get_value(cheap) == g._compute_value(0.2, 3.0)
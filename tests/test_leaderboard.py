@@ -0,0 +1,55 @@
+'''Tests of the leaderboards shown by /gamba winners and /gamba losers.'''
+
+import asyncio
+import time
+from bot import GambaBot, TimeWindow
+from benchmarks import FixedPriceAPI
+
+class User:
+
+    def __init__(self, id: int):
+
+        self.id = id
+
+def run(tmp_path, test):
+    '''Runs `test` on a bot with an empty database, closing it afterwards.'''
+
+    async def main():
+        bot = GambaBot(dbfile=str(tmp_path / 'gambles.db'), api=FixedPriceAPI())
+        try:
+            return await test(bot)
+        finally:
+            await bot._dbconn.close()
+    return asyncio.run(main())
+
+def assert_valid(embed):
+    '''Discord rejects embeds with fields lacking a name or a value.'''
+
+    assert all(field.name and field.value for field in embed.fields)
+
+def test_empty_guild(tmp_path):
+
+    async def test(bot: GambaBot):
+        for winners in (True, False):
+            embed = await bot.create_leaderboard(5, winners, guild=1234)
+            assert_valid(embed)
+            assert not embed.fields
+            assert "hasn't registered any gambles" in embed.description
+    run(tmp_path, test)
+
+def test_empty_window(tmp_path):
+
+    async def test(bot: GambaBot):
+        # The only gamble was played before the window starts
+        await bot.handle_gamble(User(1), 3, 500, 20, 0, guild=1234)
+        now = time.time()
+        window = TimeWindow(now + 3600, now + 7200, 'tomorrow')
+        page = await bot.leaderboard_page(5, True, 1234, window)
+        assert_valid(page.embed)
+        assert not page.embed.fields and '(tomorrow)' in page.embed.description
+        assert not page.has_previous and not page.has_next
+
+        filled = await bot.create_leaderboard(5, True, guild=1234)
+        assert_valid(filled)
+        assert len(filled.fields) == 2
+    run(tmp_path, test)
@@ -0,0 +1,173 @@
+'''
+Streaming import and export of gamble histories, as CSV or JSON Lines.
+
+Every record has the fields of `Gamble.__str__`: timestamp, user, hands,
+gold, ectos, runes and guild. Files are read and written one chunk at a
+time, so memory stays constant for histories of millions of gambles.
+'''
+
+import csv
+import json
+import math
+from datetime import datetime, timezone
+from itertools import islice
+from typing import Iterable, Iterator, TextIO
+from connector import Connector
+from gamble import Gamble
+
+FIELDS = ('timestamp', 'user', 'hands', 'gold', 'ectos', 'runes', 'guild')
+FORMATS = ('csv', 'jsonl')
+IMPORT_CHUNK_SIZE = 10_000
+MAX_REPORTED_ERRORS = 20
+
+class ImportReport:
+    '''Counts of the records read by an import. Only the first few invalid records are described.'''
+
+    def __init__(self):
+
+        self.imported = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.errors: list[str] = []
+
+    def reject(self, line: int, reason: str):
+        '''Counts an invalid record, found on the given line of the file.'''
+
+        self.invalid += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f"line {line}: {reason}")
+
+def detect_format(filename: str) -> str:
+    '''Guesses the format of a file from its extension. Raises a ValueError if it isn't known.'''
+
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if extension == 'csv':
+        return 'csv'
+    if extension in ('jsonl', 'ndjson'):
+        return 'jsonl'
+    raise ValueError(f"Can't tell the format of '{filename}', expected one of: {', '.join(FORMATS)}.")
+
+def export_gambles(conn: Connector, table: str, file: TextIO, fmt: str, guild: int | None = None) -> int:
+    '''
+    Writes every gamble of a table to `file`, and returns the number written.
+    - `fmt` - one of `FORMATS`.
+    - `guild` - if given, only exports the gambles recorded in that guild.
+    '''
+
+    gambles = conn.iter_gambles(table, guild)
+    count = 0
+    if fmt == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(FIELDS)
+        for g in gambles:
+            writer.writerow((repr(g.timestamp), g.user, g.hands, g.gold, g.ectos, g.runes, g.guild))
+            count += 1
+    else:
+        for g in gambles:
+            file.write(f"{g}\n")
+            count += 1
+    return count
+
+def import_gambles(
+        conn: Connector,
+        table: str,
+        file: TextIO,
+        fmt: str,
+        guild: int = 0,
+        chunk_size: int = IMPORT_CHUNK_SIZE) -> ImportReport:
+    '''
+    Saves every valid gamble read from `file`, skipping those already recorded.
+    Each chunk of `chunk_size` gambles is saved in its own transaction.
+    - `fmt` - one of `FORMATS`.
+    - `guild` - guild of the records that don't name one, such as rows of an old spreadsheet.
+    '''
+
+    report = ImportReport()
+    gambles = _parse_records(_read_records(file, fmt), guild, report)
+    while chunk := list(islice(gambles, chunk_size)):
+        imported = conn.import_gambles(table, chunk)
+        report.imported += imported
+        report.duplicates += len(chunk) - imported
+    return report
+
+def parse_gamble(record: dict, guild: int = 0) -> Gamble:
+    '''
+    Builds a gamble from an imported record, raising a ValueError describing
+    the first invalid field. Timestamps may be unix times or ISO 8601 dates,
+    which are taken as UTC unless they say otherwise.
+    '''
+
+    return Gamble(
+        _integer(record, 'user', minimum=1),
+        _integer(record, 'hands', minimum=1),
+        _integer(record, 'gold'),
+        _integer(record, 'ectos'),
+        _integer(record, 'runes'),
+        timestamp=_timestamp(record),
+        guild=_integer(record, 'guild', default=guild))
+
+def _read_records(file: TextIO, fmt: str) -> Iterator[tuple[int, dict | None]]:
+    '''Yields the line number and fields of every record of a file, or None for lines that can't be parsed.'''
+
+    if fmt == 'csv':
+        reader = csv.DictReader(file)
+        for record in reader:
+            yield reader.line_num, record
+        return
+
+    for line, text in enumerate(file, start=1):
+        if not text.strip():
+            continue
+        try:
+            record = json.loads(text)
+        except json.JSONDecodeError:
+            record = None
+        yield line, record if isinstance(record, dict) else None
+
+def _parse_records(records: Iterable[tuple[int, dict | None]], guild: int, report: ImportReport) -> Iterator[Gamble]:
+    '''Yields the gambles of the valid records, counting the others in `report`.'''
+
+    for line, record in records:
+        if record is None:
+            report.reject(line, "not a JSON object")
+            continue
+        try:
+            yield parse_gamble(record, guild)
+        except ValueError as e:
+            report.reject(line, str(e))
+
+def _integer(record: dict, field: str, minimum: int = 0, default: int | None = None) -> int:
+
+    value = record.get(field)
+    if value is None or value == '':
+        if default is not None:
+            return default
+        raise ValueError(f"missing '{field}'")
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"'{field}' must be an integer, not {value!r}")
+    if isinstance(value, bool) or (isinstance(value, float) and value != number):
+        raise ValueError(f"'{field}' must be an integer, not {value!r}")
+    if number < minimum:
+        raise ValueError(f"'{field}' must be at least {minimum}, not {number}")
+    return number
+
+def _timestamp(record: dict) -> float:
+
+    value = record.get('timestamp')
+    if value is None or value == '':
+        raise ValueError("missing 'timestamp'")
+    try:
+        timestamp = float(value)
+    except (TypeError, ValueError):
+        try:
+            date = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"'timestamp' must be a unix time or an ISO 8601 date, not {value!r}")
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        timestamp = date.timestamp()
+    if not math.isfinite(timestamp) or timestamp < 0:
+        raise ValueError(f"'timestamp' must be a positive unix time, not {value!r}")
+    return timestamp